@@ -4,29 +4,275 @@ import sys
 import os
 import json
 
-from bottle import route, run, debug, template, request, \
-    static_file
+from collections import Counter
+from itertools import chain, izip
+
+from bottle import route, run, debug, template, request, response, \
+    default_app, HTTPResponse
 
 from optparse import OptionParser
 
-from truckstop.search import Query, mk_tfidf_dot
-from truckstop.loader import load
+from truckstop.search import Query, QueryPlanner, PrefixIndex, \
+    mk_tfidf_dot, term_suggestions, word_splitter
+from truckstop.loader import load, load_schedule
+from truckstop.store import DISPLAYED_FIELDS
+from truckstop.schedule import parse_moment
+from truckstop.cache import QueryCache
+from truckstop.reloader import Reloader
+from truckstop.assets import Assets
+from truckstop import snapshot, server, stats
 from truckstop.utils import param_validator
 
-SPATIAL_INDEX = None
-TEXT_INDEX = None
-OBJECT_STORE = None
 
-TEXT_DISTANCE_FUNC = None
+class Indexes(object):
+    """Everything the handlers search, built from one load of the data.
+
+    Handlers read the current `INDEXES` once, and use only that for the
+    rest of the request, so swapping in a reload is a single assignment
+    which never mixes old and new data in a response. Each load gets a
+    fresh cache, so cached results never outlive their data. That's
+    also why permits are never changed in place, with `loader.update`
+    and friends: the cache and the suggestions would go stale.
+
+    `schedule`, if there is one, is the `Schedule` of when each of the
+    `objects` is open. `counters` are what loading them counted, like
+    how many rows were skipped.
+    """
+
+    def __init__(self, spatial, text, objects, schedule=None,
+                 counters=None):
+        self.spatial = spatial
+        self.text = text
+        self.objects = objects
+        self.schedule = schedule
+        self.counters = counters or Counter()
+        self.text_distance_func = mk_tfidf_dot(text)
+        self.planner = QueryPlanner(spatial, text)
+        self.cache = QueryCache()
+
+        applicants = [objects.value(o, 'Applicant') for o in objects]
+        # the texts are only read if the index doesn't already know the
+        # words its terms are suggested as
+        self.term_suggestions = term_suggestions(
+            text, chain(applicants, (objects.value(o, 'FoodItems')
+                                     for o in objects)))
+        self.name_suggestions = PrefixIndex(Counter(applicants))
+
+        # build the filter bitmaps now, rather than on the first search
+        for _, field in FILTERS:
+            if objects.column(field) is not None:
+                objects.bitmaps(field)
+
+
+INDEXES = None
+
+def swap_indexes(indexes):
+    """Starts serving from `indexes`, an `Indexes`"""
+    global INDEXES
+    INDEXES = indexes
+
+def set_indexes(spatial, text, objects, schedule=None, counters=None):
+    """Starts serving from `spatial`, `text`, `objects` and
+    `schedule`"""
+    swap_indexes(Indexes(spatial, text, objects, schedule, counters))
+
+def load_indexes(fname, share=False, schedule=None, processes=None):
+    """Loads (spatial, text, objects, schedule, counters) from `fname`,
+    a snapshot or a CSV, and the schedule table `schedule`, if given.
+    With `share`, indexes built from a CSV are moved into a mapping,
+    for forked workers to share. A CSV's text is analyzed by
+    `processes` loader processes (see `loader.load`)."""
+    counters = Counter()
+    if snapshot.is_snapshot(fname):
+        indexes = snapshot.load(fname)
+    else:
+        indexes = load(fname, processes=processes, counters=counters)
+        if share:
+            indexes = snapshot.shared(*indexes)
+    if schedule is not None:
+        # the schedule refers to rows, so it has to be loaded again
+        # along with them
+        schedule = load_schedule(schedule, indexes[2], counters)
+    return indexes + (schedule, counters)
+
+def build_indexes(fname, share=False, schedule=None, processes=None):
+    """The `Indexes` of what `load_indexes` loads, ready to be
+    swapped in"""
+    return Indexes(*load_indexes(fname, share, schedule, processes))
+
+def rebuild_indexes(fname, share=False, schedule=None):
+    """`build_indexes`, as the `Reloader` runs it, on one of gevent's
+    threads. gevent can only fork from the hub's thread, so the text is
+    analyzed right there rather than by loader processes."""
+    return build_indexes(fname, share, schedule, processes=1)
+
+ASSETS = None
+
+def set_assets(directory, watch=False):
+    """Starts serving the static files under `directory`, from memory
+    (see `truckstop/assets.py`). With `watch`, changed files are picked
+    up as they're requested."""
+    global ASSETS
+    ASSETS = Assets(directory, watch=watch)
+
+@route('/static/<path:path>')
+def static(path):
+    status, headers, body = ASSETS.response(
+        path, request.headers.get('Accept-Encoding'),
+        request.headers.get('If-None-Match'), request.method == 'HEAD')
+    return HTTPResponse(body, status, **headers)
+
+# fields which aren't straight out of the object store
+COMPUTED_FIELDS = {
+    'Address': lambda o, distance: DISPLAYED_FIELDS['Address'](o['Address']),
+    'distance': lambda o, distance: distance,
+    'distance_desc': lambda o, distance: '%.2fmi' % distance,
+}
+
+def venue(o, distance, fields=None):
+    """Builds the response for a single object `distance` miles away,
+    with only `fields`, if given."""
+    if fields is None:
+        fields = o.keys() + ['distance', 'distance_desc']
+
+    v = {}
+    for f in fields:
+        if f in COMPUTED_FIELDS:
+            v[f] = COMPUTED_FIELDS[f](o, distance)
+        elif f in o:
+            v[f] = o[f]
+    return v
+
+def venue_fields(objects, fields):
+    """The comma separated `fields` as a list, or None if there aren't
+    any. Each has to be a field of `objects`, or a computed one."""
+    names = [f.strip() for f in fields.split(',') if f.strip()]
+    unknown = [f for f in names
+               if f not in COMPUTED_FIELDS and f not in objects.fields]
+    if unknown:
+        raise ValueError("Unknown fields: %s" % ', '.join(
+            f.encode('utf-8') if isinstance(f, unicode) else f
+            for f in unknown))
+    return [str(f) for f in names] or None
 
-def mk_static(route_base):
-    def s(filename):
-        return static_file(filename, root=os.path.abspath('.' + route_base))
-    return route(os.path.join(route_base,'<filename>'))(s)
+# the most searches /api/v1/search_batch.json takes at once
+MAX_BATCH = 500
 
-mk_static('/static/js')
-mk_static('/static/css')
-mk_static('/static/img')
+# (search parameter, categorical field) of what searches can filter on
+FILTERS = (
+    ('status', 'Status'),
+    ('facility_type', 'FacilityType'),
+)
+
+def search_filters(objects, params):
+    """The filters in `params` as {field: [values]}, or None if there
+    aren't any. Each parameter is a comma separated list of values,
+    any of which will do, matched regardless of case."""
+    filters = {}
+    for param, field in FILTERS:
+        given = params.get(param)
+        if not given:
+            continue
+        if not isinstance(given, basestring):
+            raise ValueError("Invalid %s" % param)
+        column = objects.column(field)
+        known = dict((v.lower(), v) for v in column.values)
+        values = []
+        for v in given.split(','):
+            v = v.strip().lower()
+            if v not in known:
+                raise ValueError("%s must be one of: %s" % (
+                    param, ', '.join(sorted(column.values))))
+            values.append(known[v])
+        filters[field] = values
+    return filters or None
+
+def open_moment(indexes, open_at):
+    """The (weekday, minute) `open_at` names, or None if it's empty"""
+    if not open_at:
+        return None
+    if not isinstance(open_at, basestring):
+        raise ValueError("Invalid open_at")
+    if indexes.schedule is None:
+        raise ValueError("open_at needs a schedule, and none is loaded")
+    return parse_moment(open_at)
+
+def cache_filters(indexes, filters, moment):
+    """What a search limited by `filters` and `moment` is cached on.
+    Every moment in a stretch where the same venues are open shares
+    results."""
+    if moment is None:
+        return filters
+    keyed = dict(filters or {})
+    keyed['open_at'] = [indexes.schedule.segment(*moment)]
+    return keyed
+
+def allowed_keys(indexes, filters, moment):
+    """A `Bitmap` of the venues matching `filters` and open at
+    `moment`, or None if neither limits the search"""
+    allowed = None
+    if filters:
+        allowed = indexes.objects.matching(filters)
+    if moment is not None:
+        is_open = indexes.schedule.open_at(*moment)
+        allowed = is_open if allowed is None else allowed & is_open
+    return allowed
+
+def check_search(radius=10, page=1, per_page=10, nearest=None):
+    """Raises a ValueError if any of the search parameters are out of
+    bounds"""
+    if radius <= 0 or radius > 15:
+        raise ValueError("radius must be > 0 and < 15")
+    if page <= 0:
+        raise ValueError("page must be > 0")
+    if per_page <= 0 or per_page > 50:
+        raise ValueError("per page must be between 0 and 50")
+    if nearest is not None and (nearest <= 0 or nearest > 50):
+        raise ValueError("nearest must be between 0 and 50")
+
+def page_rows(indexes, results, pt, origin, offset, per_page):
+    """[(distance, oid)] of the venues on the page of `results` starting
+    at `offset`, which were measured from `origin`, ordered by distance
+    from `pt`."""
+    shown = results[offset:offset + per_page]
+    if origin != pt:
+        # measured from somewhere else in the same cache cell
+        shown = indexes.spatial.distances(pt, [k for _, k in shown])
+
+    # only the objects on this page ever get looked at
+    objects = indexes.objects
+    rows = [(distance, oid) for distance, oid in sorted(shown)
+            if objects.get(oid)]
+    stats.count('rows', len(rows))
+    return rows
+
+def page_of(indexes, results, pt, origin, offset, per_page, fields):
+    """The venues on a page of `results`, as `page_rows` finds them"""
+    return [venue(indexes.objects[oid], distance, fields)
+            for distance, oid in page_rows(indexes, results, pt, origin,
+                                           offset, per_page)]
+
+def venues_json(objects, rows, fields=None):
+    """The JSON of each of the venues `rows`, [(distance, oid)].
+
+    Whole venues are spliced together from each object's pre-encoded
+    fragment and its distance, so only the distance gets encoded.
+    Venues with only some `fields` are encoded from scratch.
+    """
+    if fields is not None:
+        return [json.dumps(venue(objects[oid], distance, fields))
+                for distance, oid in rows]
+    return ['{%s, "distance": %r, "distance_desc": "%.2fmi"}' %
+            (objects.fragment(oid), distance, distance)
+            for distance, oid in rows]
+
+def with_venues(result, venues):
+    """The JSON of `result` with a `venues` list of the already encoded
+    `venues` spliced in"""
+    rest = json.dumps(result)
+    if rest == '{}':
+        return '{"venues": [%s]}' % ', '.join(venues)
+    return '{"venues": [%s], %s' % (', '.join(venues), rest[1:])
 
 @route('/api/v1/search.json')
 @param_validator(lat=(float, "Invalid Latitude"),
@@ -34,58 +280,305 @@ mk_static('/static/img')
                  radius=(float, None),
                  query=(str, None),
                  page=(int, None),
-                 per_page=(int, None),)
+                 per_page=(int, None),
+                 nearest=(int, None),
+                 fields=(str, None),
+                 explain=(int, None),
+                 status=(str, None),
+                 facility_type=(str, None),
+                 open_at=(str, None),)
 def api_search(lat=None, lon=None, radius=10, 
-               query='', page=1, per_page=10):
+               query='', page=1, per_page=10, nearest=None, fields='',
+               explain=0, status='', facility_type='', open_at=''):
     """Searches a given area identified by the parameters
     `lat`, `lon` and `radius` for `query` (optional)
+
+    Results come back `per_page` at a time. Without a query, pages go
+    from closest to furthest. With one, they go from most to least
+    relevant, with each page ordered by distance. `more` says whether
+    there's another page.
+
+    If `nearest` is given, only the `nearest` closest (or most
+    relevant) venues are returned, rather than everything in range.
+    `fields` is a comma separated list of the only fields to return for
+    each venue. If `explain` is set, the query plan used is described
+    in the response, along with whether the results were cached.
+
+    `status` and `facility_type` limit the search to venues with one of
+    the comma separated values given, like `status=approved` or
+    `facility_type=truck,push cart`. Venues which don't match are
+    skipped while walking the indexes, so filtering makes a search
+    cheaper, not dearer.
+
+    If a schedule is loaded, `open_at` limits the search to venues open
+    at a moment: `now`, a time today like `14:30`, or a weekday and a
+    time, like `fri 2:30pm`, all in the server's local time.
+
+    Results for nearby searches for the same thing are shared through
+    the current indexes' cache.
+
+    When the app runs with `--profile`, the response has an
+    `X-Truckstop-Timing` header saying how long each stage of the
+    search took, in milliseconds, and counting the work done, and the
+    same goes into the totals at `/debug/stats`.
     """
-    if radius <= 0 or radius > 15:
-        raise ValueError("radius must be > 0 and < 15")
-    if page <= 0:
-        raise ValueError("page must be > 0")
-    if per_page <= 0 or per_page > 50:
-        raise ValueError("per page must be between 0 and 50")
+    check_search(radius, page, per_page, nearest)
+    indexes = INDEXES
 
-                
-    results = SPATIAL_INDEX.search((lat, lon), radius)
-    distances = dict((v, k) for k, v in results)
-    textscores = {}
+    # one more than the page needs tells us if there's another page
+    offset = (page - 1) * per_page
+    wanted = offset + per_page + 1
+    if nearest:
+        wanted = min(wanted, nearest)
 
-    if query and results:
-        keys = set(x[1] for x in results)
-        results = TEXT_INDEX.query(Query(query), keys=keys)
-        scores = dict((v, k) for k, v in results)
+    pt = (lat, lon)
+    filters = search_filters(indexes.objects, {'status': status,
+                                               'facility_type': facility_type})
+    moment = open_moment(indexes, open_at)
+    timing = stats.begin()
 
-    # we also need to keep the correct distances from above.z
-    # do paging now, then get the correct objects from the OBJECT_STORE
+    with stats.stage('parse'):
+        query = Query(query) if query else None
+    with stats.stage('cache'):
+        key = indexes.cache.key(pt, radius, query,
+                                cache_filters(indexes, filters, moment))
+        cached = indexes.cache.get(key, wanted)
+    if cached is None:
+        with stats.stage('plan'):
+            allowed = allowed_keys(indexes, filters, moment)
+            plan = indexes.planner.plan(pt, radius, query=query,
+                                        max_results=wanted, allowed=allowed)
+        results = plan.execute()
+        origin = pt
+        indexes.cache.put(key, wanted, results, pt, plan)
+    else:
+        results, origin, plan = cached
+        results = results[:wanted]
 
-    objects = []
-    for s, oid in results:
-        o = OBJECT_STORE.get(oid)
-        if o:
-            o = o.copy()
-            o['Address'] = o['Address'].title()
-            o['distance'] = distances.get(oid, 10000)
-            o['distance_desc'] = '%.2fmi' % distances.get(oid, 10000)
-            objects.append(o.copy())
+    fields = [f for f in fields.split(',') if f] or None
+    with stats.stage('page'):
+        rows = page_rows(indexes, results, pt, origin, offset, per_page)
+    result = {'page': page, 'per_page': per_page,
+              'more': len(results) > offset + per_page}
+    if explain:
+        result['plan'] = plan.explain()
+        result['cached'] = cached is not None
+
+    with stats.stage('json'):
+        body = with_venues(result, venues_json(indexes.objects, rows,
+                                               fields))
+    response.content_type = 'application/json'
+    if timing is not None:
+        stats.finish()
+        response.set_header('X-Truckstop-Timing', timing.header())
+    return body
+
+def batch_search(search):
+    """Parses one search in a batch into (pt, radius, Query or None)"""
+    if not isinstance(search, dict):
+        raise ValueError("Invalid search")
+    try:
+        lat = float(search.get('lat'))
+    except (TypeError, ValueError):
+        raise ValueError("Invalid Latitude")
+    try:
+        lon = float(search.get('lon'))
+    except (TypeError, ValueError):
+        raise ValueError("Invalid Longitude")
+    try:
+        radius = float(search.get('radius', 10))
+    except (TypeError, ValueError):
+        raise ValueError("Invalid radius")
+    check_search(radius)
+
+    query = search.get('query') or ''
+    if isinstance(query, unicode):
+        query = query.encode('utf-8')
+    elif not isinstance(query, str):
+        raise ValueError("Invalid query")
+    return (lat, lon), radius, Query(query) if query else None
+
+@route('/api/v1/search_batch.json', method='POST')
+def api_search_batch():
+    """Runs many searches at once, posted as a JSON object like:
+
+        {"searches": [{"lat": 37.78, "lon": -122.41, "radius": 1,
+                       "query": "tacos"}, ...],
+         "per_page": 10, "nearest": 5, "fields": "Applicant,distance",
+         "status": "approved", "open_at": "now"}
+
+    Everything but `searches` is optional, and applies to every search,
+    as it would for `/api/v1/search.json`. Only the first page of each
+    search is returned.
+
+    The response has a `results` list with one entry per search, in
+    order: either `{"venues": [...], "more": ...}` or `{"error": ...}`.
+    Searches which aren't cached share their walks of the spatial index.
+    """
+    indexes = INDEXES
+    try:
+        body = request.json
+    except ValueError:
+        body = None
+    if not isinstance(body, dict) or \
+            not isinstance(body.get('searches'), list):
+        return {'error': "expected a JSON object with a list of searches"}
+    searches = body['searches']
+
+    try:
+        per_page = int(body.get('per_page', 10))
+        nearest = body.get('nearest')
+        if nearest is not None:
+            nearest = int(nearest)
+        fields = body.get('fields') or ''
+        if not isinstance(fields, basestring):
+            raise ValueError("Invalid fields")
+        fields = venue_fields(indexes.objects, fields)
+        check_search(per_page=per_page, nearest=nearest)
+        filters = search_filters(indexes.objects, body)
+        moment = open_moment(indexes, body.get('open_at'))
+        keyed = cache_filters(indexes, filters, moment)
+    except (TypeError, ValueError), e:
+        return {'error': str(e)}
+    if len(searches) > MAX_BATCH:
+        return {'error': "at most %d searches at a time" % MAX_BATCH}
+
+    wanted = per_page + 1
+    if nearest:
+        wanted = min(wanted, nearest)
+
+    results = [None] * len(searches)
+    misses = []
+    for i, search in enumerate(searches):
+        try:
+            pt, radius, query = batch_search(search)
+        except ValueError, e:
+            results[i] = {'error': str(e)}
+            continue
+
+        key = indexes.cache.key(pt, radius, query, keyed)
+        cached = indexes.cache.get(key, wanted)
+        if cached is None:
+            misses.append((i, pt, radius, query, key))
+        else:
+            found, origin, _ = cached
+            results[i] = (pt, origin, found[:wanted])
 
-    return {'venues': sorted(objects, key=lambda x: x['distance'])}
+    allowed = None
+    if misses:
+        allowed = allowed_keys(indexes, filters, moment)
+    executed = indexes.planner.execute_many([(pt, radius, query)
+                                     for _, pt, radius, query, _ in misses],
+                                    max_results=wanted, allowed=allowed)
+    for (i, pt, _, _, key), (plan, found) in izip(misses, executed):
+        indexes.cache.put(key, wanted, found, pt, plan)
+        results[i] = (pt, pt, found)
+
+    for i, result in enumerate(results):
+        if isinstance(result, tuple):
+            pt, origin, found = result
+            results[i] = {'venues': page_of(indexes, found, pt, origin, 0,
+                                            per_page, fields),
+                          'more': len(found) > per_page}
+    return {'results': results}
+
+@route('/api/v1/suggest.json')
+@param_validator(prefix=(str, "Invalid prefix"),
+                 count=(int, None),)
+def api_suggest(prefix=None, count=5):
+    """Suggests ways to finish typing `prefix`, without searching.
+
+    `terms` finish the last word of `prefix` with words in the index,
+    and `names` are venue names starting with `prefix`. Each has up to
+    `count` suggestions, most common first.
+    """
+    if not prefix.strip() or len(prefix) > 64:
+        raise ValueError("prefix must be between 1 and 64 characters")
+    if count <= 0 or count > PrefixIndex.MAX_SUGGESTIONS:
+        raise ValueError("count must be between 1 and %d" %
+                         PrefixIndex.MAX_SUGGESTIONS)
+
+    indexes = INDEXES
+    words = word_splitter(prefix)
+    terms = []
+    if words and not prefix[-1].isspace():
+        typed = ' '.join(words[:-1] + [''])
+        terms = [typed + t for t in
+                 indexes.term_suggestions.suggest(words[-1], count)]
+
+    return {'terms': terms,
+            'names': indexes.name_suggestions.suggest(prefix.strip(),
+                                                      count)}
+
+# the most venues /api/v1/roulette.json picks at once
+MAX_ROULETTE = 10
 
 @route('/api/v1/roulette.json')
-def api_roulette():
-    return {'venues': []}
+@param_validator(lat=(float, "Invalid Latitude"),
+                 lon=(float, "Invalid Longitude"),
+                 radius=(float, None),
+                 query=(str, None),
+                 count=(int, None),
+                 fields=(str, None),
+                 status=(str, None),
+                 facility_type=(str, None),
+                 open_at=(str, None),)
+def api_roulette(lat=None, lon=None, radius=1, query='', count=1,
+                 fields='', status='', facility_type='', open_at=''):
+    """Surprise me: picks `count` venues at random within `radius` of
+    `lat`, `lon`, matching `query`, if given.
+
+    Every venue in range is as likely to be picked as any other, but
+    they're picked without gathering them all up, so this costs about
+    as much as looking up a single point. `fields`, `status`,
+    `facility_type` and `open_at` work as they do for
+    `/api/v1/search.json`. Picks are never cached.
+    """
+    check_search(radius)
+    if count <= 0 or count > MAX_ROULETTE:
+        raise ValueError("count must be between 1 and %d" % MAX_ROULETTE)
+    indexes = INDEXES
+
+    filters = search_filters(indexes.objects, {'status': status,
+                                               'facility_type': facility_type})
+    moment = open_moment(indexes, open_at)
+    picked = indexes.planner.sample((lat, lon), radius,
+                                    Query(query) if query else None, count,
+                                    allowed_keys(indexes, filters, moment))
+
+    fields = [f for f in fields.split(',') if f] or None
+    venues = []
+    for distance, oid in picked:
+        o = indexes.objects.get(oid)
+        if o:
+            venues.append(venue(o, distance, fields))
+    return {'venues': venues}
+
+@route('/debug/stats')
+def debug_stats():
+    """How this process has been doing: what loading the current
+    indexes counted, their cache hits and misses, and with `--profile`,
+    the mean and worst time spent in each stage of
+    `/api/v1/search.json`, and the work counted there. Each worker
+    keeps its own."""
+    indexes = INDEXES
+    result = {'pid': os.getpid(), 'profile': stats.enabled(),
+              'load': dict(indexes.counters),
+              'cache': indexes.cache.stats()}
+    if stats.enabled():
+        result['search'] = stats.TOTALS.summary()
+    return result
 
 @route('/')
 def index():
-    return template('index')
+    return template('index', static=ASSETS.url)
 
 @route('/about.html')
 def index():
-    return template('about')
+    return template('about', static=ASSETS.url)
 
 
-parser = OptionParser(usage="%prog [options] datafile)")
+parser = OptionParser(usage="%prog [options] datafile|snapshotfile")
 parser.add_option("-b", "--bind", dest="host",
                   default="127.0.0.1")
 parser.add_option("-d", "--dev", dest="dev", action="store_true",
@@ -94,7 +587,25 @@ parser.add_option("-d", "--dev", dest="dev", action="store_true",
 parser.add_option("-p", "--port", dest="port",
                   type="int", default=8080)
 parser.add_option("-s", "--static-directory", dest="static",
-                  default="./static")
+                  default="./static",
+                  help="where the static files are; run "
+                  "`python -m truckstop.assets` on it first to "
+                  "precompress them")
+parser.add_option("-w", "--workers", dest="workers",
+                  type="int", default=1,
+                  help="number of worker processes to serve from")
+parser.add_option("-S", "--schedule", dest="schedule",
+                  default=None,
+                  help="a CSV schedule table of when each permit is open, "
+                  "for searching with open_at")
+parser.add_option("-P", "--profile", dest="profile", action="store_true",
+                  default=False,
+                  help="time each stage of every search, for the "
+                  "X-Truckstop-Timing header and /debug/stats")
+parser.add_option("-r", "--reload-interval", dest="reload_interval",
+                  type="float", default=60,
+                  help="seconds between checks for a changed datafile, "
+                  "or 0 to never reload")
 
 
 if __name__ == '__main__':
@@ -115,12 +626,43 @@ if __name__ == '__main__':
         parser.print_help()
         raise SystemExit()
 
+    if options.profile:
+        stats.enable()
+
+    prefork = options.workers > 1 and not options.dev
+    set_assets(options.static, watch=options.dev)
     print "Loading data from file...."
-    SPATIAL_INDEX, TEXT_INDEX, OBJECT_STORE = load(args[0])
-    print "%d locations indexed" % len(OBJECT_STORE)
+    swap_indexes(build_indexes(args[0], share=prefork,
+                               schedule=options.schedule))
+    print "%d locations indexed" % len(INDEXES.objects)
+    skipped = sorted((name, n) for name, n in INDEXES.counters.iteritems()
+                     if 'skipped' in name.split('.'))
+    if skipped:
+        print "Skipped rows: %s" % ', '.join('%s=%d' % s for s in skipped)
 
-    TEXT_DISTANCE_FUNC = mk_tfidf_dot(TEXT_INDEX)
+    if prefork:
+        print "Starting %d workers on %s:%d..." % (options.workers,
+                                                   options.host,
+                                                   options.port)
+        workers = server.PreforkServer(
+            default_app(), server.listener(options.host, options.port),
+            options.workers)
 
-    print "Starting app on %(host)s:%(port)d..." % params
+        def swap(indexes):
+            # new workers fork from the new indexes
+            swap_indexes(indexes)
+            workers.replace()
+    else:
+        swap = swap_indexes
 
-    run(**params)
+    if options.reload_interval > 0:
+        # everything, down to the suggestions, gets built off the loop
+        Reloader(args[0], lambda fname: rebuild_indexes(
+                    fname, share=prefork, schedule=options.schedule),
+                 swap, options.reload_interval).start()
+
+    if prefork:
+        workers.serve_forever()
+    else:
+        print "Starting app on %(host)s:%(port)d..." % params
+        run(**params)
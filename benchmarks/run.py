@@ -0,0 +1,248 @@
+"""run.py: Times the hot paths, so commits can be compared.
+
+    python -m benchmarks.run -o before.json
+    (change things)
+    python -m benchmarks.run -o after.json
+    python -m benchmarks.run --compare before.json after.json
+
+For each size, a set of synthetic permits (see `synthetic.py`) is
+written out and benchmarked in a fresh process, so each size's peak RSS
+is its own. Per size, the benchmarks are:
+
+  - load: `loader.load`, parsing the CSV and building everything.
+  - kdtree: `kdtree()`, building the tree from projected locations.
+  - spatial_search: `SpatialIndex.search`, for random spots and radii.
+  - document_index: building a `DocumentIndex`.
+  - document_query: `DocumentIndex.query`, for random food items.
+  - api_search: `/api/v1/search.json` end to end, from the query string
+    to the JSON of its response, with the cache emptied before each
+    search, so every one is a miss.
+  - api_search_cached: the same searches again, all cache hits.
+
+Each reports the p50, p99 and mean milliseconds a run took, and
+`objects`, the net number of garbage collected objects a run allocated
+(Python 2 has nothing like tracemalloc, so this comes from the
+collector's allocation count, with collection turned off; objects freed
+during the run cancel out). Sizes also report their peak RSS.
+
+The biggest sizes take a long while; `--sizes` picks others.
+
+With `--compare`, any benchmark whose p50 got more than `--threshold`
+times slower is reported, and the exit status is 1 if there were any.
+"""
+
+import gc
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from optparse import OptionParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks import synthetic
+
+
+DATA = os.path.join(ROOT, 'data', 'Mobile_Food_Facility_Permit.csv')
+
+SIZES = (1000, 10000, 100000, 1000000)
+
+# runs of each build, and searches per size
+REPEAT = 3
+SEARCHES = 200
+
+
+def percentile(timings, p):
+    """The `p`th percentile of `timings`, by nearest rank"""
+    ordered = sorted(timings)
+    rank = int(round(p / 100.0 * len(ordered) + 0.5)) - 1
+    return ordered[max(0, min(len(ordered) - 1, rank))]
+
+
+def measure(func, args):
+    """Calls `func(*a)` for each `a` in `args`, returning the summary
+    of how long each call took, and what it allocated.
+
+    The first call is made with the collector off, to count the objects
+    it allocates, and isn't timed. What it returns is counted too, so a
+    build counts everything it built.
+    """
+    gc.collect()
+    gc.disable()
+    try:
+        before = gc.get_count()[0]
+        result = func(*args[0])
+        objects = gc.get_count()[0] - before
+        del result
+    finally:
+        gc.enable()
+
+    timings = []
+    clock = time.time
+    for a in args:
+        start = clock()
+        func(*a)
+        timings.append((clock() - start) * 1000)
+    return {
+        'runs': len(timings),
+        'p50': percentile(timings, 50),
+        'p99': percentile(timings, 99),
+        'mean': sum(timings) / len(timings),
+        'objects': objects,
+    }
+
+
+def peak_rss():
+    """The most memory this process has had resident, in KB"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss //= 1024
+    return rss
+
+
+def benchmark(size, repeat=REPEAT, searches=SEARCHES, seed=0):
+    """Runs every benchmark on `size` synthetic permits"""
+    import bottle
+    import app
+    from truckstop.loader import load, location, document
+    from truckstop.search import DocumentIndex, Query, kdtree
+
+    results = {'rss_start': peak_rss()}
+    fields, source = synthetic.real_permits(DATA)
+    directory = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(directory, 'permits.csv')
+        synthetic.write(fname, fields, synthetic.permits(source, size, seed))
+        spots = list(synthetic.searches(source, searches, seed))
+
+        builds = [()] * repeat
+        results['load'] = measure(lambda: load(fname), builds)
+        spatial, text, objects = load(fname)
+    finally:
+        shutil.rmtree(directory)
+
+    rows = [objects[rowid] for rowid in objects]
+    locations = [(rowid, location(row)) for rowid, row in enumerate(rows)]
+    project = spatial.projection.project
+    projected = [(key, project(pt)) for key, pt in locations]
+    results['kdtree'] = measure(lambda: kdtree(projected), builds)
+    results['spatial_search'] = measure(spatial.search, [
+        ((lat, lon), radius) for lat, lon, radius, _ in spots])
+
+    documents = [document(rowid, row) for rowid, row in enumerate(rows)]
+    results['document_index'] = measure(lambda: DocumentIndex(documents),
+                                        builds)
+    queries = [(Query(q),) for _, _, _, q in spots if q]
+    results['document_query'] = measure(text.query, queries)
+
+    app.set_indexes(spatial, text, objects)
+
+    def api_search(qs, cached=False):
+        if not cached:
+            app.INDEXES.cache.clear()
+        bottle.request.bind({'QUERY_STRING': qs, 'REQUEST_METHOD': 'GET'})
+        return app.api_search()
+
+    qs = ['lat=%r&lon=%r&radius=%r&query=%s' % spot for spot in spots]
+    results['api_search'] = measure(api_search, [(q,) for q in qs])
+    cached = [(q, True) for q in qs]
+    for q in cached:
+        api_search(*q)
+    results['api_search_cached'] = measure(api_search, cached)
+
+    results['rss_peak'] = peak_rss()
+    return results
+
+
+def commit():
+    """The commit being benchmarked, if this is a git checkout"""
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                           cwd=ROOT, stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(before, after, threshold):
+    """[(size, benchmark, ratio)] of the benchmarks in `after` whose p50
+    is more than `threshold` times what it was in `before`"""
+    slower = []
+    for size, results in sorted(after['sizes'].iteritems(),
+                                key=lambda kv: int(kv[0])):
+        old = before['sizes'].get(size, {})
+        for name, result in sorted(results.iteritems()):
+            if not isinstance(result, dict) or name not in old:
+                continue
+            ratio = result['p50'] / max(old[name]['p50'], 1e-9)
+            if ratio > threshold:
+                slower.append((size, name, ratio))
+    return slower
+
+
+parser = OptionParser(usage="%prog [options]\n"
+                            "       %prog --compare before.json after.json")
+parser.add_option("-s", "--sizes", dest="sizes",
+                  default=','.join(map(str, SIZES)),
+                  help="comma separated numbers of permits to benchmark")
+parser.add_option("-r", "--repeat", dest="repeat", type="int",
+                  default=REPEAT, help="times to run each build")
+parser.add_option("-n", "--searches", dest="searches", type="int",
+                  default=SEARCHES, help="searches to run per size")
+parser.add_option("-o", "--output", dest="output", default=None,
+                  help="where to write the results, rather than stdout")
+parser.add_option("-c", "--compare", dest="compare", action="store_true",
+                  default=False, help="compare two sets of results")
+parser.add_option("-t", "--threshold", dest="threshold", type="float",
+                  default=1.2, help="how much slower counts as a regression")
+
+
+def main(argv=None):
+    (options, args) = parser.parse_args(argv)
+
+    if options.compare:
+        if len(args) != 2:
+            parser.print_help()
+            raise SystemExit(2)
+        before, after = [json.load(open(fname)) for fname in args]
+        slower = compare(before, after, options.threshold)
+        for size, name, ratio in slower:
+            print "%s at %s permits: %.2fx slower" % (name, size, ratio)
+        raise SystemExit(1 if slower else 0)
+
+    report = {
+        'commit': commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': options.repeat,
+        'searches': options.searches,
+        'sizes': {},
+    }
+    for size in map(int, options.sizes.split(',')):
+        print >>sys.stderr, "Benchmarking %d permits..." % size
+        # a process per size, so its peak RSS is its own
+        pool = multiprocessing.Pool(1, maxtasksperchild=1)
+        try:
+            report['sizes'][str(size)] = pool.apply(
+                benchmark, (size, options.repeat, options.searches))
+        finally:
+            pool.terminate()
+
+    out = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(out + '\n')
+    else:
+        print out
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""synthetic.py: Made up permits, as many as a benchmark needs.
+
+The real data only has a few hundred permits. To see how things hold
+up with more, each synthetic permit is a real one, picked at random,
+moved a short way from where it really is, and serving a mix of its own
+food items and another permit's. The result looks like the real data
+(the same fields, the same clustering downtown, the same vocabulary),
+just denser.
+"""
+
+import csv
+import random
+
+# roughly how far, in degrees, a copy of a permit moves from the real one
+JITTER = 0.005
+
+
+def real_permits(fname):
+    """The permits in `fname` which have a location"""
+    with open(fname) as f:
+        reader = csv.DictReader(f)
+        permits = [row for row in reader
+                   if row['Latitude'] and row['Longitude']]
+        return reader.fieldnames, permits
+
+
+def permits(source, count, seed=0):
+    """Yields `count` synthetic permits modeled on `source`"""
+    rng = random.Random(seed)
+    for i in xrange(count):
+        permit = dict(rng.choice(source))
+        other = rng.choice(source)
+        lat = float(permit['Latitude']) + rng.gauss(0, JITTER)
+        lon = float(permit['Longitude']) + rng.gauss(0, JITTER)
+        permit['ObjectID'] = str(i)
+        permit['Latitude'] = repr(lat)
+        permit['Longitude'] = repr(lon)
+        permit['Location'] = '(%r, %r)' % (lat, lon)
+        items = (permit['FoodItems'] + ':' + other['FoodItems']).split(':')
+        permit['FoodItems'] = ':'.join(
+            rng.sample(items, min(len(items), rng.randint(1, 6))))
+        yield permit
+
+
+def write(fname, fields, rows):
+    """Writes `rows` to the CSV `fname`, the way the city publishes it"""
+    with open(fname, 'wb') as f:
+        writer = csv.DictWriter(f, fields)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def searches(source, count, seed=0):
+    """Yields `count` random searches around the permits in `source`:
+    (lat, lon, radius in miles, query)"""
+    rng = random.Random(seed)
+    words = []
+    for permit in source:
+        words.extend(w for w in permit['FoodItems'].replace(':', ' ').split()
+                     if w.isalpha() and len(w) > 3)
+    for _ in xrange(count):
+        near = rng.choice(source)
+        lat = float(near['Latitude']) + rng.gauss(0, 4 * JITTER)
+        lon = float(near['Longitude']) + rng.gauss(0, 4 * JITTER)
+        radius = rng.choice((0.25, 0.5, 1, 2, 5))
+        query = ' '.join(rng.sample(words, rng.randint(0, 2)))
+        yield lat, lon, radius, query
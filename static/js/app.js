@@ -13,17 +13,25 @@ $(function() {
   var CURRENT_LOCATION_MARKER;
   var MARKERS = {};
   var MAP = L.map('map').setView(DEFAULT_POSITION, 13);
-  var RESULT_TEMPLATE = Mustache.compile('<span class="clear-button">X</span><h2>Search Results</h2>' + 
-'  {{#venues}}' +
+  var VENUES = '  {{#venues}}' +
 '<dl id="anchor-{{ObjectID}}" data-id="{{ObjectID}}">' + 
 '    <dt><span class="distance">{{ distance_desc }}</span><span class="name">{{ Applicant }}</span></dt>' +
 '    <dd><span class="address">{{ Address }}</span>' +
 '     <p><strong>Serves:</strong> {{ FoodItems }}</p>' +
 '  </dd></dl>' +
-'  {{/venues}}' +
+'  {{/venues}}';
+  var RESULT_TEMPLATE = Mustache.compile('<span class="clear-button">X</span><h2>Search Results</h2>' + 
+VENUES +
 '  {{^venues}}' +
 '   <h2>No results found!</h2>' +
-'  {{/venues}}');
+'  {{/venues}}' +
+'  {{#more}}' +
+'   <button class="more-button">Show more</button>' +
+'  {{/more}}');
+  var MORE_TEMPLATE = Mustache.compile(VENUES);
+
+  // the search the result list is showing, and its last page
+  var SEARCH, PAGE;
 
   var HIGHLIGHT_ICON = L.icon({
       iconUrl: '/static/img/active-marker-icon.png',
@@ -58,6 +66,7 @@ $(function() {
     $('#map').css({'height': '500px'});
     MAP.invalidateSize();
     $('.result-list').css({'display': 'none'});
+    SEARCH = null;
   };
 
   var getPosition = function(cb) {
@@ -82,7 +91,9 @@ $(function() {
         'query': query.query,
         'lat': CURRENT_LOCATION[0],
         'lon': CURRENT_LOCATION[1],
-        'radius': query.radius
+        'radius': query.radius,
+        'page': query.page || 1,
+        'per_page': 50
         }).done(dcb);
     if (ecb) {
       req.fail(ecb);
@@ -90,6 +101,48 @@ $(function() {
   };
 
 
+  var addMarkers = function(venues) {
+    for (var i = 0; i < venues.length; i++) {
+      var venue = venues[i];
+      MARKERS[venue['ObjectID']] = L.marker([parseFloat(venue['Latitude']), parseFloat(venue['Longitude'])]).addTo(MAP);
+      MARKERS[venue['ObjectID']].on('mouseover', (function (v) {
+        return function(e) {
+           MARKERS[v['ObjectID']].setIcon(HIGHLIGHT_ICON);
+           var off = $('#anchor-' + v['ObjectID']).offset();
+           $(window).scrollTop(off.top - 320);
+           $('#anchor-' + v['ObjectID']).addClass('hover-state');
+        }})(venue));
+      MARKERS[venue['ObjectID']].on('mouseout', (function (v) {
+        return function(e) {
+           MARKERS[v['ObjectID']].setIcon(DEFAULT_ICON);
+           $('#anchor-' + v['ObjectID']).removeClass('hover-state');
+        }})(venue));
+    }
+  };
+
+  var getSuggestions = function(prefix, dcb) {
+    return $.getJSON('/api/v1/suggest.json', {
+        'prefix': prefix,
+        'count': 5
+        }).done(dcb);
+  };
+
+  var SUGGESTION_REQUEST;
+  var showSuggestions = function(prefix) {
+    if (SUGGESTION_REQUEST) {
+      SUGGESTION_REQUEST.abort();
+    }
+    if (!$.trim(prefix) || prefix.indexOf('within:') != -1) {
+      $('#suggestions').empty();
+      return;
+    }
+    SUGGESTION_REQUEST = getSuggestions(prefix, function(results) {
+      var options = $('#suggestions').empty();
+      $.each((results.terms || []).concat(results.names || []), function(i, s) {
+        options.append($('<option>').attr('value', s));
+      });
+    });
+  };
 
   $(document).on('click', '.clear-button', function(e) {
     $('.search input').val('');
@@ -116,7 +169,10 @@ $(function() {
   });
 
   $('.search input').keyup(function(event) {
-    if (event.which == 13) {
+    if (event.which != 13) {
+      showSuggestions($('.search input').val());
+    }
+    else {
       event.preventDefault();
       resetEverything();
       var radius = 5, query = '';
@@ -135,36 +191,39 @@ $(function() {
          }
       }
 
-      getSearchResults({'query': query, 'radius': radius}, function(results) {
+      SEARCH = {'query': query, 'radius': radius};
+      PAGE = 1;
+      getSearchResults(SEARCH, function(results) {
         if (results.venues) {
-          // render a template to put in the result-list.innerHTML
-          for (var i = 0; i < results.venues.length; i++) {
-            var venue = results.venues[i];
-            MARKERS[venue['ObjectID']] = L.marker([parseFloat(venue['Latitude']), parseFloat(venue['Longitude'])]).addTo(MAP);
-            MARKERS[venue['ObjectID']].on('mouseover', (function (v) {
-              return function(e) {
-                 MARKERS[v['ObjectID']].setIcon(HIGHLIGHT_ICON);
-                 var off = $('#anchor-' + v['ObjectID']).offset();
-                 $(window).scrollTop(off.top - 320);
-                 $('#anchor-' + v['ObjectID']).addClass('hover-state');
-              }})(venue));
-            MARKERS[venue['ObjectID']].on('mouseout', (function (v) {
-              return function(e) {
-                 MARKERS[v['ObjectID']].setIcon(DEFAULT_ICON);
-                 $('#anchor-' + v['ObjectID']).removeClass('hover-state');
-              }})(venue));
-
-          }
-
+          addMarkers(results.venues);
           $('#map').css({'height': '300px'});
           MAP.invalidateSize();
-          $('.result-list').css({'display': 'block'}).html(RESULT_TEMPLATE({ 'venues': results.venues }));
+          // render a template to put in the result-list.innerHTML
+          $('.result-list').css({'display': 'block'}).html(RESULT_TEMPLATE(results));
         }
       });
     }
 
   });
 
+  // results come 50 at a time; the rest are a click away
+  $(document).on('click', '.more-button', function(e) {
+    var search = SEARCH, button = $(this).prop('disabled', true);
+    getSearchResults($.extend({'page': PAGE + 1}, search), function(results) {
+      if (search !== SEARCH || !results.venues) {
+        return;
+      }
+      PAGE += 1;
+      addMarkers(results.venues);
+      button.before(MORE_TEMPLATE(results)).prop('disabled', false);
+      if (!results.more) {
+        button.remove();
+      }
+    }, function() {
+      button.prop('disabled', false);
+    });
+  });
+
 
   $(document).on('mouseover', '.result-list dl', function(event) {
     $(this).addClass('hover-state');
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+
+from cStringIO import StringIO
+from wsgiref.util import setup_testing_defaults
+
+import app
+import bottle
+
+from benchmarks import synthetic
+from truckstop import loader
+from truckstop.reloader import Reloader
+
+
+DATA = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'data', 'Mobile_Food_Facility_Permit.csv')
+
+INDEXES = []
+
+
+def indexes():
+    if not INDEXES:
+        INDEXES.append(app.Indexes(*loader.load(DATA, processes=1)))
+    return INDEXES[0]
+
+
+class TestSearchBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.indexes = app.INDEXES
+        app.swap_indexes(indexes())
+
+    def tearDown(self):
+        app.swap_indexes(self.indexes)
+
+    def post(self, body):
+        body = json.dumps(body)
+        environ = {'REQUEST_METHOD': 'POST',
+                   'PATH_INFO': '/api/v1/search_batch.json',
+                   'CONTENT_TYPE': 'application/json',
+                   'CONTENT_LENGTH': str(len(body)),
+                   'wsgi.input': StringIO(body)}
+        setup_testing_defaults(environ)
+        status = []
+        out = bottle.default_app()(environ,
+                                   lambda s, headers, *_: status.append(s))
+        return status[0], json.loads(''.join(out))
+
+    def search(self, **params):
+        params['searches'] = [{'lat': 37.7841, 'lon': -122.3957,
+                               'radius': 1, 'query': 'tacos'}]
+        return self.post(params)
+
+    def test_fields(self):
+        status, body = self.search(fields='Applicant,distance')
+        self.assertEquals(status, '200 OK')
+        venues = body['results'][0]['venues']
+        self.assertTrue(venues)
+        for v in venues:
+            self.assertEquals(sorted(v), ['Applicant', 'distance'])
+
+        for fields in (u'Applicant,Caf\xe9', 'Applicant,Nope'):
+            status, body = self.search(fields=fields)
+            self.assertEquals(status, '200 OK',
+                              "Bad fields are an error, not a crash")
+            self.assertTrue(body['error'].startswith('Unknown fields'))
+        self.assertEquals(self.search(fields=['Applicant'])[1],
+                          {'error': 'Invalid fields'})
+
+    def test_errors(self):
+        self.assertTrue('error' in self.post({'searches': 'tacos'})[1])
+        status, body = self.post({'searches': [{'lat': 'x', 'lon': 1},
+                                               {'lat': 37.78, 'lon': -122.4}]})
+        self.assertEquals(body['results'][0], {'error': 'Invalid Latitude'})
+        self.assertTrue('venues' in body['results'][1])
+
+
+class TestReload(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.fname = os.path.join(self.directory, 'permits.csv')
+        self.fields, self.source = synthetic.real_permits(DATA)
+        self.write(100)
+        self.cpu_count = multiprocessing.cpu_count
+        # the default of a loader process per core, on a machine with a
+        # few of them
+        multiprocessing.cpu_count = lambda: 3
+
+    def tearDown(self):
+        multiprocessing.cpu_count = self.cpu_count
+        shutil.rmtree(self.directory)
+
+    def write(self, n):
+        # written alongside and renamed into place, as it would be
+        synthetic.write(self.fname + '.new', self.fields,
+                        synthetic.permits(self.source, n, 5))
+        os.rename(self.fname + '.new', self.fname)
+
+    def test_reload(self):
+        swapped = []
+        reloader = Reloader(self.fname, app.rebuild_indexes, swapped.append)
+        self.write(200)
+        os.utime(self.fname, (1, 1))
+        reloader.check()
+        self.assertTrue(reloader.check(),
+                        "Reloading off the loop doesn't fork loaders")
+        self.assertEquals(len(swapped[0].objects), 200)
@@ -0,0 +1,140 @@
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+from cStringIO import StringIO
+
+from truckstop import assets
+from truckstop.assets import Assets
+
+
+SCRIPT = 'var truck = "tacos";\n' * 200
+
+
+def gunzip(data):
+    return gzip.GzipFile(fileobj=StringIO(data)).read()
+
+
+class TestAssets(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.directory, 'js'))
+        os.mkdir(os.path.join(self.directory, 'img'))
+        self.write('js/app.js', SCRIPT)
+        self.write('img/marker.png', '\x89PNG\r\n\x1a\n' + 'x' * 500)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, contents):
+        with open(os.path.join(self.directory, name), 'wb') as f:
+            f.write(contents)
+
+    def test_fingerprints(self):
+        static = Assets(self.directory)
+        self.assertEquals(len(static), 2)
+        url = static.url('js/app.js')
+        self.assertTrue(url.startswith('/static/js/app.') and
+                        url.endswith('.js') and url != '/static/js/app.js')
+        self.assertEquals(static.url('js/nope.js'), '/static/js/nope.js')
+
+        status, headers, body = static.response(url[len('/static/'):])
+        self.assertEquals((status, body), (200, SCRIPT))
+        self.assertEquals(headers['Cache-Control'], assets.IMMUTABLE,
+                          "Fingerprinted URLs never change")
+        status, headers, _ = static.response('js/app.js')
+        self.assertEquals(headers['Cache-Control'], assets.REVALIDATE)
+        status, headers, _ = static.response('js/app.000000000000.js')
+        self.assertEquals((status, headers['Cache-Control']),
+                          (200, assets.REVALIDATE),
+                          "A stale fingerprint gets the current file, "
+                          "but it has to be revalidated")
+        self.assertEquals(static.response('js/nope.js')[0], 404)
+
+        self.write('js/app.js', SCRIPT + '\n')
+        self.assertNotEquals(Assets(self.directory).url('js/app.js'), url,
+                             "Changing a file changes its URL")
+
+    def test_encodings(self):
+        static = Assets(self.directory)
+        status, headers, body = static.response('js/app.js', 'gzip, deflate')
+        self.assertEquals(headers['Content-Encoding'], 'gzip')
+        self.assertEquals(headers['Vary'], 'Accept-Encoding')
+        self.assertEquals(int(headers['Content-Length']), len(body))
+        self.assertEquals(gunzip(body), SCRIPT)
+
+        for accept in (None, '', 'gzip;q=0', 'deflate'):
+            _, headers, body = static.response('js/app.js', accept)
+            self.assertFalse('Content-Encoding' in headers)
+            self.assertEquals(body, SCRIPT)
+        _, headers, _ = static.response('js/app.js', '*')
+        self.assertTrue('Content-Encoding' in headers)
+
+        _, headers, body = static.response('img/marker.png', 'gzip')
+        self.assertFalse('Content-Encoding' in headers or 'Vary' in headers,
+                         "Images aren't compressed again")
+        self.assertEquals(headers['Content-Type'], 'image/png')
+
+        _, headers, body = static.response('js/app.js', 'gzip', head=True)
+        self.assertEquals((int(headers['Content-Length']), body),
+                          (len(static.get('js/app.js').copies['gzip'][0]),
+                           ''))
+
+    def test_etags(self):
+        static = Assets(self.directory)
+        _, plain, _ = static.response('js/app.js')
+        _, gzipped, _ = static.response('js/app.js', 'gzip')
+        self.assertNotEquals(plain['ETag'], gzipped['ETag'],
+                             "Each encoding has its own strong ETag")
+
+        status, headers, body = static.response(
+            'js/app.js', 'gzip', 'W/"x", %s' % gzipped['ETag'])
+        self.assertEquals((status, body), (304, ''))
+        self.assertEquals(headers['ETag'], gzipped['ETag'])
+        self.assertEquals(static.response('js/app.js', None,
+                                          gzipped['ETag'])[0], 200)
+
+    def test_build(self):
+        built = dict(assets.build(self.directory))
+        self.assertEquals(sorted(built), ['img/marker.png', 'js/app.js'])
+        fname = os.path.join(self.directory, 'js', 'app.js')
+        self.assertTrue(os.path.exists(fname + '.gz'))
+        self.assertFalse(os.path.exists(
+            os.path.join(self.directory, 'img', 'marker.png.gz')))
+
+        # a built copy is what gets served, as long as it's up to date
+        self.write('js/app.js.gz', assets.gzip_compress('built', 9))
+        static = Assets(self.directory)
+        self.assertEquals(len(static), 2, "Built copies aren't assets")
+        self.assertEquals(built['js/app.js'],
+                          static.get('js/app.js').url_name)
+        self.assertEquals(gunzip(static.response('js/app.js', 'gzip')[2]),
+                          'built')
+
+        os.utime(fname + '.gz', (0, 0))
+        static = Assets(self.directory)
+        self.assertEquals(gunzip(static.response('js/app.js', 'gzip')[2]),
+                          SCRIPT, "Stale copies are ignored")
+
+    def test_watch(self):
+        static = Assets(self.directory, watch=True)
+        url = static.url('js/app.js')
+        self.write('js/app.js', 'changed')
+        os.utime(os.path.join(self.directory, 'js', 'app.js'), (1, 1))
+        self.assertNotEquals(static.url('js/app.js'), url)
+        self.assertEquals(static.response('js/app.js')[2], 'changed')
+
+        os.remove(os.path.join(self.directory, 'img', 'marker.png'))
+        self.assertEquals(static.response('img/marker.png')[0], 404)
+
+        self.write('js/new.js', 'new')
+        self.assertEquals(static.response('js/new.js')[2], 'new')
+        outside = os.path.basename(self.directory)
+        for path in ('../%s/js/app.js' % outside, 'img/../../%s/js/app.js'
+                     % outside, 'js/../js/app.js', '/etc/passwd'):
+            self.assertEquals(static.response(path)[0], 404,
+                              "Nothing outside the directory is served, "
+                              "like %s" % path)
@@ -0,0 +1,71 @@
+import unittest
+
+from truckstop.cache import QueryCache
+from truckstop.search import Query
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestQueryCache(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.cache = QueryCache(capacity=2, ttl=60, clock=self.clock)
+
+    def test_key(self):
+        key = self.cache.key
+        self.assertEquals(key((37.7749, -122.4194), 1, Query("Tacos!")),
+                          key((37.77491, -122.41941), 1, Query("tacos")),
+                          "Nearby searches for the same terms share a key")
+        self.assertNotEquals(key((37.7749, -122.4194), 1, Query("tacos")),
+                             key((37.7849, -122.4194), 1, Query("tacos")))
+        self.assertNotEquals(key((37.7749, -122.4194), 1, Query("tacos")),
+                             key((37.7749, -122.4194), 2, Query("tacos")))
+        self.assertNotEquals(key((37.7749, -122.4194), 1, Query("tacos")),
+                             key((37.7749, -122.4194), 1, None))
+
+        approved = {'Status': ['APPROVED', 'REQUESTED']}
+        self.assertEquals(key((37.7749, -122.4194), 1, None, approved),
+                          key((37.7749, -122.4194), 1, None,
+                              {'Status': ['REQUESTED', 'APPROVED']}),
+                          "Filter values are in no particular order")
+        self.assertNotEquals(key((37.7749, -122.4194), 1, None, approved),
+                             key((37.7749, -122.4194), 1, None))
+        self.assertEquals(key((37.7749, -122.4194), 1, None, {}),
+                          key((37.7749, -122.4194), 1, None))
+
+    def test_get(self):
+        results = [(0.1, 1), (0.2, 2), (0.3, 3)]
+        self.cache.put('full', 3, results, (0, 0), None)
+        self.cache.put('short', 5, results, (0, 0), None)
+
+        self.assertEquals(self.cache.get('full', 2)[0], results,
+                          "An entry answers searches for fewer results")
+        self.assertEquals(self.cache.get('full', 4), None,
+                          "but not for more")
+        self.assertEquals(self.cache.get('short', 50)[0], results,
+                          "unless it has all of them")
+        self.assertEquals((self.cache.hits, self.cache.misses), (2, 1))
+
+        self.clock.now = 61
+        self.assertEquals(self.cache.get('full', 1), None,
+                          "Entries expire")
+
+    def test_lru(self):
+        self.cache.put('a', 1, [], (0, 0), None)
+        self.cache.put('b', 1, [], (0, 0), None)
+        self.cache.get('a')
+        self.cache.put('c', 1, [], (0, 0), None)
+        self.assertTrue(self.cache.get('b') is None,
+                        "The least recently used entry is evicted")
+        self.assertTrue(self.cache.get('a') is not None)
+
+        self.cache.clear()
+        self.assertEquals(len(self.cache), 0)
@@ -1,5 +1,9 @@
+import random
 import unittest
-from truckstop.search import Document, DocumentIndex, Query, mk_tfidf_dot
+from bisect import bisect_left
+
+from truckstop.search import Document, DocumentIndex, Query, \
+    PrefixIndex, Analyzer, Postings, mk_tfidf_dot, term_suggestions
 
 from bane_lyrics import holding_this_moment
 
@@ -39,6 +43,39 @@ class TestDocumentFrequencies(unittest.TestCase):
 
 
         
+class TestAnalyzer(unittest.TestCase):
+
+    def test_terms(self):
+        analyzer = Analyzer(memo_size=4)
+        terms = analyzer.terms("Cupcakes and a cupcake, with TEA")
+        self.assertEquals(len(terms), 3, "Stop words are dropped")
+        self.assertEquals(terms[0], terms[1],
+                          "Words sharing a stem share a term id")
+        self.assertEquals(map(analyzer.term, terms),
+                          ['cupcak', 'cupcak', 'tea'])
+        self.assertEquals(len(analyzer), 2)
+
+        self.assertEquals(analyzer.terms("teas pho", intern=False),
+                          [terms[2], 'pho'],
+                          "Queries leave unknown stems alone")
+        self.assertEquals(len(analyzer), 2)
+        self.assertEquals(analyzer.lookup('Pho'), None)
+
+        for word in ('tacos', 'burritos', 'tortas', 'sopes', 'elotes'):
+            analyzer.stem(word)
+        self.assertTrue(len(analyzer._memo) <= 4, "The memo is bounded")
+        self.assertEquals(analyzer.lookup('TEAS'), terms[2])
+
+    def test_shared(self):
+        analyzer = Analyzer()
+        doc = Document('doc', "Chocolate cupcakes", analyzer)
+        index = DocumentIndex([doc], analyzer)
+        self.assertEquals(index.doc_freq('cupcake'), 1)
+        query = Query("cupcake sprinkles", analyzer)
+        self.assertEquals(query.terms(), ['cupcak', 'sprinkl'])
+        self.assertEquals([key for _, key in index.query(query)], ['doc'])
+
+
 class TestIndex(unittest.TestCase):
     
     def setUp(self):
@@ -91,3 +128,144 @@ class TestIndex(unittest.TestCase):
         self.assertEquals(hardcoreResults[0][1], 'Every Effort Made',
                           "Every Effort Made is the best result")
         
+
+    def test_updates(self):
+        songs = holding_this_moment
+        index = DocumentIndex(songs[:3])
+        for song in songs[3:]:
+            index.add(song)
+        index.remove(songs[1])
+        rebuilt = DocumentIndex([songs[0]] + songs[2:])
+
+        self.assertEquals(len(index), len(rebuilt))
+        self.assertEquals(index.doc_freq("life"), rebuilt.doc_freq("life"))
+        for query in (self.lifeQuery, self.hardcoreQuery,
+                      Query("life know hand words eyes")):
+            self.assertEquals(sorted(index.query(query, max_results=100)),
+                              sorted(rebuilt.query(query, max_results=100)),
+                              "Updates find what a rebuild does")
+        self.assertEquals(index.remove(songs[1]), 0,
+                          "Removing twice removes nothing")
+
+    def test_top_results(self):
+        everything = self.index.query(self.lifeQuery, max_results=100)
+        for k in range(len(everything) + 1):
+            self.assertEquals(self.index.query(self.lifeQuery,
+                                               max_results=k),
+                              everything[:k],
+                              "The best %d results are the first %d "
+                              "of all of them" % (k, k))
+
+        broadQuery = Query("life know hand words eyes")
+        everything = self.index.query(broadQuery, max_results=100)
+        self.index.MAXSCORE_POSTINGS = 0
+        self.assertEquals(self.index.query(broadQuery, max_results=100),
+                          everything, "Walking postings a document at a "
+                          "time gives the same results")
+        self.assertEquals(self.index.query(broadQuery, max_results=3),
+                          everything[:3],
+                          "Skipping terms doesn't change the top 3")
+
+
+class TestPostings(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(22)
+        # mostly dense, with a few long gaps
+        self.docs, i = [], 0
+        for _ in range(1000):
+            i += random.choice((1, 1, 2, 3, 300, 70000))
+            self.docs.append(i)
+        self.freqs = [random.randint(1, 3) for _ in self.docs]
+        self.postings = Postings.encode(self.docs, self.freqs)
+
+    def test_encode(self):
+        postings = self.postings
+        self.assertEquals(len(postings), len(self.docs))
+        self.assertEquals(postings.docs(), self.docs)
+        self.assertEquals(list(postings.items()),
+                          zip(self.docs, self.freqs))
+        self.assertEquals(postings.freqs.typecode, 'B')
+        self.assertEquals(map(postings.doc, range(len(self.docs))),
+                          self.docs)
+
+    def test_seek(self):
+        postings, docs = self.postings, self.docs
+        for _ in range(500):
+            i = random.randint(0, docs[-1] + 1)
+            lo = random.randint(0, len(docs))
+            hi = random.randint(lo, len(docs))
+            self.assertEquals(postings.seek(i, lo, hi),
+                              bisect_left(docs, i, lo, hi),
+                              "Seeking %d in [%d, %d)" % (i, lo, hi))
+        self.assertEquals(postings.find(docs[500]), 500)
+        missing = min(set(range(docs[-1])) - set(docs))
+        self.assertEquals(postings.find(missing), None)
+
+    def test_updates(self):
+        postings = Postings()
+        for i, f in zip(self.docs, self.freqs):
+            postings.append(i, f)
+        postings.append(self.docs[-1] + 1, 1000)
+        self.assertEquals(postings.docs(), self.docs + [self.docs[-1] + 1])
+        self.assertEquals(postings.freqs[-1], 1000,
+                          "The frequencies widen to fit")
+
+        for i in self.docs[::3]:
+            self.assertTrue(postings.remove(i))
+        self.assertFalse(postings.remove(self.docs[0]))
+        self.assertEquals(postings.docs(),
+                          [i for p, i in enumerate(self.docs) if p % 3] +
+                          [self.docs[-1] + 1])
+
+    def test_scores(self):
+        words = ['taco', 'burrito', 'hot', 'dog', 'cupcake', 'tea', 'pho']
+        documents = [Document(i, ' '.join(random.sample(
+            words, random.randint(1, 4)) * random.randint(1, 2)))
+                     for i in range(2000)]
+        index = DocumentIndex(documents)
+        query = Query("taco tea pho")
+        everything = index.query(query, max_results=50)
+        index.MAXSCORE_POSTINGS = 0
+        self.assertEquals(index.query(query, max_results=50), everything,
+                          "Walking many blocks a document at a time gives "
+                          "the same results")
+
+
+class TestPrefixIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.names = PrefixIndex({'Cupkates': 3, 'Curry Up Now': 5,
+                                  'Cheese Gone Wild': 1, 'Kettle Corn': 2})
+
+    def test_suggest(self):
+        self.assertEquals(self.names.suggest('cu'),
+                          ['Curry Up Now', 'Cupkates'],
+                          "Suggestions start with the prefix, "
+                          "heaviest first")
+        self.assertEquals(self.names.suggest('C', 2),
+                          ['Curry Up Now', 'Cupkates'])
+        self.assertEquals(self.names.suggest('pizza'), [])
+
+    def test_precomputed(self):
+        words = dict(('%s%d' % (c, i), i) for c in 'abc' for i in range(50))
+        class Eager(PrefixIndex):
+            SCAN_LIMIT = 10
+
+        precomputed = Eager(words)
+        scanned = PrefixIndex(words)
+
+        self.assertTrue('a' in precomputed._precomputed)
+        for prefix in ('', 'a', 'b4', 'c1', 'c10', 'd'):
+            self.assertEquals(precomputed.suggest(prefix),
+                              scanned.suggest(prefix),
+                              "Precomputed suggestions for %r are what "
+                              "a scan finds" % prefix)
+
+    def test_terms(self):
+        index = DocumentIndex(holding_this_moment)
+        texts = ["Lessons, a lesson", "life's lessons", "Rubberband"]
+        terms = term_suggestions(index, texts)
+        self.assertEquals(terms.suggest('les'), ['lessons'],
+                          "Words are suggested once per stem")
+        self.assertEquals(terms.suggest('rub'), ['rubberband'])
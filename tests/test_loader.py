@@ -0,0 +1,128 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from collections import Counter
+
+from benchmarks import synthetic
+from truckstop import loader, snapshot
+from truckstop.search import DocumentIndex, Query, term_suggestions
+
+
+DATA = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'data', 'Mobile_Food_Facility_Permit.csv')
+
+
+class TestLoader(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.fname = os.path.join(self.directory, 'permits.csv')
+        self.fields, self.source = synthetic.real_permits(DATA)
+        rows = list(synthetic.permits(self.source, 500, 23))
+        rows[7]['Latitude'] = ''
+        rows[8]['Longitude'] = 'east-ish'
+        synthetic.write(self.fname, self.fields, rows)
+
+        self.chunk_rows = loader.CHUNK_ROWS
+        loader.CHUNK_ROWS = 64
+
+    def tearDown(self):
+        loader.CHUNK_ROWS = self.chunk_rows
+        shutil.rmtree(self.directory)
+
+    def test_load(self):
+        counters = Counter()
+        spatial, text, objects = loader.load(self.fname, processes=1,
+                                             counters=counters)
+        self.assertEquals(counters, Counter({
+            'rows': 500, 'indexed': 498, 'skipped.no_location': 1,
+            'skipped.bad_location': 1}))
+        self.assertEquals(len(objects), 498)
+        self.assertEquals(len(spatial), 498)
+
+        documents = [loader.document(rowid, objects[rowid])
+                     for rowid in objects]
+        rebuilt = DocumentIndex(documents)
+        for _, _, _, q in synthetic.searches(self.source, 50, 23):
+            self.assertEquals(text.query(Query(q), max_results=20),
+                              rebuilt.query(Query(q), max_results=20),
+                              "Chunked postings find what a build from "
+                              "whole documents does, for %r" % q)
+
+    def test_processes(self):
+        serial = loader.load(self.fname, processes=1)
+        counters = Counter()
+        spatial, text, objects = loader.load(self.fname, processes=3,
+                                             counters=counters)
+        self.assertEquals(counters['indexed'], 498)
+        for lat, lon, radius, q in synthetic.searches(self.source, 50, 23):
+            self.assertEquals(spatial.search((lat, lon), radius),
+                              serial[0].search((lat, lon), radius))
+            self.assertEquals(text.query(Query(q), max_results=20),
+                              serial[1].query(Query(q), max_results=20),
+                              "Merging the partial indexes of several "
+                              "processes changes nothing, for %r" % q)
+
+    def test_suggestions(self):
+        spatial, text, objects = loader.load(self.fname, processes=2)
+        texts = [loader.permit_text(objects[rowid]) for rowid in objects]
+        rebuilt = DocumentIndex([loader.document(rowid, objects[rowid])
+                                 for rowid in objects])
+        expected = term_suggestions(rebuilt, texts)
+
+        fname = os.path.join(self.directory, 'permits.snapshot')
+        snapshot.save(fname, spatial, text, objects)
+        _, restored, _ = snapshot.load(fname)
+        for index in (text, restored):
+            terms = term_suggestions(index)
+            for prefix in 'abcdefghijklmnopqrstuvwxyz':
+                self.assertEquals(terms.suggest(prefix, 20),
+                                  expected.suggest(prefix, 20),
+                                  "The loader works out what to suggest "
+                                  "without going over the text again")
+
+    def test_changes(self):
+        spatial, text, objects = loader.load(self.fname, processes=1)
+
+        def found(q, pt=(37.7, -122.3)):
+            keys = set(k for _, k in text.query(Query(q), max_results=10))
+            near = set(k for _, k in spatial.search(pt, 0.1))
+            return keys, near
+
+        spot = dict(objects[0].copy(), Applicant='Zyzzyva Tacos',
+                    Latitude='37.7', Longitude='-122.3')
+        key = loader.add(spatial, text, objects, spot)
+        self.assertEquals(found('zyzzyva'), (set([key]), set([key])))
+        self.assertEquals(loader.add(spatial, text, objects,
+                                     dict(spot, Latitude='')), None,
+                          "Permits without a location aren't added")
+
+        loader.update(spatial, text, objects, key, {'Status': 'EXPIRED'})
+        self.assertEquals(objects[key]['Status'], 'EXPIRED')
+        loader.update(spatial, text, objects, key,
+                      {'Applicant': 'Quokka Tacos', 'Latitude': '37.71'})
+        self.assertEquals(found('zyzzyva'), (set(), set()))
+        self.assertEquals(found('quokka', (37.71, -122.3)),
+                          (set([key]), set([key])))
+
+        for changes in ({'Latitude': 'north-ish', 'Applicant': 'Wombat'},
+                        {'Longitude': ''}):
+            self.assertRaises(ValueError, loader.update, spatial, text,
+                              objects, key, changes)
+        self.assertRaises(KeyError, loader.update, spatial, text, objects,
+                          key, {'Applicant': 'Wombat', 'Nope': 1})
+        self.assertEquals((objects[key]['Applicant'],
+                           objects[key]['Latitude']),
+                          ('Quokka Tacos', '37.71'),
+                          "A bad change changes nothing")
+        self.assertEquals(found('quokka', (37.71, -122.3)),
+                          (set([key]), set([key])))
+
+        loader.remove(spatial, text, objects, key)
+        self.assertEquals(found('quokka', (37.71, -122.3)), (set(), set()))
+        self.assertRaises(KeyError, loader.update, spatial, text, objects,
+                          key, {'Applicant': 'Quokka Tacos again'})
+        self.assertEquals(found('quokka', (37.71, -122.3)), (set(), set()),
+                          "Removed permits stay removed")
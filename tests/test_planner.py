@@ -0,0 +1,120 @@
+import random
+import unittest
+
+from truckstop.search import SpatialIndex, DocumentIndex, Document, Query, \
+    QueryPlanner, TextFirst, SpatialFirst, RangeScan, NearestScan
+
+from test_spatial import SCENARIO_2
+
+
+MENUS = {
+    'A': "Tacos and burritos",
+    'B': "Cupcakes",
+    'C': "Tacos, hot dogs",
+    'D': "Burritos, tacos",
+    'E': "Hot dogs and sodas",
+    'F': "Tacos",
+}
+
+
+class TestQueryPlanner(unittest.TestCase):
+
+    def setUp(self):
+        self.spatial = SpatialIndex(SCENARIO_2, magnitude=1)
+        self.text = DocumentIndex([Document(k, v)
+                                   for k, v in sorted(MENUS.items())])
+        self.planner = QueryPlanner(self.spatial, self.text)
+
+    def test_strategies(self):
+        self.assertTrue(isinstance(self.planner.plan((0, 0), 7),
+                                   RangeScan))
+        self.assertTrue(isinstance(self.planner.plan((0, 0), 7,
+                                                     max_results=2),
+                                   NearestScan))
+
+        rare = self.planner.plan((0, 0), 100, Query("cupcakes"))
+        self.assertTrue(isinstance(rare, TextFirst),
+                        "A rare term over a wide radius drives from the "
+                        "postings: %s" % rare.explain())
+
+        common = self.planner.plan((2, 3), 0.5, Query("tacos"))
+        self.assertTrue(isinstance(common, SpatialFirst),
+                        "A common term in a tiny radius drives from the "
+                        "spatial index: %s" % common.explain())
+
+    def test_execute(self):
+        for within in (1, 5, 7, 100):
+            for query in ("tacos", "hot dogs", "burritos cupcakes"):
+                args = (self.spatial, self.text, (0, 0), within)
+                textFirst = TextFirst(*args, query=Query(query),
+                                      max_results=10).execute()
+                spatialFirst = SpatialFirst(*args, query=Query(query),
+                                            max_results=10).execute()
+                self.assertEquals(textFirst, spatialFirst,
+                                  "Both plans find the same venues")
+
+        found = self.planner.plan((0, 0), 7, Query("tacos")).execute()
+        self.assertEquals('A', ''.join(map(lambda x: x[1], found)),
+                          "Only A serves tacos within 7")
+
+        found = self.planner.plan((0, 0), 100, Query("burritos tacos"),
+                                  max_results=2).execute()
+        self.assertEquals('AD', ''.join(map(lambda x: x[1], found)),
+                          "A and D serve both, and they come first")
+
+    def test_execute_many(self):
+        searches = [((0, 0), within, query and Query(query))
+                    for within in (1, 7, 100)
+                    for query in (None, "tacos", "cupcakes", "hot dogs")]
+        for max_results in (None, 2):
+            batch = self.planner.execute_many(searches, max_results)
+            for (pt, within, query), (plan, found) in zip(searches, batch):
+                alone = self.planner.plan(pt, within, query, max_results)
+                self.assertEquals(found, alone.execute(),
+                                  "A batch finds what %s does alone" %
+                                  alone.explain())
+
+    def test_sample(self):
+        rng = random.Random(18)
+        for query in ("tacos", "cupcakes", "hot dogs"):
+            for within in (1, 7, 100):
+                expected = set(k for _, k in self.planner.plan(
+                    (0, 0), within, Query(query)).execute())
+                found = self.planner.sample((0, 0), within, Query(query),
+                                            count=10, rng=rng)
+                self.assertEquals(set(k for _, k in found), expected,
+                                  "Only %r within %g" % (query, within))
+
+        found = self.planner.sample((0, 0), 100, count=10,
+                                    allowed=set('ABC'), rng=rng)
+        self.assertEquals(sorted(k for _, k in found), ['A', 'B', 'C'])
+
+    def test_filtered(self):
+        allowed = set('ABDF')
+        for within in (1, 7, 100):
+            for query in (None, "tacos", "hot dogs", "burritos cupcakes"):
+                query = query and Query(query)
+                everything = self.planner.plan((0, 0), within, query,
+                                               max_results=None)
+                expected = [f for f in everything.execute()
+                            if f[1] in allowed]
+                for max_results in (None, 2):
+                    plan = self.planner.plan((0, 0), within, query,
+                                             max_results, allowed)
+                    self.assertEquals(plan.execute(),
+                                      expected[:max_results],
+                                      "%s only finds what's allowed" %
+                                      plan.explain())
+                    args = (self.spatial, self.text, (0, 0), within)
+                    if query is not None:
+                        self.assertEquals(
+                            TextFirst(*args, query=query, allowed=allowed,
+                                      max_results=10).execute(),
+                            SpatialFirst(*args, query=query, allowed=allowed,
+                                         max_results=10).execute())
+
+        batch = self.planner.execute_many([((0, 0), 100, None),
+                                           ((0, 0), 100, Query("tacos"))],
+                                          allowed=set('BE'))
+        self.assertEquals([[k for _, k in found] for _, found in batch],
+                          [['B', 'E'], []])
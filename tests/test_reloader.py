@@ -0,0 +1,47 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from truckstop.reloader import Reloader
+
+
+class TestReloader(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.fname = os.path.join(self.directory, 'data.csv')
+        self.write('first')
+        self.swapped = []
+        self.reloader = Reloader(self.fname, lambda f: open(f).read(),
+                                 self.swapped.append)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, contents):
+        # written alongside and renamed into place, as it would be
+        with open(self.fname + '.new', 'w') as f:
+            f.write(contents)
+        os.rename(self.fname + '.new', self.fname)
+
+    def test_check(self):
+        self.assertFalse(self.reloader.check(),
+                         "Nothing happens until the file changes")
+
+        self.write('second')
+        self.assertFalse(self.reloader.check(),
+                         "A change has to settle for a check first")
+        self.assertTrue(self.reloader.check())
+        self.assertEquals(self.swapped, ['second'])
+
+        self.assertFalse(self.reloader.check(),
+                         "The same file is only loaded once")
+        self.assertEquals(self.reloader.reloads, 1)
+
+    def test_missing(self):
+        os.unlink(self.fname)
+        self.assertFalse(self.reloader.check(),
+                         "A missing file leaves things as they are")
+        self.assertFalse(self.reloader.check())
+        self.assertEquals(self.swapped, [])
@@ -0,0 +1,99 @@
+import os
+import random
+import shutil
+import tempfile
+import time
+import unittest
+
+from truckstop.schedule import Schedule, MINUTES_PER_DAY, parse_weekday, \
+    parse_time, parse_moment
+from truckstop.loader import load_schedule
+from truckstop.store import ObjectStore
+
+
+def is_open(intervals, rowid, weekday, minute):
+    """The slow way: goes through every interval"""
+    for r, day, opens, closes in intervals:
+        if r != rowid:
+            continue
+        if closes > opens:
+            if day == weekday and opens <= minute < closes:
+                return True
+        elif (day == weekday and minute >= opens) or \
+                ((day + 1) % 7 == weekday and minute < closes):
+            return True
+    return False
+
+
+class TestSchedule(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEquals(map(parse_weekday, ['Monday', 'tue', 'Su']),
+                          [0, 1, 6])
+        self.assertRaises(ValueError, parse_weekday, 'T')
+        self.assertRaises(ValueError, parse_weekday, 'Blursday')
+
+        self.assertEquals(map(parse_time, ['14:30', '9', '2:30PM', '12am',
+                                           '12pm', '24:00']),
+                          [870, 540, 870, 0, 720, MINUTES_PER_DAY])
+        for bad in ('25:00', '10:60', '13pm', 'noon', ''):
+            self.assertRaises(ValueError, parse_time, bad)
+
+        # Wednesday, 10:15
+        now = time.struct_time((2013, 3, 13, 10, 15, 0, 2, 72, 0))
+        self.assertEquals(parse_moment('now', now), (2, 615))
+        self.assertEquals(parse_moment('11:00', now), (2, 660))
+        self.assertEquals(parse_moment('Fri 2pm', now), (4, 840))
+        self.assertRaises(ValueError, parse_moment, 'Fri 24:00', now)
+
+    def test_open_at(self):
+        random.seed(17)
+        intervals = []
+        for rowid in range(50):
+            for _ in range(random.randint(0, 4)):
+                opens = random.randrange(0, MINUTES_PER_DAY, 15)
+                closes = random.randrange(0, MINUTES_PER_DAY, 15)
+                intervals.append((rowid, random.randrange(7), opens, closes))
+        schedule = Schedule(50, intervals)
+        self.assertEquals(len(schedule), len(intervals))
+
+        for weekday in range(7):
+            for minute in range(0, MINUTES_PER_DAY, 10):
+                self.assertEquals(
+                    list(schedule.open_at(weekday, minute)),
+                    [r for r in range(50)
+                     if is_open(intervals, r, weekday, minute)],
+                    "What's open at %d on day %d" % (minute, weekday))
+
+    def test_segment(self):
+        schedule = Schedule(2, [(0, 0, 600, 720), (1, 6, 1320, 120)])
+        self.assertEquals(schedule.segment(0, 610), schedule.segment(0, 700),
+                          "Nothing opens or closes between 10:10 and 11:40")
+        self.assertNotEquals(schedule.segment(0, 610),
+                             schedule.segment(0, 730))
+        self.assertEquals(list(schedule.open_at(0, 60)), [1],
+                          "Open past midnight, into Monday")
+        self.assertEquals(list(schedule.open_at(0, 120)), [])
+
+    def test_load(self):
+        directory = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(directory, 'schedule.csv')
+            with open(fname, 'w') as f:
+                f.write("locationid,DayOfWeekStr,start24,end24\n"
+                        "101,Monday,10:00,14:00\n"
+                        "102,Monday,22:00,02:00\n"
+                        "999,Monday,10:00,14:00\n"
+                        "101,Someday,10:00,14:00\n")
+            objects = ObjectStore(['ObjectID'])
+            for oid in ('101', '102'):
+                objects.append({'ObjectID': oid})
+
+            schedule = load_schedule(fname, objects)
+            self.assertEquals(len(schedule), 2,
+                              "Rows for unknown permits or weekdays "
+                              "are skipped")
+            self.assertEquals(list(schedule.open_at(0, 720)), [0])
+            self.assertEquals(list(schedule.open_at(1, 60)), [1])
+        finally:
+            shutil.rmtree(directory)
@@ -0,0 +1,89 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from truckstop import snapshot
+from truckstop.search import SpatialIndex, DocumentIndex, Document, Query
+from truckstop.store import ObjectStore
+
+from test_spatial import SCENARIO_3
+from test_store import FIELDS, ROWS
+
+
+MENUS = ["Tacos and burritos", "Cupcakes", "Tacos, hot dogs"]
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.store = ObjectStore(FIELDS)
+        ids = map(self.store.append, ROWS)
+        places = sorted(SCENARIO_3.values())[:len(ids)]
+        self.spatial = SpatialIndex(dict(zip(ids, places)))
+        self.text = DocumentIndex([Document(i, m)
+                                   for i, m in zip(ids, MENUS)])
+
+        self.directory = tempfile.mkdtemp()
+        self.fname = os.path.join(self.directory, 'test.snapshot')
+        snapshot.save(self.fname, self.spatial, self.text, self.store)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        self.assertTrue(snapshot.is_snapshot(self.fname))
+        spatial, text, store = snapshot.load(self.fname)
+
+        pt = SCENARIO_3['Null Island']
+        for within in (1, 100, 5000):
+            self.assertEquals(spatial.search(pt, within),
+                              self.spatial.search(pt, within))
+        self.assertEquals(spatial.nearest(pt, 2), self.spatial.nearest(pt, 2))
+
+        for query in ("tacos", "cupcakes hot dogs", "pizza"):
+            self.assertEquals(text.query(Query(query)),
+                              self.text.query(Query(query)))
+
+        self.assertEquals(len(store), len(self.store))
+        for rowid in store:
+            self.assertEquals(store[rowid].copy(), self.store[rowid].copy())
+            self.assertEquals(store.fragment(rowid),
+                              self.store.fragment(rowid))
+
+    def test_postings(self):
+        menus = ["tacos", "burritos", "tacos burritos", "hot dogs"]
+        documents = [Document(i, menus[i % 7 % 4]) for i in range(1000)]
+        documents.append(Document(100000, "tacos " * 300))
+        text = DocumentIndex(documents)
+        snapshot.save(self.fname, self.spatial, text, self.store)
+        _, restored, _ = snapshot.load(self.fname)
+
+        for query in ("tacos", "burritos hot dogs", "pizza"):
+            self.assertEquals(restored.query(Query(query), max_results=50),
+                              text.query(Query(query), max_results=50))
+
+        gone = documents[3]
+        for index in (text, restored):
+            index.remove(gone)
+            index.add(Document(100001, "tacos"))
+        self.assertEquals(restored.query(Query("tacos"), max_results=2000),
+                          text.query(Query("tacos"), max_results=2000),
+                          "A restored index can still be changed")
+
+    def test_corruption(self):
+        with open(self.fname, 'r+b') as f:
+            f.seek(-1, os.SEEK_END)
+            last = f.read(1)
+            f.seek(-1, os.SEEK_END)
+            f.write(chr(ord(last) ^ 0xff))
+
+        self.assertRaises(snapshot.SnapshotError, snapshot.load, self.fname)
+
+    def test_shared(self):
+        spatial, text, store = snapshot.shared(self.spatial, self.text,
+                                               self.store, self.directory)
+        self.assertEquals(os.listdir(self.directory), ['test.snapshot'],
+                          "Nothing is left behind on disk")
+        self.assertEquals(text.query(Query("tacos")),
+                          self.text.query(Query("tacos")))
@@ -1,6 +1,7 @@
+import random
 import unittest
 
-from truckstop.search import SpatialIndex
+from truckstop.search import SpatialIndex, EARTH_RADIUS_MILES
 
 """
 
@@ -53,12 +54,23 @@ SCENARIO_2 = {
     'F': (7, 2)
 }
 
+# (lat, lon) spots which are close together on the globe, but nowhere
+# near each other in degrees.
+SCENARIO_3 = {
+    'Fiji': (-17.0, 179.9),
+    'Also Fiji': (-17.0, -179.9),
+    'North Pole': (89.9, 0),
+    'Also North Pole': (89.9, 180),
+    'Null Island': (0, 0),
+}
+
 
 class TestSpatialIndex(unittest.TestCase):
 
     def setUp(self):
         self.scenario_1 = SpatialIndex(SCENARIO_1, magnitude=1)
         self.scenario_2 = SpatialIndex(SCENARIO_2, magnitude=1)
+        self.scenario_3 = SpatialIndex(SCENARIO_3)
 
     def test_search(self):
         wideOpenSearch = self.scenario_1.search((0, 0), 100000,
@@ -79,5 +91,125 @@ class TestSpatialIndex(unittest.TestCase):
         self.assertEquals('AB', 
                           ''.join(map(lambda x: x[1], within7oforigin)),
                           'Order should be AB')
-        
-                                                 
+
+    def test_nearest(self):
+        closest = self.scenario_2.nearest((0, 0), 3)
+        self.assertEquals('ABF', ''.join(map(lambda x: x[1], closest)),
+                          'The 3 closest to the origin are ABF, in order')
+
+        closestWithin = self.scenario_2.nearest((0, 0), 3, within=7)
+        self.assertEquals('AB', ''.join(map(lambda x: x[1], closestWithin)),
+                          'Only 2 of the 3 closest are within 7')
+
+        self.assertEquals(len(self.scenario_1.nearest((0, 0), 10)), 4,
+                          "Asking for more than we have returns "
+                          "everything")
+        self.assertEquals(self.scenario_1.nearest((0, 0), 0), [],
+                          "Asking for nothing returns nothing")
+
+    def test_search_many(self):
+        searches = [((0, 0), 7), ((2, 3), 0.5), ((-5, 5), 100), ((9, 9), 1)]
+        for index in (self.scenario_1, self.scenario_2, self.scenario_3):
+            self.assertEquals(index.search_many(searches),
+                              [index.search(pt, within)
+                               for pt, within in searches],
+                              "A shared walk finds what separate "
+                              "searches do")
+            self.assertEquals(index.search_many(searches, max_results=1),
+                              [index.search(pt, within, max_results=1)
+                               for pt, within in searches])
+        self.assertEquals(self.scenario_1.search_many([]), [])
+
+    def test_updates(self):
+        random.seed(15)
+        points = dict((i, (random.uniform(37.7, 37.8),
+                           random.uniform(-122.5, -122.4)))
+                      for i in range(200))
+        index = SpatialIndex(dict((i, points[i]) for i in range(100)))
+        live = set(range(100))
+        for i in range(100, 200):
+            index.insert(i, points[i])
+            live.add(i)
+            if i % 3 == 0:
+                gone = random.choice(sorted(live))
+                self.assertEquals(index.remove(gone), 1)
+                live.discard(gone)
+        self.assertEquals(index.remove('nothing'), 0)
+
+        rebuilt = SpatialIndex(dict((i, points[i]) for i in live))
+        self.assertEquals(len(index), len(live))
+        for pt in ((37.75, -122.45), (37.71, -122.49)):
+            for within in (0.5, 2, 10):
+                self.assertEquals(index.search(pt, within),
+                                  rebuilt.search(pt, within),
+                                  "Updates find what a rebuild does")
+                self.assertEquals(index.nearest(pt, 5, within),
+                                  rebuilt.nearest(pt, 5, within))
+                self.assertEquals(index.search_many([(pt, within)], 3),
+                                  [rebuilt.search(pt, within, 3)])
+            self.assertEquals(index.distances(pt, range(200)),
+                              rebuilt.distances(pt, range(200)))
+
+        index.compact()
+        self.assertEquals(index.search((37.75, -122.45), 2),
+                          rebuilt.search((37.75, -122.45), 2))
+
+    def test_sample(self):
+        rng = random.Random(18)
+        points = dict((i, (rng.uniform(37.7, 37.8),
+                           rng.uniform(-122.5, -122.4)))
+                      for i in range(300))
+        index = SpatialIndex(points)
+        for i in range(300, 320):
+            index.insert(i, (37.75, -122.45))
+        for i in range(0, 300, 4):
+            index.remove(i)
+
+        pt = (37.75, -122.45)
+        in_range = dict((k, d) for d, k in index.search(pt, 2))
+        tree = index._tree
+        here = index.projection.project(pt)
+        radius = index.projection.bound(2)
+        self.assertEquals(sorted(s for lo, hi in tree.cover(here, radius)
+                                 for s in range(lo, hi)),
+                          sorted(s for _, s in tree.within(here, radius)),
+                          "An exact cover is everything in range")
+
+        counts = dict.fromkeys(in_range, 0)
+        for _ in range(len(in_range) * 50):
+            (d, key), = index.sample(pt, 2, rng=rng)
+            self.assertAlmostEquals(d, in_range[key])
+            counts[key] += 1
+        self.assertTrue(min(counts.values()) > 20 and
+                        max(counts.values()) < 90,
+                        "Everything in range is about as likely: %r" %
+                        sorted(counts.values()))
+
+        picked = index.sample(pt, 2, count=5, rng=rng)
+        self.assertEquals(len(set(k for _, k in picked)), 5)
+        odd = index.sample(pt, 2, count=1000, accept=lambda k: k % 2,
+                           rng=rng)
+        self.assertEquals(sorted(k for _, k in odd),
+                          sorted(k for k in in_range if k % 2),
+                          "Asking for more than there are finds them all")
+        self.assertEquals(index.sample(pt, 2, accept=lambda k: k == 305,
+                                       rng=rng)[0][1], 305,
+                          "Even one in hundreds is found")
+        self.assertEquals(index.sample((0, 0), 2, rng=rng), [])
+
+    def test_geodesic(self):
+        degree = self.scenario_3.nearest((1, 0), 1)
+        self.assertAlmostEquals(degree[0][0],
+                                2 * 3.14159265359 * EARTH_RADIUS_MILES / 360,
+                                places=3, msg="A degree of latitude is "
+                                "1/360th of a great circle")
+
+        fiji = self.scenario_3.search((-17.0, 180), 10)
+        self.assertEquals(['Also Fiji', 'Fiji'],
+                          sorted(map(lambda x: x[1], fiji)),
+                          "Searches work across the antimeridian")
+
+        pole = self.scenario_3.search((90, 0), 10)
+        self.assertEquals(['Also North Pole', 'North Pole'],
+                          sorted(map(lambda x: x[1], pole)),
+                          "Searches work around the poles")
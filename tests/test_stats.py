@@ -0,0 +1,70 @@
+import unittest
+
+from truckstop import stats
+from truckstop.search import SpatialIndex, DocumentIndex, Document, Query, \
+    QueryPlanner
+
+from test_planner import MENUS
+from test_spatial import SCENARIO_2
+
+
+class TestStats(unittest.TestCase):
+
+    def setUp(self):
+        stats.TOTALS.reset()
+
+    def tearDown(self):
+        stats.finish()
+        stats.enable(False)
+
+    def test_disabled(self):
+        self.assertEquals(stats.begin(), None)
+        push = [].append
+        self.assertTrue(stats.counting('nodes', push) is push,
+                        "Nothing is wrapped while disabled")
+        with stats.stage('spatial'):
+            stats.count('rows', 10)
+        self.assertEquals(stats.finish(), None)
+        self.assertEquals(stats.TOTALS.requests, 0)
+
+    def test_timing(self):
+        stats.enable()
+        timing = stats.begin()
+        with stats.stage('spatial'):
+            stats.count('rows', 10)
+            stats.count('rows')
+        pushed = []
+        push = stats.counting('nodes', pushed.append)
+        for i in range(5):
+            push(i)
+        self.assertEquals(pushed, range(5))
+        self.assertTrue(stats.finish() is timing)
+
+        self.assertEquals(timing.counters, {'rows': 11, 'nodes': 5})
+        self.assertEquals(timing.stages.keys(), ['spatial'])
+        header = timing.header()
+        self.assertTrue(header.startswith('total='))
+        self.assertTrue('spatial=' in header and 'rows=11' in header,
+                        header)
+
+        summary = stats.TOTALS.summary()
+        self.assertEquals(summary['requests'], 1)
+        self.assertEquals(summary['counters']['nodes']['total'], 5)
+        self.assertEquals(summary['stages']['spatial']['requests'], 1)
+
+    def test_searches(self):
+        spatial = SpatialIndex(SCENARIO_2, magnitude=1)
+        text = DocumentIndex([Document(k, v)
+                              for k, v in sorted(MENUS.items())])
+        planner = QueryPlanner(spatial, text)
+
+        stats.enable()
+        timing = stats.begin()
+        planner.plan((0, 0), 100, max_results=3).execute()
+        planner.plan((0, 0), 100, Query("tacos")).execute()
+        stats.finish()
+        self.assertTrue(0 < timing.counters['nodes'] <= len(SCENARIO_2),
+                        "Every node visited is counted: %r" % timing.counters)
+        self.assertEquals(timing.counters['candidates'], 4,
+                          "A, C, D and F serve tacos")
+        self.assertTrue('spatial' in timing.stages)
@@ -0,0 +1,122 @@
+import json
+import unittest
+
+from truckstop.store import ObjectStore, Bitmap, TEMPLATE_FIELDS
+
+
+FIELDS = ['ObjectID', 'Applicant', 'Status', 'permit', 'Schedule',
+          'Location']
+
+SCHEDULE = TEMPLATE_FIELDS['Schedule']
+
+ROWS = [
+    {'ObjectID': '1', 'Applicant': 'Cupkates', 'Status': 'APPROVED',
+     'permit': '13MFF-0068', 'Schedule': SCHEDULE % {'permit': '13MFF-0068'},
+     'Location': '(37.79, -122.39)'},
+    {'ObjectID': '2', 'Applicant': 'Cheese Gone Wild', 'Status': 'EXPIRED',
+     'permit': '13MFF-0060', 'Schedule': 'http://example.com/schedule.pdf',
+     'Location': '(37.78, -122.39)'},
+    {'ObjectID': '3', 'Applicant': 'Cupkates', 'Status': 'APPROVED',
+     'permit': '13MFF-0069', 'Schedule': '',
+     'Location': '(37.77, -122.39)'},
+]
+
+
+class TestObjectStore(unittest.TestCase):
+
+    def setUp(self):
+        self.store = ObjectStore(FIELDS)
+        self.ids = map(self.store.append, ROWS)
+
+    def test_rows(self):
+        self.assertEquals(self.ids, [0, 1, 2], "Row ids count up from 0")
+        self.assertEquals(len(self.store), 3)
+
+        for rowid, row in zip(self.ids, ROWS):
+            expected = dict(row)
+            del expected['Location']
+            self.assertEquals(self.store[rowid].copy(), expected,
+                              "Rows read back the way they went in, "
+                              "minus the dropped fields")
+
+        self.assertEquals(self.store.get(3), None)
+        self.assertEquals(self.store[0].get('Location'), None,
+                          "Location isn't kept")
+        self.assertRaises(KeyError, lambda: self.store[0]['Location'])
+
+    def test_columns(self):
+        status = self.store.column('Status')
+        self.assertEquals(status.values, ['APPROVED', 'EXPIRED'],
+                          "Each distinct status is only stored once")
+        self.assertEquals(list(status.codes), [0, 1, 0])
+
+        self.assertEquals(self.store.column('Schedule'), None,
+                          "Schedule is filled in from a template")
+        self.assertEquals(self.store._exceptions['Schedule'],
+                          {1: ROWS[1]['Schedule'], 2: ''},
+                          "Only schedules that don't fit the template "
+                          "are stored")
+
+    def test_set(self):
+        self.store.set(0, 'Status', 'EXPIRED')
+        self.store.set(1, 'Status', 'REQUESTED')
+        self.assertEquals([self.store[i]['Status'] for i in self.ids],
+                          ['EXPIRED', 'REQUESTED', 'APPROVED'])
+
+        self.store.set(0, 'permit', '14MFF-0001')
+        self.assertEquals(self.store[0]['Schedule'], ROWS[0]['Schedule'],
+                          "Changing a field doesn't change the ones "
+                          "filled in from a template with it")
+        self.store.set(0, 'Schedule', SCHEDULE % {'permit': '14MFF-0001'})
+        self.assertFalse(0 in self.store._exceptions['Schedule'])
+
+        self.assertRaises(KeyError, self.store.set, 0, 'Location', '')
+        self.assertRaises(KeyError, self.store.set, 3, 'Status', '')
+
+    def test_bitmaps(self):
+        approved = self.store.bitmap('Status', 'APPROVED')
+        self.assertEquals(list(approved), [0, 2])
+        self.assertEquals(len(approved), 2)
+        self.assertTrue(0 in approved and 1 not in approved)
+        self.assertFalse(3 in approved or -1 in approved or
+                         'x' in approved)
+        self.assertEquals(list(self.store.bitmap('Status', 'REQUESTED')), [])
+        self.assertRaises(KeyError, self.store.bitmap, 'Applicant', '')
+
+        self.assertEquals(list(self.store.matching(
+            {'Status': ['APPROVED', 'EXPIRED']})), [0, 1, 2],
+            "Any of a field's values will do")
+
+        self.store.set(2, 'Status', 'EXPIRED')
+        self.store.append(ROWS[0])
+        self.assertEquals(list(self.store.bitmap('Status', 'APPROVED')),
+                          [0, 3], "Bitmaps follow changes to the rows")
+        self.assertEquals(list(self.store.bitmap('Status', 'EXPIRED')),
+                          [1, 2])
+
+        self.assertEquals(self.store.extend(ROWS), 4)
+        self.assertEquals(list(self.store.bitmap('Status', 'APPROVED')),
+                          [0, 3, 4, 6], "Bitmaps follow rows added at once")
+        self.assertEquals(len(approved), 4, "Counts follow them too")
+        self.assertEquals(self.store[5].copy(), self.store[1].copy())
+
+        a, b = Bitmap(20), Bitmap(12)
+        for i in (1, 9, 11, 19):
+            a.add(i)
+        for i in (0, 1, 11):
+            b.add(i)
+        self.assertEquals(list(a & b), [1, 11])
+        self.assertEquals(list(a | b), [0, 1, 9, 11, 19])
+        a.discard(9)
+        self.assertEquals(list(a), [1, 11, 19])
+
+    def test_fragments(self):
+        self.store.build_fragments()
+        self.store.set(1, 'Status', 'REQUESTED')
+        self.store.append(ROWS[0])
+        for rowid in self.store:
+            self.assertEquals(
+                json.loads('{%s}' % self.store.fragment(rowid)),
+                self.store[rowid].copy(),
+                "A row's fragment is its fields, as JSON, kept up to "
+                "date with changes")
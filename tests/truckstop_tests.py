@@ -1,13 +1,38 @@
 import unittest
 
 def suite():
-    from test_document import TestDocumentFrequencies, TestIndex
+    from test_document import TestDocumentFrequencies, TestIndex, \
+        TestPrefixIndex, TestAnalyzer, TestPostings
     from test_spatial import TestSpatialIndex
+    from test_planner import TestQueryPlanner
+    from test_store import TestObjectStore
+    from test_snapshot import TestSnapshot
+    from test_cache import TestQueryCache
+    from test_reloader import TestReloader
+    from test_schedule import TestSchedule
+    from test_stats import TestStats
+    from test_loader import TestLoader
+    from test_assets import TestAssets
+    from test_app import TestSearchBatch, TestReload
 
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(TestDocumentFrequencies))
     suite.addTest(unittest.makeSuite(TestIndex))
+    suite.addTest(unittest.makeSuite(TestAnalyzer))
+    suite.addTest(unittest.makeSuite(TestPostings))
+    suite.addTest(unittest.makeSuite(TestPrefixIndex))
     suite.addTest(unittest.makeSuite(TestSpatialIndex))
+    suite.addTest(unittest.makeSuite(TestQueryPlanner))
+    suite.addTest(unittest.makeSuite(TestObjectStore))
+    suite.addTest(unittest.makeSuite(TestSnapshot))
+    suite.addTest(unittest.makeSuite(TestQueryCache))
+    suite.addTest(unittest.makeSuite(TestReloader))
+    suite.addTest(unittest.makeSuite(TestSchedule))
+    suite.addTest(unittest.makeSuite(TestStats))
+    suite.addTest(unittest.makeSuite(TestLoader))
+    suite.addTest(unittest.makeSuite(TestAssets))
+    suite.addTest(unittest.makeSuite(TestSearchBatch))
+    suite.addTest(unittest.makeSuite(TestReload))
 
     return suite
     
@@ -0,0 +1,363 @@
+"""assets.py: Serves the static files from memory, compressed ahead of time.
+
+Every file under the static directory is read once, at startup (before
+any workers fork, so they all share it), and kept as an `Asset`: its
+bytes, a gzip copy, and a brotli copy if the `brotli` module is
+installed. Compressed copies are only kept for types that compress,
+and only if they came out smaller.
+
+Each asset's fingerprint is a hash of its contents. It names the
+asset's URL, like `/static/js/app.3f2a9c1b7e4d.js`, which the pages
+link to through `Assets.url`. Since a fingerprinted URL always means
+the same bytes, it's served as immutable, cached for a year. The plain
+URL still works, for the files the stylesheets and scripts refer to
+themselves, but it has to be revalidated. Either way, each copy has a
+strong ETag, so revalidating costs a 304 and no body.
+
+Compressing with brotli at its best is slow, so rather than doing that
+at every startup, a build step does it once:
+
+    python -m truckstop.assets ./static
+
+which writes `app.js.gz` and `app.js.br` next to `app.js`, and so on.
+Copies newer than their file are used as they are; anything else is
+compressed when it's loaded, at a cheaper level.
+"""
+
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+
+from cStringIO import StringIO
+from optparse import OptionParser
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# hex digits of the content hash used as the fingerprint
+FINGERPRINT_LENGTH = 12
+
+FINGERPRINTED = re.compile(r'^(.*)\.([0-9a-f]{%d})(\.[^./]+)$' %
+                           FINGERPRINT_LENGTH)
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'public, no-cache'
+
+# the types worth compressing; images are compressed already
+COMPRESSIBLE = re.compile(r'^(text/|application/(javascript|json|'
+                          r'x-javascript|xml)|image/svg)')
+
+# encoding -> (suffix of the built copy, level when built, level when
+# loaded), in order of preference
+ENCODINGS = (
+    ('br', ('.br', 11, 5)),
+    ('gzip', ('.gz', 9, 6)),
+)
+SUFFIXES = tuple(suffix for _, (suffix, _, _) in ENCODINGS)
+
+
+def gzip_compress(data, level):
+    out = StringIO()
+    # a fixed mtime, so the same file always compresses the same way
+    f = gzip.GzipFile(filename='', mode='wb', compresslevel=level,
+                      fileobj=out, mtime=0)
+    f.write(data)
+    f.close()
+    return out.getvalue()
+
+
+def brotli_compress(data, level):
+    return brotli.compress(data, quality=level)
+
+
+COMPRESSORS = {
+    'gzip': gzip_compress,
+    'br': brotli_compress if brotli is not None else None,
+}
+
+
+def fingerprinted(name, fingerprint):
+    """`name`, like 'js/app.js', with `fingerprint` before its
+    extension, like 'js/app.3f2a9c1b7e4d.js'"""
+    base, ext = os.path.splitext(name)
+    return '%s.%s%s' % (base, fingerprint, ext)
+
+
+def accepted(header):
+    """{encoding: q} of an Accept-Encoding `header`. '*' stands for
+    any encoding not named."""
+    encodings = {}
+    for part in (header or '').split(','):
+        params = part.strip().split(';')
+        coding = params[0].strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params[1:]:
+            key, _, value = param.strip().partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        encodings[coding] = q
+    return encodings
+
+
+def matches(header, etag):
+    """Whether an If-None-Match `header` matches `etag`. As RFC 7232
+    has it, the comparison is weak, so W/ prefixes don't matter."""
+    if not header:
+        return False
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag == '*':
+            return True
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+class Asset(object):
+    """One static file, held in memory.
+
+    `copies` maps each encoding it can be sent in ('identity', and maybe
+    'gzip' or 'br') to its (bytes, ETag).
+    """
+
+    def __init__(self, name, data, content_type, compressed=None,
+                 signature=None):
+        self.name = name
+        self.content_type = content_type
+        self.signature = signature
+        self.fingerprint = hashlib.sha1(data).hexdigest()[
+            :FINGERPRINT_LENGTH]
+        self.url_name = fingerprinted(name, self.fingerprint)
+
+        self.copies = {'identity': (data, '"%s"' % self.fingerprint)}
+        for encoding, body in (compressed or {}).iteritems():
+            self.copies[encoding] = (body, '"%s-%s"' % (self.fingerprint,
+                                                        encoding))
+
+    def negotiate(self, accept_encoding):
+        """The encoding to send this in, for the Accept-Encoding header
+        `accept_encoding`. The most preferred encoding the client takes
+        wins, with ties going to the smaller copy."""
+        if len(self.copies) == 1:
+            return 'identity'
+        encodings = accepted(accept_encoding)
+        best, best_q = 'identity', 0.0
+        for encoding, _ in ENCODINGS:
+            if encoding not in self.copies:
+                continue
+            q = encodings.get(encoding, encodings.get('*', 0.0))
+            if q > best_q:
+                best, best_q = encoding, q
+        return best
+
+    def response(self, accept_encoding=None, if_none_match=None,
+                 immutable=False, head=False):
+        """(status, headers, body) of a request for this asset"""
+        encoding = self.negotiate(accept_encoding)
+        body, etag = self.copies[encoding]
+        headers = {
+            'ETag': etag,
+            'Cache-Control': IMMUTABLE if immutable else REVALIDATE,
+        }
+        if len(self.copies) > 1:
+            headers['Vary'] = 'Accept-Encoding'
+        if matches(if_none_match, etag):
+            return 304, headers, ''
+
+        headers['Content-Type'] = self.content_type
+        headers['Content-Length'] = str(len(body))
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+        return 200, headers, '' if head else body
+
+
+def signature(fname):
+    """Something which changes whenever `fname` is replaced or written"""
+    st = os.stat(fname)
+    return (st.st_ino, st.st_size, st.st_mtime)
+
+
+def built_copy(fname, suffix):
+    """The contents of the built copy of `fname` ending in `suffix`, if
+    there's one at least as new as `fname`"""
+    copy = fname + suffix
+    try:
+        if os.stat(copy).st_mtime < os.stat(fname).st_mtime:
+            return None
+        with open(copy, 'rb') as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
+
+
+def read_asset(directory, name):
+    """The `Asset` of the file `name`, relative to `directory`"""
+    fname = os.path.join(directory, name)
+    sig = signature(fname)
+    with open(fname, 'rb') as f:
+        data = f.read()
+
+    content_type = mimetypes.guess_type(fname)[0] or \
+        'application/octet-stream'
+    compressed = {}
+    if COMPRESSIBLE.match(content_type):
+        for encoding, (suffix, _, level) in ENCODINGS:
+            body = built_copy(fname, suffix)
+            if body is None and COMPRESSORS[encoding] is not None:
+                body = COMPRESSORS[encoding](data, level)
+            if body is not None and len(body) < len(data):
+                compressed[encoding] = body
+    return Asset(name, data, content_type, compressed, sig)
+
+
+def walk(directory):
+    """The names of the files under `directory`, relative to it, not
+    counting the built copies"""
+    names = []
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for f in files:
+            if f.startswith('.'):
+                continue
+            if f.endswith(SUFFIXES) and \
+                    os.path.splitext(f)[0] in files:
+                continue
+            names.append(os.path.relpath(os.path.join(root, f), directory)
+                         .replace(os.sep, '/'))
+    return sorted(names)
+
+
+class Assets(object):
+    """Every file under `directory`, served from memory under the URL
+    `prefix`.
+
+    With `watch`, every request checks whether the file has changed
+    since it was loaded, and loads it again if so, which is handy
+    while working on them. New files are picked up too, as long as
+    they're really under `directory`.
+    """
+
+    def __init__(self, directory, prefix='/static/', watch=False):
+        self.directory = os.path.abspath(directory)
+        self._root = os.path.join(os.path.realpath(directory), '')
+        self.prefix = prefix
+        self.watch = watch
+        self._assets = {}
+        for name in walk(self.directory):
+            self._assets[name] = read_asset(self.directory, name)
+
+    def __len__(self):
+        return len(self._assets)
+
+    def __contains__(self, name):
+        return name in self._assets
+
+    def url(self, name):
+        """The fingerprinted URL of the asset `name`, like 'js/app.js',
+        or its plain URL, if there isn't one"""
+        asset = self.get(name)
+        if asset is None:
+            return self.prefix + name
+        return self.prefix + asset.url_name
+
+    def get(self, name):
+        """The `Asset` named `name`, or None"""
+        asset = self._assets.get(name)
+        if self.watch:
+            asset = self._refresh(name, asset)
+        return asset
+
+    def _refresh(self, name, asset):
+        fname = os.path.join(self.directory, name)
+        if os.path.normpath(name) != name or os.path.isabs(name) or \
+                name.split('/')[0] == os.pardir or \
+                not os.path.realpath(fname).startswith(self._root):
+            # like ../app.py, or a link out of the directory
+            return None
+        try:
+            sig = signature(fname)
+        except OSError:
+            self._assets.pop(name, None)
+            return None
+        if asset is None or asset.signature != sig:
+            asset = self._assets[name] = read_asset(self.directory, name)
+        return asset
+
+    def lookup(self, path):
+        """(`Asset`, whether `path` was its fingerprinted name) of the
+        asset at `path`, relative to the prefix, or (None, False).
+
+        A fingerprint which isn't the asset's current one (from a page
+        rendered before it changed) still gets the current asset, just
+        not as immutable."""
+        asset = self.get(path)
+        if asset is not None:
+            return asset, False
+        m = FINGERPRINTED.match(path)
+        if m is None:
+            return None, False
+        asset = self.get(m.group(1) + m.group(3))
+        if asset is None:
+            return None, False
+        return asset, asset.fingerprint == m.group(2)
+
+    def response(self, path, accept_encoding=None, if_none_match=None,
+                 head=False):
+        """(status, headers, body) of a request for `path`, relative to
+        the prefix"""
+        asset, immutable = self.lookup(path)
+        if asset is None:
+            return 404, {}, "File does not exist."
+        return asset.response(accept_encoding, if_none_match, immutable,
+                              head)
+
+
+def build(directory):
+    """Writes the compressed copies of every file under `directory`
+    worth compressing, at the best level, next to each file. Returns
+    [(name, fingerprinted name)]."""
+    built = []
+    for name in walk(directory):
+        fname = os.path.join(directory, name)
+        with open(fname, 'rb') as f:
+            data = f.read()
+        content_type = mimetypes.guess_type(fname)[0] or ''
+        for encoding, (suffix, level, _) in ENCODINGS:
+            compress = COMPRESSORS[encoding]
+            if compress is None or not COMPRESSIBLE.match(content_type):
+                continue
+            with open(fname + suffix, 'wb') as f:
+                f.write(compress(data, level))
+        built.append((name, Asset(name, data, content_type).url_name))
+    return built
+
+
+parser = OptionParser(usage="%prog [options] staticdirectory")
+
+
+def main(argv=None):
+    (options, args) = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.print_help()
+        raise SystemExit()
+
+    if brotli is None:
+        print "No brotli module, so only writing gzip copies"
+    for name, url_name in build(args[0]):
+        print "%s -> %s" % (name, url_name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""cache.py: Remembers recent search results.
+
+The front end searches on every keystroke, and most searches come from
+a few spots downtown, for a few common words. So, the same search, or
+one close enough to it, tends to get run over and over again.
+
+`QueryCache` keeps the most recently used results, for a while. Rather
+than the exact search, results are keyed on:
+
+  - The location, snapped to a grid of `cell` degrees. Searches a few
+    steps apart land in the same cell.
+  - The radius.
+  - The query's stemmed terms, minus the stop words, and how many
+    times each appears. "Tacos!" and "tacos" are the same search.
+  - The attribute filters, if any, in no particular order.
+
+Since results are ranked the same way regardless of how many are asked
+for, an entry holding the top N results can answer any search for N or
+fewer of them, or for any number at all if there weren't N to be had.
+"""
+
+import time
+
+from collections import OrderedDict
+
+
+class QueryCache(object):
+    """An LRU cache of up to `capacity` search results, each of which
+    expires `ttl` seconds after it was stored."""
+
+    def __init__(self, capacity=1024, ttl=300, cell=0.0005,
+                 clock=time.time):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.cell = cell
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def key(self, pt, within, query=None, filters=None):
+        """The cache key for a search around `pt`, `within` miles, for
+        `query` (a `Query`), if given, limited by `filters`, a dict of
+        {field: [values]}, if given"""
+        lat, lon = pt
+        terms = None
+        if query is not None:
+            terms = tuple(sorted(query._frequencies.iteritems()))
+        if filters:
+            filters = tuple(sorted((f, tuple(sorted(set(values))))
+                                   for f, values in filters.iteritems()))
+        else:
+            filters = None
+        return (int(round(lat / self.cell)), int(round(lon / self.cell)),
+                within, terms, filters)
+
+    def get(self, key, max_results=None):
+        """The entry stored for `key`, if it has at least `max_results`
+        results (or all of them, when `max_results` is None), else None.
+
+        Entries are (results, pt, plan), where `pt` is the point the
+        results were measured from, and `plan` is what found them.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            expires, wanted, value = entry
+            if expires <= self.clock():
+                entry = None
+            else:
+                self._entries[key] = entry
+                complete = wanted is None or len(value[0]) < wanted
+                if complete or (max_results is not None and
+                                max_results <= wanted):
+                    self.hits += 1
+                    return value
+        self.misses += 1
+        return None
+
+    def put(self, key, max_results, results, pt, plan):
+        """Stores `results`, the top `max_results` (or all, if None)
+        results of a search from `pt`, found by `plan`"""
+        self._entries.pop(key, None)
+        self._entries[key] = (self.clock() + self.ttl, max_results,
+                              (results, pt, plan))
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        """Forgets everything, for when the indexes change"""
+        self._entries.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._entries), 'capacity': self.capacity}
@@ -1,30 +1,337 @@
 import csv
+import multiprocessing
 
-from search import SpatialIndex, DocumentIndex, Document
+from array import array
+from collections import Counter, defaultdict
+from itertools import chain, islice, izip
 
-def load(fname):
-    """Loads CSV into searchable indexes
+from search import SpatialIndex, DocumentIndex, Document, Postings, \
+    ANALYZER, augmented_tf, tf_norm, word_splitter, count_words, \
+    surface_forms
+from store import ObjectStore
+from schedule import Schedule, parse_weekday, parse_time
+
+# fields which go into the indexes, rather than just the object store
+LOCATION_FIELDS = ('Latitude', 'Longitude',)
+TEXT_FIELDS = ('Applicant', 'FoodItems',)
+
+# how many rows of the CSV are read, and handed off to be analyzed, at
+# a time
+CHUNK_ROWS = 2000
+
+# the columns of a schedule table: the ObjectID of the permit, the
+# weekday, and the opening and closing times
+SCHEDULE_FIELDS = ('locationid', 'DayOfWeekStr', 'start24', 'end24',)
+
+
+def location(spot):
+    """The (lat, lon) of a permit, or None if it doesn't have one"""
+    if not spot['Latitude'] or not spot['Longitude']:
+        return None
+    return float(spot['Latitude']), float(spot['Longitude'])
+
+
+def permit_text(spot):
+    """The text of a permit which gets indexed"""
+    return "%(Applicant)s %(FoodItems)s" % spot
+
+
+def document(key, spot, analyzer=ANALYZER):
+    """The text of a permit, to be indexed under `key`"""
+    return Document(key, permit_text(spot), analyzer)
+
+
+class PartialIndex(object):
+    """The postings of some of the documents, built up a chunk at a time.
+
+    `postings` maps each term to [doc ids, term frequencies, max
+    weight], `max_freqs` holds (first doc id, array of each document's
+    `max_freq`) for each chunk, and `words` counts the words terms get
+    suggested as (see `count_words`). Built in a loader process,
+    terms its copy of the analyzer already had an id for keep it, and
+    the rest are left as stems for the parent to intern, so nothing is
+    interned twice.
     """
-    skip = 0
-    documents = []
-    locations = []
-    objects = {}
-    reader = csv.DictReader(open(fname))
-    for spot in reader:
-        if not spot['Latitude'] or not spot['Longitude']:
-            print "%d. Have to skip this one: %s" % (skip, spot['Applicant'])
-            skip += 1
-            continue
 
-        lat, lon = float(spot['Latitude']), float(spot['Longitude'])
-        doctext = "%(Applicant)s %(FoodItems)s" % spot
-        key = spot['ObjectID']
-        locations.append((key, (lat, lon,),))
-        documents.append(Document(key, doctext))
-        objects[key] = spot
+    def __init__(self, analyzer):
+        self.analyzer = analyzer
+        self.postings = {}
+        self.max_freqs = []
+        self.words = {}
+
+    def add(self, first, texts):
+        """Adds `texts`, the documents `first`, `first` + 1, ..."""
+        terms = self.analyzer.terms
+        stop_words = self.analyzer.stop_words
+        postings = self.postings
+        max_freqs = array('l')
+        for key, text in enumerate(texts, first):
+            words = word_splitter(text)
+            count_words(words, self.words, stop_words)
+            freqs = defaultdict(int)
+            for t in terms(words, intern=False):
+                freqs[t] += 1
+            max_freq = max(freqs.itervalues()) if freqs else 0
+            max_freqs.append(max_freq)
+            for t, f in freqs.iteritems():
+                p = postings.get(t)
+                if p is None:
+                    p = postings[t] = [array('l'), array('l'), 0.0]
+                p[0].append(key)
+                p[1].append(f)
+                weight = augmented_tf(f, max_freq)
+                if weight > p[2]:
+                    p[2] = weight
+        self.max_freqs.append((first, max_freqs))
+
+    def result(self):
+        return self.postings, self.max_freqs, self.words
+
+
+def _analyze(analyzer, inbox, outbox):
+    """Runs in a loader process: adds each chunk of texts it's sent to a
+    `PartialIndex`, until it's sent None, then sends back the result"""
+    partial = PartialIndex(analyzer)
+    for first, texts in iter(inbox.recv, None):
+        partial.add(first, texts)
+    outbox.send(partial.result())
+
+
+class Analyzers(object):
+    """Hands chunks of text out to up to `processes` loader processes,
+    round robin, starting them as they're needed. With one process,
+    the chunks are just analyzed in this one.
+
+    Processes are forked and talked to over pipes, rather than through
+    a `multiprocessing.Pool`, whose helper threads hang once gevent has
+    patched threading.
+    """
+
+    def __init__(self, analyzer, processes):
+        self.analyzer = analyzer
+        self.processes = processes
+        self.local = PartialIndex(analyzer) if processes <= 1 else None
+        # (process, its inbox, its outbox)
+        self.workers = []
+        self.sent = 0
+
+    def _start(self):
+        inbox, send = multiprocessing.Pipe(False)
+        receive, outbox = multiprocessing.Pipe(False)
+        process = multiprocessing.Process(
+            target=_analyze, args=(self.analyzer, inbox, outbox))
+        process.daemon = True
+        process.start()
+        inbox.close()
+        outbox.close()
+        self.workers.append((process, send, receive))
+
+    def send(self, first, texts):
+        """Analyzes `texts`, the documents `first`, `first` + 1, ..."""
+        if self.local is not None:
+            self.local.add(first, texts)
+            return
+        if len(self.workers) < self.processes:
+            self._start()
+        _, send, _ = self.workers[self.sent % len(self.workers)]
+        send.send((first, texts))
+        self.sent += 1
+
+    def results(self):
+        """[(postings, max_freqs, words)] of each `PartialIndex`"""
+        if self.local is not None:
+            return [self.local.result()]
+        for _, send, _ in self.workers:
+            send.send(None)
+        try:
+            results = [receive.recv() for _, _, receive in self.workers]
+        except EOFError:
+            raise RuntimeError("a loader process died")
+        for process, _, _ in self.workers:
+            process.join()
+        return results
+
+    def close(self):
+        for process, send, receive in self.workers:
+            if process.is_alive():
+                process.terminate()
+            send.close()
+            receive.close()
+        self.workers = []
+
+
+def merged(partials, size, analyzer=ANALYZER):
+    """The `DocumentIndex` of the `size` documents in `partials`, the
+    results of `PartialIndex`es.
+
+    Each term's postings come in a sorted run per partial index, which
+    (unless there's just one) get merged, as do the counts of their
+    words, so the index knows what to suggest its terms as.
+    """
+    norms = array('d', [0.0]) * size
+    runs = defaultdict(list)
+    words = Counter()
+    for postings, max_freqs, counts in partials:
+        words.update(counts)
+        for first, chunk in max_freqs:
+            norms[first:first + len(chunk)] = array('d', map(tf_norm, chunk))
+        for t, run in postings.iteritems():
+            if isinstance(t, basestring):
+                t = analyzer.intern(t)
+            runs[t].append(run)
+
+    index = {}
+    for t, term_runs in runs.iteritems():
+        if len(term_runs) == 1:
+            docs, freqs, max_weight = term_runs[0]
+        else:
+            pairs = sorted(chain.from_iterable(
+                izip(docs, freqs) for docs, freqs, _ in term_runs))
+            docs = [i for i, _ in pairs]
+            freqs = [f for _, f in pairs]
+            max_weight = max(run[2] for run in term_runs)
+        index[t] = Postings.encode(docs, freqs, max_weight)
+    return DocumentIndex.from_postings(xrange(size), norms, index, analyzer,
+                                       surface_forms(analyzer, words))
+
+
+def load(fname, analyzer=ANALYZER, processes=None, counters=None):
+    """Loads CSV into searchable indexes, with the text run through
+    `analyzer`.
+
+    The CSV is streamed through `CHUNK_ROWS` rows at a time. Each chunk
+    goes straight into the object store, its locations are put aside for
+    the spatial index, and its text is handed to one of `processes`
+    loader processes (by default, one per core) to be split, stemmed and
+    counted into a partial inverted index. Once the whole file has been
+    read, the partial indexes are merged into the text index.
+
+    Rows are counted into `counters`, a `Counter`: every one under
+    'rows', those which got indexed under 'indexed', and those which
+    were skipped under 'skipped.no_location' (they don't have one) or
+    'skipped.bad_location' (it doesn't parse).
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if counters is None:
+        counters = Counter()
+    locations = []
+    reader = csv.reader(open(fname, 'rb'))
+    fields = next(reader)
+    objects = ObjectStore(fields)
+    analyzers = Analyzers(analyzer, processes)
+    try:
+        while True:
+            rows = list(islice(reader, CHUNK_ROWS))
+            if not rows:
+                break
+            counters['rows'] += len(rows)
+            spots = []
+            for row in rows:
+                spot = dict(izip(fields, row))
+                try:
+                    pt = location(spot)
+                except (KeyError, ValueError):
+                    counters['skipped.bad_location'] += 1
+                    continue
+                if pt is None:
+                    counters['skipped.no_location'] += 1
+                    continue
+                locations.append((len(objects) + len(spots), pt))
+                spots.append(spot)
+            if spots:
+                first = objects.extend(spots)
+                analyzers.send(first, map(permit_text, spots))
+        partials = analyzers.results()
+    finally:
+        analyzers.close()
+    counters['indexed'] += len(objects)
+    objects.build_fragments()
 
     spatial = SpatialIndex(locations)
-    text = DocumentIndex(documents)
+    text = merged(partials, len(objects), analyzer)
 
     return spatial, text, objects
-    
+
+
+def load_schedule(fname, objects, counters=None):
+    """Loads a CSV schedule table for the permits in `objects` into a
+    `Schedule`. Each row has a permit's ObjectID, a weekday, and the
+    times it opens and closes that day, in the `SCHEDULE_FIELDS`
+    columns.
+
+    Rows are counted into `counters`, if given: every one under
+    'schedule.rows', and those without a known permit, weekday or times
+    under 'schedule.skipped'.
+    """
+    if counters is None:
+        counters = Counter()
+    rowids = dict((objects.value(rowid, 'ObjectID'), rowid)
+                  for rowid in objects)
+    id_field, weekday_field, opens_field, closes_field = SCHEDULE_FIELDS
+    intervals = []
+    for row in csv.DictReader(open(fname)):
+        counters['schedule.rows'] += 1
+        rowid = rowids.get(row.get(id_field))
+        try:
+            interval = (rowid, parse_weekday(row[weekday_field]),
+                        parse_time(row[opens_field]),
+                        parse_time(row[closes_field]))
+        except (KeyError, TypeError, ValueError):
+            rowid = None
+        if rowid is None:
+            counters['schedule.skipped'] += 1
+            continue
+        intervals.append(interval)
+    return Schedule(len(objects), intervals)
+
+
+def add(spatial, text, objects, spot):
+    """Adds the permit `spot` to already loaded indexes, returning its
+    key, or None if it doesn't have a location."""
+    pt = location(spot)
+    if pt is None:
+        return None
+    key = objects.append(spot)
+    spatial.insert(key, pt)
+    text.add(document(key, spot))
+    return key
+
+
+def remove(spatial, text, objects, key):
+    """Takes the permit `key` out of the indexes. Its row stays in
+    `objects`, but nothing will find it."""
+    spatial.remove(key)
+    text.remove(document(key, objects[key]))
+
+
+def update(spatial, text, objects, key, changes):
+    """Applies `changes`, a dict of field values, to the permit `key`.
+
+    Only changes to its location or text touch the indexes; anything
+    else, like a change in `Status`, just updates its row.
+
+    Everything is checked before anything changes: a KeyError is raised
+    for a permit that's been removed or a field it doesn't have, and a
+    ValueError for a location that's missing or doesn't parse.
+    """
+    if key not in text:
+        raise KeyError(key)
+    row = objects[key]
+    for f in changes:
+        if f not in row:
+            raise KeyError(f)
+    reindex = [f for f in changes
+               if f in LOCATION_FIELDS + TEXT_FIELDS and changes[f] != row[f]]
+    if reindex:
+        changed = row.copy()
+        changed.update(changes)
+        pt = location(changed)
+        if pt is None:
+            raise ValueError("a permit has to have a location")
+        remove(spatial, text, objects, key)
+    for f, value in changes.iteritems():
+        objects.set(key, f, value)
+    if reindex:
+        spatial.insert(key, pt)
+        text.add(document(key, row))
@@ -0,0 +1,95 @@
+"""reloader.py: Picks up a changed data file without a restart.
+
+A `Reloader` checks the data file every so often. Once it has changed,
+and then stayed the same for a whole check (so we don't read it half
+written), the file is loaded again, and the new indexes are handed
+over to be swapped in.
+
+Loading happens on a real thread when gevent has one to offer, so
+requests keep being served while the new indexes are built. Only the
+build gets that thread, so it should leave the indexes ready to serve,
+and the swap should be as cheap as an assignment. If the new file
+can't be loaded, the old indexes stay put.
+"""
+
+import os
+import sys
+import traceback
+
+import gevent
+
+
+def signature(fname):
+    """Something which changes whenever `fname` is replaced or written"""
+    st = os.stat(fname)
+    return (st.st_ino, st.st_size, st.st_mtime)
+
+
+def off_loop(func, *args):
+    """Calls `func(*args)` on gevent's thread pool, if it has one, so
+    the hub can keep running other greenlets meanwhile."""
+    threadpool = getattr(gevent.get_hub(), 'threadpool', None)
+    if threadpool is None:
+        return func(*args)
+    return threadpool.apply(func, args)
+
+
+class Reloader(object):
+    """Watches `fname`, calling `swap(build(fname))` whenever it
+    changes. Checks happen every `interval` seconds."""
+
+    def __init__(self, fname, build, swap, interval=60):
+        self.fname = fname
+        self.build = build
+        self.swap = swap
+        self.interval = interval
+        self.loaded = signature(fname)
+        self.pending = None
+        self.reloads = 0
+        self.pid = None
+
+    def check(self):
+        """Reloads if the file has changed and since settled, returning
+        whether it did."""
+        try:
+            current = signature(self.fname)
+        except OSError:
+            # in the middle of being replaced, probably
+            self.pending = None
+            return False
+
+        if current == self.loaded:
+            self.pending = None
+            return False
+        if current != self.pending:
+            # give it a check to settle down
+            self.pending = current
+            return False
+
+        indexes = off_loop(self.build, self.fname)
+        self.swap(indexes)
+        self.loaded = current
+        self.pending = None
+        self.reloads += 1
+        return True
+
+    def run(self):
+        while True:
+            gevent.sleep(self.interval)
+            if os.getpid() != self.pid:
+                # a forked worker; reloading is up to whoever forked it
+                return
+            try:
+                if self.check():
+                    print "Reloaded %s" % self.fname
+            except Exception:
+                print >>sys.stderr, "Couldn't reload %s, keeping the " \
+                    "current indexes:" % self.fname
+                traceback.print_exc()
+                # don't try this version of the file again
+                self.loaded = self.pending
+                self.pending = None
+
+    def start(self):
+        self.pid = os.getpid()
+        return gevent.spawn(self.run)
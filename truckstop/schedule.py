@@ -0,0 +1,137 @@
+"""schedule.py: Which venues are open when.
+
+Permits only link to a PDF of their schedule, so schedules come from a
+separate table (see `loader.load_schedule`), each row of which says a
+venue is open on a weekday from one time to another.
+
+A `Schedule` cuts each weekday at every time anything opens or closes.
+Between two cuts, the same venues are open the whole while, so each of
+these segments gets a `Bitmap` of them. Finding what's open at a given
+time is then a binary search for its segment, O(log n), and the bitmap
+is used like any other filter: combined with them, and checked while
+walking the indexes, so only the k venues in range which are open ever
+get looked at.
+"""
+
+import time
+
+from bisect import bisect_left, bisect_right
+
+from store import Bitmap
+
+
+# in the order of `time.struct_time.tm_wday`
+WEEKDAYS = ('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday',
+            'Saturday', 'Sunday',)
+
+MINUTES_PER_DAY = 24 * 60
+
+
+def parse_weekday(s):
+    """The number of the weekday `s`, like 'Monday', 'mon' or 'Mo', with
+    Monday being 0"""
+    s = s.strip().lower()
+    if len(s) >= 2:
+        for i, day in enumerate(WEEKDAYS):
+            if day.lower().startswith(s):
+                return i
+    raise ValueError("Invalid weekday: %r" % s)
+
+
+def parse_time(s):
+    """Minutes past midnight of the time of day `s`, either 24 hour,
+    like '14:30' or '9', or 12 hour, like '2:30PM' or '9am'.
+
+    '24:00' is midnight at the end of the day, for closing times.
+    """
+    t = s.strip().lower()
+    meridian = None
+    if t[-2:] in ('am', 'pm'):
+        t, meridian = t[:-2].strip(), t[-2:]
+    hours, _, minutes = t.partition(':')
+    try:
+        hours, minutes = int(hours), int(minutes or 0)
+    except ValueError:
+        raise ValueError("Invalid time: %r" % s)
+    if meridian is not None:
+        if not 1 <= hours <= 12:
+            raise ValueError("Invalid time: %r" % s)
+        hours = hours % 12 + (12 if meridian == 'pm' else 0)
+    minute = hours * 60 + minutes
+    if not 0 <= minutes < 60 or not 0 <= minute <= MINUTES_PER_DAY:
+        raise ValueError("Invalid time: %r" % s)
+    return minute
+
+
+def parse_moment(s, now=None):
+    """(weekday, minutes past midnight) of `s`, which is 'now', a time
+    of day today, like '14:30', or a weekday and a time, like
+    'Fri 14:30'. Today and now are local time, or `now`, a
+    `time.struct_time`, if given."""
+    if now is None:
+        now = time.localtime()
+    s = s.strip()
+    if s.lower() == 'now':
+        return now.tm_wday, now.tm_hour * 60 + now.tm_min
+    day, _, at = s.rpartition(' ')
+    weekday = parse_weekday(day) if day else now.tm_wday
+    minute = parse_time(at)
+    if minute == MINUTES_PER_DAY:
+        raise ValueError("Invalid time: %r" % at)
+    return weekday, minute
+
+
+class Schedule(object):
+    """When each of `size` rows is open, given [(rowid, weekday, opens,
+    closes)], with times in minutes past midnight.
+
+    A row which closes at or before it opens is open past midnight, into
+    the next day.
+    """
+
+    def __init__(self, size, intervals):
+        self.size = size
+        days = [[] for _ in WEEKDAYS]
+        count = 0
+        for rowid, weekday, opens, closes in intervals:
+            count += 1
+            if closes > opens:
+                days[weekday].append((rowid, opens, closes))
+                continue
+            days[weekday].append((rowid, opens, MINUTES_PER_DAY))
+            if closes:
+                days[(weekday + 1) % 7].append((rowid, 0, closes))
+        self._count = count
+
+        # per weekday, the minute each segment starts at, and a bitmap of
+        # the rows open throughout it
+        self._starts = []
+        self._open = []
+        for entries in days:
+            cuts = set([0])
+            for _, opens, closes in entries:
+                cuts.add(opens)
+                cuts.add(closes)
+            cuts.discard(MINUTES_PER_DAY)
+            starts = sorted(cuts)
+            segments = [Bitmap(size) for _ in starts]
+            for rowid, opens, closes in entries:
+                for i in xrange(bisect_left(starts, opens),
+                                bisect_left(starts, closes)):
+                    segments[i].add(rowid)
+            self._starts.append(starts)
+            self._open.append(segments)
+
+    def __len__(self):
+        return self._count
+
+    def segment(self, weekday, minute):
+        """An id for the stretch of time around `minute` of `weekday`
+        during which the same rows are open"""
+        return weekday, bisect_right(self._starts[weekday], minute) - 1
+
+    def open_at(self, weekday, minute):
+        """A `Bitmap` of the rows open at `minute` past midnight on
+        `weekday`"""
+        weekday, i = self.segment(weekday, minute)
+        return self._open[weekday][i]
@@ -15,6 +15,11 @@ queries are a bit more forgiving. Maybe a venue serves "cupcakes" but
 we searched for "cupcake." Without stemming, our naive index wouldn't
 find "cupcakes," and therefore, we'd miss the venue.
 
+Splitting, dropping stop words and stemming all happen in one place,
+an `Analyzer`, shared by the documents, the queries and the index.
+It remembers the stems of the words it has seen, and gives each stem
+a small integer id, which is what documents and postings are keyed by.
+
 We also keep an inverted index to speed up the query process. The 
 inverted index maps words to documents that contain that word. 
 Therefore, when querying "chocolate cupcakes" we only consider 
@@ -29,39 +34,73 @@ can easily build a KD-Tree (though other types of trees, such as an
 Octree or Quad-tree would work) to eliminate trucks from our search
 that are out of range.
 
+Lat / lon aren't a flat plane, though, and a degree of longitude 
+shrinks the further you get from the equator. So, before they go into
+the tree, points are projected onto 3D earth-centered coordinates. The
+straight line distance through the earth between two points grows with
+the great circle distance between them, which means the tree can prune
+with plain euclidean math and still be exact, anywhere on the planet.
+
 Then, our search for food trucks given a lat, lon, a radius and a 
-text query goes like this:
+text query goes one of two ways, whichever the QueryPlanner thinks 
+is cheaper:
 
   - Use the spatial index to find venues within `radius` of `(lat, lon)`
-  - Perform a text search for `query` limiting the corpus to only those
-    venues returned from the spatial query.
-  - Order by distance.
-
-One can make this ordering better by considering the relevance of the
-text query. However, given that we're not considering other important
-parameters such as where a word appears in the document (it's likely
-that words appearing earlier in the document are more relevant), or
-whether or not all the words in the query appear together (e.g. 
-"chocolate cupcakes" vs. "chocolate" or "cupcakes"). Thus, our 
-relevance metric is rather naive, and we opt only to order via distance.
+    and score only those venues against `query`, or
+  - Find the venues containing a word in `query` from the inverted 
+    index, and check how far away each of them is.
+
+Without a query, the results are ordered by distance, closest first.
+With one, they're ordered by relevance, most relevant first, and it's
+only each page of them that the API orders by distance.
+
+The relevance metric is rather naive. It doesn't consider where a word
+appears in the document (it's likely that words appearing earlier in
+the document are more relevant), or whether or not all the words in
+the query appear together (e.g. "chocolate cupcakes" vs. "chocolate"
+or "cupcakes"), which is why a page, once chosen, is still shown
+closest first.
 
 """
 
+from array import array
+from bisect import bisect_left, bisect_right
 from collections import defaultdict
+from itertools import chain, izip
 from stemming.porter2 import stem
 
+from stats import stage, count, counting
+
 import re
 import math
 import heapq
+import random
+import threading
+
 
+INFINITY = float('inf')
 
-# At 40 deg north or south the distance between a degree of 
-# longitude is 53 miles. Latitude varies ~68 - 69 miles
+# How far down the spatial index looks when estimating how many nodes
+# a search would find. At most 2 ** ESTIMATE_DEPTH subtrees are looked at.
+ESTIMATE_DEPTH = 8
 
-# XXX: I should have just done it for real.
-SAN_FRANCISCO_LONGITUDE_MILEAGE = 53
-SAN_FRANCISCO_LATITUDE_MILEAGE = 69
-ESTIMATE_PER_UNIT_DISTANCE_MILES = (69 + 53) / 2.0
+# How many random draws `SpatialIndex.sample` makes per result, before
+# giving up on drawing and going through everything in range instead.
+SAMPLE_TRIES = 32
+
+# The biggest subtree on the edge of a search `SpatialIndex.sample`
+# draws from as a whole, rather than splitting it any further.
+SAMPLE_LEAF = 16
+
+# Postings are stored in blocks of 2 ** POSTINGS_SHIFT documents.
+POSTINGS_SHIFT = 7
+POSTINGS_BLOCK = 1 << POSTINGS_SHIFT
+
+# The array types postings are narrowed to, smallest first.
+WIDTHS = 'BHIL'
+
+# Mean radius of the earth, which is close enough for a sphere.
+EARTH_RADIUS_MILES = 3958.7613
 
 
 STOP_WORDS = set([
@@ -81,19 +120,111 @@ STOP_WORDS = set([
 ])
 
 
+WORD_SEPARATORS = re.compile("[^a-zA-Z0-9-]+")
+
+
 def word_splitter(s):
     if isinstance(s, list):
         return s
-    return filter(None, map(lambda x: x.strip().lower(),
-                            re.split("[^a-zA-Z0-9-]+", s)))
+    return filter(None, WORD_SEPARATORS.split(s.lower()))
+
+
+class Analyzer(object):
+    """Turns text into terms: splits it into words, drops the stop
+    words and stems the rest.
+
+    Stemming is the expensive part, and the same few thousand words come
+    up over and over, so the stem of each word is memoized. The memo is
+    bounded by `memo_size`, and simply starts over once it fills up.
+
+    Each stem is interned as an integer term id the first time a
+    document has it. Queries only look ids up, so words no document
+    has stay stems, and don't grow the dictionary.
+    """
+
+    MEMO_SIZE = 65536
+
+    def __init__(self, stop_words=STOP_WORDS, memo_size=MEMO_SIZE):
+        self.stop_words = stop_words
+        self.memo_size = memo_size
+        self._memo = {}
+        self._ids = {}
+        self._terms = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._terms)
+
+    def stem(self, word):
+        """The stem of the (lowercase) `word`"""
+        memo = self._memo
+        s = memo.get(word)
+        if s is None:
+            if len(memo) >= self.memo_size:
+                memo.clear()
+            s = memo[word] = stem(word)
+        return s
+
+    def intern(self, term):
+        """The id of the stem `term`, giving it one if it has none"""
+        i = self._ids.get(term)
+        if i is None:
+            with self._lock:
+                i = self._ids.get(term)
+                if i is None:
+                    i = self._ids[term] = len(self._terms)
+                    self._terms.append(term)
+        return i
+
+    def term_id(self, term):
+        """The id of the stem `term`, or None"""
+        return self._ids.get(term)
+
+    def term(self, t):
+        """The stem for the term `t`, an id or a stem without one"""
+        if isinstance(t, basestring):
+            return t
+        return self._terms[t]
+
+    def lookup(self, word):
+        """The term `word` counts under: its id, or None"""
+        return self._ids.get(self.stem(word.lower()))
+
+    def terms(self, text, intern=True):
+        """The terms in `text` (a string, or a list of lowercase words),
+        in order. Stems without an id are interned when `intern` is set,
+        and otherwise stay stems."""
+        stop_words = self.stop_words
+        stems = [self.stem(w) for w in word_splitter(text)
+                 if w not in stop_words]
+        if intern:
+            return map(self.intern, stems)
+        ids = self._ids
+        return [ids.get(s, s) for s in stems]
+
+
+ANALYZER = Analyzer()
+
+
+def tf_norm(max_freq):
+    """What a term's frequency is scaled by in a document whose most
+    frequent term appears `max_freq` times"""
+    return .5 / (max_freq or 1)
+
+
+def augmented_tf(freq, max_freq):
+    """Term frequency, normalized by the most frequent term in the
+    document so long documents don't win just by being long."""
+    return .5 + freq * tf_norm(max_freq)
 
 
 def fdot_product(d1, d2):
     """Computes the dot product of d1 and d2 using word frequencies
     as the vector components"""
     n = 0
+    frequencies = d2._frequencies
     for w, f1 in d1._frequencies.iteritems():
-        f2 = d2.freq(w)
+        f2 = frequencies.get(w, 0)
         n += f2 * f1
 
     return n
@@ -110,14 +241,17 @@ def mk_tfidf_dot(docindex):
     A simpler way to get similar results would be to remove the most common
     words, or to use a "stop list" which is a predetermined list of common
     words. We opt for a stop list, and TF-IDF for our computation.
+
+    This isn't quite what `DocumentIndex.query` computes from its
+    postings by default. The postings only count the query terms a
+    document has, where here a term the document lacks still gets the
+    augmented tf's floor of .5, so the scores differ, and rankings can
+    too. This is kept around for scoring arbitrary pairs of documents.
     """
     def tf(w, d):
-        return .5 + (.5 * d.freq(w)) / (d.max_freq or 1)
+        return augmented_tf(d._frequencies.get(w, 0), d.max_freq)
 
-    def idf(w):
-        dfreq = docindex.doc_freq(w) or 1
-        ndocs = len(docindex)
-        return math.log(ndocs / dfreq)
+    idf = docindex.idf
 
     def fdot_product(d1, d2):
         n = 0
@@ -140,12 +274,17 @@ class Document(object):
 
     Each document gets a `key` which is some external identifier used
     to retrieve the real data associated with the this representation.
+
+    Words are counted under the term ids `analyzer` gives them.
     """
 
-    def __init__(self, key, words):
+    # whether new stems get ids, or (for queries) stay stems
+    INTERN = True
+
+    def __init__(self, key, words, analyzer=ANALYZER):
         self._key = key
-        words = filter(lambda x: x not in STOP_WORDS, word_splitter(words))
-        words = map(stem, words)
+        self._analyzer = analyzer
+        words = analyzer.terms(words, self.INTERN)
         self._frequencies = self._compute_frequencies(words)
         self._total_word_count = len(words)
         
@@ -157,7 +296,7 @@ class Document(object):
         return self._key
 
     def freq(self, w, default=0):
-        return self._frequencies.get(stem(w.lower()), default)
+        return self._frequencies.get(self._analyzer.lookup(w), default)
 
     @property
     def max_freq(self):
@@ -178,89 +317,1417 @@ class Query(Document):
     """Represents a query, which is just a Document without a key
     """
 
-    def __init__(self, s):
-        super(Query, self).__init__(s, word_splitter(s))
+    INTERN = False
+
+    def __init__(self, s, analyzer=ANALYZER):
+        super(Query, self).__init__(s, s, analyzer)
+
+    def terms(self):
+        """The query's stems, sorted"""
+        return sorted(self._analyzer.term(t) for t in self._frequencies)
+
+
+def _prefixed(prefix, arrays):
+    return dict((prefix + name, a) for name, a in arrays.iteritems())
+
+
+def key_table(keys):
+    """Stores `keys` compactly: in an `array('l')` if they're all
+    integers (like row ids), otherwise in a list."""
+    keys = list(keys)
+    if all(isinstance(k, (int, long)) for k in keys):
+        return array('l', keys)
+    return keys
+
+
+class KeyMap(object):
+    """Maps the keys in a key table back to their positions in it.
+
+    When the keys are row ids, each appearing once, this is just the
+    inverse permutation in an `array('l')`. Other keys, which aren't
+    necessarily unique, go in a dict of lists.
+    """
+
+    __slots__ = ('_inverse', '_positions',)
+
+    def __init__(self, keys):
+        n = len(keys)
+        self._inverse = None
+        self._positions = None
+        if isinstance(keys, array):
+            inverse = array('l', [-1]) * n
+            for i, k in enumerate(keys):
+                if not 0 <= k < n or inverse[k] != -1:
+                    break
+                inverse[k] = i
+            else:
+                self._inverse = inverse
+                return
+
+        self._positions = defaultdict(list)
+        for i, k in enumerate(keys):
+            self._positions[k].append(i)
+        self._positions = dict(self._positions)
+
+    def _dump(self):
+        if self._inverse is not None:
+            return {'positions': None}, {'inverse': self._inverse}
+        return {'positions': self._positions}, {}
+
+    @classmethod
+    def _restore(cls, meta, reader):
+        keymap = cls.__new__(cls)
+        keymap._positions = meta['positions']
+        keymap._inverse = None
+        if keymap._positions is None:
+            keymap._inverse = reader.view('inverse')
+        return keymap
+
+    def get(self, key):
+        """Returns the positions holding `key`"""
+        inverse = self._inverse
+        if inverse is not None:
+            if isinstance(key, (int, long)) and 0 <= key < len(inverse) \
+                    and inverse[key] != -1:
+                return (inverse[key],)
+            return ()
+        return self._positions.get(key, ())
+
+    def positions(self, keys):
+        """Returns the set of positions holding any of `keys`"""
+        found = set()
+        inverse = self._inverse
+        if inverse is not None:
+            n = len(inverse)
+            found.update(inverse[k] for k in keys
+                         if isinstance(k, (int, long)) and 0 <= k < n)
+            found.discard(-1)
+        else:
+            for k in keys:
+                found.update(self._positions.get(k, ()))
+        return found
+
+
+    def add(self, key, position):
+        """Records that `key` is (also) at `position`"""
+        inverse = self._inverse
+        if inverse is not None:
+            if isinstance(key, (int, long)) and key >= 0 and \
+                    (key >= len(inverse) or inverse[key] == -1):
+                if not isinstance(inverse, array):
+                    inverse = self._inverse = array('l', inverse)
+                if key >= len(inverse):
+                    inverse.extend([-1] * (key + 1 - len(inverse)))
+                inverse[key] = position
+                return
+            # not a permutation anymore
+            self._positions = defaultdict(list)
+            for k, i in enumerate(inverse):
+                if i != -1:
+                    self._positions[k].append(i)
+            self._positions = dict(self._positions)
+            self._inverse = None
+        self._positions.setdefault(key, []).append(position)
+
+    def discard(self, key, position):
+        """Forgets that `key` is at `position`"""
+        inverse = self._inverse
+        if inverse is not None:
+            if self.get(key) == (position,):
+                if not isinstance(inverse, array):
+                    inverse = self._inverse = array('l', inverse)
+                inverse[key] = -1
+            return
+        positions = self._positions.get(key)
+        if positions and position in positions:
+            positions.remove(position)
+            if not positions:
+                del self._positions[key]
+
+
+class TopK(object):
+    """Keeps the `k` lowest ranked items pushed into it.
+
+    Items are integer ids, and ties in rank go to the lower id, so the
+    same `k` come out no matter what order they went in.
+
+    The kept items live in a bounded max-heap, so the worst of them is
+    always at hand as `threshold`. Anything that doesn't rank better
+    than the threshold is turned away without touching the heap, and
+    callers can use the threshold to skip work that can't produce a
+    better item.
+    """
+
+    __slots__ = ('k', '_heap',)
+
+    def __init__(self, k):
+        self.k = k
+        self._heap = []
+
+    def __len__(self):
+        return len(self._heap)
+
+    @property
+    def full(self):
+        return len(self._heap) >= self.k
+
+    @property
+    def threshold(self):
+        """Items must rank no higher than this to get in"""
+        if len(self._heap) < self.k:
+            return INFINITY
+        if not self._heap:
+            return -INFINITY
+        return -self._heap[0][0]
+
+    def push(self, rank, item):
+        """Offers `item`, returning whether it was kept"""
+        heap = self._heap
+        if len(heap) < self.k:
+            heapq.heappush(heap, (-rank, -item))
+            return True
+        if self.k and (-rank, -item) > heap[0]:
+            heapq.heapreplace(heap, (-rank, -item))
+            return True
+        return False
+
+    def extend(self, pairs):
+        """Offers every (rank, item) in `pairs` at once"""
+        heap = [(-rank, -item) for rank, item in
+                heapq.nsmallest(self.k, chain(self.results(), pairs))]
+        heapq.heapify(heap)
+        self._heap = heap
+
+    def results(self):
+        """Returns [(rank, item)], lowest rank first"""
+        return sorted((-rank, -item) for rank, item in self._heap)
+
+
+class KeysIn(object):
+    """The document ids whose keys, in `keys`, are in `allowed`"""
+
+    __slots__ = ('keys', 'allowed',)
+
+    def __init__(self, keys, allowed):
+        self.keys = keys
+        self.allowed = allowed
+
+    def __contains__(self, i):
+        return self.keys[i] in self.allowed
+
+
+_LIMITS = dict((code, 1 << 8 * array(code).itemsize) for code in WIDTHS)
+
+
+def _narrowest(values):
+    """`values`, none of them negative, in the narrowest array that
+    holds them all"""
+    top = max(values) if len(values) else 0
+    for code in WIDTHS:
+        if top < _LIMITS[code]:
+            return array(code, values)
+    raise OverflowError("%d doesn't fit in any array" % top)
+
+
+def _appended(values, value):
+    """Appends `value` to the array `values`, widening the array first if
+    it's too narrow to hold it. Returns the array."""
+    if value >= _LIMITS[values.typecode]:
+        values = _narrowest(list(values) + [value])
+    else:
+        values.append(value)
+    return values
+
+
+def _typecode(values):
+    """The typecode of an array, or of a snapshot's ctypes view"""
+    if isinstance(values, array):
+        return values.typecode
+    return values._type_._type_
+
+
+class Postings(object):
+    """The documents a term appears in, and how often it appears in each.
+
+    Document ids are in increasing order, in blocks of `POSTINGS_BLOCK`.
+    The first id of each block goes in `bases`, which doubles as a list
+    of skip pointers, and every id is stored in `offsets` as how far it
+    is past the first id of its block. `freqs` holds the term frequency
+    in each document, lined up with `offsets`. Both are kept in the
+    narrowest array type that holds them, which for the dense blocks of
+    a common term is a byte per document.
+
+    Finding a document is a binary search of `bases` for its block and
+    then of the block's offsets, so lookups and intersections only
+    decode the ids they land on.
+    """
+
+    __slots__ = ('bases', 'offsets', 'freqs', 'max_weight',)
+
+    def __init__(self, bases=None, offsets=None, freqs=None,
+                 max_weight=0.0):
+        self.bases = array('l') if bases is None else bases
+        self.offsets = array(WIDTHS[0]) if offsets is None else offsets
+        self.freqs = array(WIDTHS[0]) if freqs is None else freqs
+        self.max_weight = max_weight
+
+    @classmethod
+    def encode(cls, docs, freqs, max_weight=0.0):
+        """Postings for the increasing document ids `docs`, which the
+        term appears in `freqs` times"""
+        mask = ~(POSTINGS_BLOCK - 1)
+        offsets = [i - docs[p & mask] for p, i in enumerate(docs)]
+        return cls(array('l', docs[::POSTINGS_BLOCK]), _narrowest(offsets),
+                   _narrowest(freqs), max_weight)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def doc(self, p):
+        """The id of the document at position `p`"""
+        return self.bases[p >> POSTINGS_SHIFT] + self.offsets[p]
+
+    def docs(self):
+        """All of the document ids, decoded"""
+        ids = []
+        offsets = self.offsets
+        for b, base in enumerate(self.bases):
+            start = b << POSTINGS_SHIFT
+            ids.extend([base + d for d in
+                        offsets[start:start + POSTINGS_BLOCK]])
+        return ids
+
+    def items(self):
+        """Yields (document id, term frequency)"""
+        return izip(self.docs(), self.freqs)
+
+    def seek(self, i, lo=0, hi=None):
+        """The position of the first document from position `lo` on
+        (and before `hi`) whose id is at least `i`, or `hi` if none is"""
+        if hi is None:
+            hi = len(self.offsets)
+        if lo >= hi:
+            return hi
+        bases = self.bases
+        first = lo >> POSTINGS_SHIFT
+        b = bisect_right(bases, i, first,
+                         ((hi - 1) >> POSTINGS_SHIFT) + 1) - 1
+        if b < first:
+            return lo
+        return bisect_left(self.offsets, i - bases[b],
+                           max(lo, b << POSTINGS_SHIFT),
+                           min(hi, (b + 1) << POSTINGS_SHIFT))
+
+    def find(self, i):
+        """The position of the document `i`, or None"""
+        p = self.seek(i)
+        if p < len(self.offsets) and self.doc(p) == i:
+            return p
+        return None
+
+    def _writable(self):
+        """Makes sure the arrays (say, mapped from a snapshot) can be
+        changed"""
+        if not isinstance(self.offsets, array):
+            self.bases = array('l', self.bases)
+            self.offsets = array(_typecode(self.offsets), self.offsets)
+            self.freqs = array(_typecode(self.freqs), self.freqs)
+
+    def append(self, i, freq):
+        """Adds the document `i`, which must come after all the others"""
+        self._writable()
+        if len(self.offsets) % POSTINGS_BLOCK:
+            offset = i - self.bases[-1]
+        else:
+            self.bases.append(i)
+            offset = 0
+        self.offsets = _appended(self.offsets, offset)
+        self.freqs = _appended(self.freqs, freq)
+
+    def remove(self, i):
+        """Removes the document `i`, returning whether it was there.
+        Everything after it moves up a place, so its blocks are encoded
+        again."""
+        p = self.find(i)
+        if p is None:
+            return False
+        docs = self.docs()
+        freqs = list(self.freqs)
+        del docs[p]
+        del freqs[p]
+        encoded = self.encode(docs, freqs)
+        self.bases = encoded.bases
+        self.offsets = encoded.offsets
+        self.freqs = encoded.freqs
+        return True
 
 
 class DocumentIndex(object):
     """A box of documents, which can be queried. 
 
+    Every document gets an integer id, which is its position in
+    `documents`. At build time, each (stemmed) term gets a `Postings`
+    list holding the frequency of the term in every document it appears
+    in, along with its inverse document frequency. Each document's
+    `tf_norm` is kept alongside, to turn those into augmented term
+    frequencies. Scoring a query is then a single pass over the postings
+    of its terms, with nothing to stem or recount.
+
+    Documents can be `add`ed and `remove`d afterwards. A new document
+    gets the next id, so it goes on the end of each of its terms'
+    postings. Inverse document frequencies depend on how many documents
+    there are, so they're worked out again as queries need them.
     """
 
-    def __init__(self, documents):
+    # below this many postings, skipping costs more than it saves
+    MAXSCORE_POSTINGS = 4096
+
+    def __init__(self, documents, analyzer=ANALYZER):
+        self.analyzer = analyzer
         self._documents = documents
-        self._inverted_index = defaultdict(set)
+        self._size = len(documents)
+        self._keys = key_table(d.key for d in documents)
+        self._ids = KeyMap(self._keys)
+        self._norms = array('d', (tf_norm(d.max_freq) for d in documents))
+        # documents don't keep their words, so there's no telling
+        self._forms = None
+        self._set_postings(self._build_postings(documents))
+
+    @classmethod
+    def from_postings(cls, keys, norms, postings, analyzer=ANALYZER,
+                      forms=None):
+        """An index of documents which have already been broken down:
+        the key of each, its `tf_norm`, and the `Postings` of every term
+        id. Like one restored from a snapshot, it only has its postings
+        to score queries with.
+
+        `forms`, if given, maps term ids to the word each is suggested
+        as (see `surface_forms`)."""
+        index = cls.__new__(cls)
+        index.analyzer = analyzer
+        index._documents = None
+        index._size = len(keys)
+        index._keys = key_table(keys)
+        index._ids = KeyMap(index._keys)
+        index._norms = norms
+        index._forms = forms
+        index._set_postings(postings)
+        return index
+
+    def _set_postings(self, postings):
+        self._inverted_index = postings
         # how many documents is `w` in?
-        self._document_frequencies = self._rollup_frequencies(documents)
-
+        self._document_frequencies = dict(
+            (w, len(p)) for w, p in postings.iteritems())
+        self._idf = dict((w, self._compute_idf(df))
+                         for w, df in self._document_frequencies.iteritems())
 
     def doc_freq(self, w, default=1):
-        return self._document_frequencies.get(stem(w.lower()), default)
+        return self._document_frequencies.get(self.analyzer.lookup(w),
+                                              default)
+
+    def idf(self, term):
+        """Inverse document frequency of the term (id) `term`"""
+        idf = self._idf.get(term)
+        if idf is None:
+            df = self._document_frequencies.get(term)
+            idf = self._compute_idf(df or 1)
+            if df:
+                self._idf[term] = idf
+        return idf
 
     def __len__(self):
-        return len(self._documents)
+        return self._size
+
+    def __contains__(self, key):
+        """Is there a document keyed `key`?"""
+        return bool(self._ids.get(key))
+
+    def _compute_idf(self, df):
+        return math.log(float(self._size) / (df or 1))
+
+    def _build_postings(self, documents):
+        docs = defaultdict(list)
+        freqs = defaultdict(list)
+        max_weights = defaultdict(float)
+        for i, d in enumerate(documents):
+            max_freq = d.max_freq
+            for w, f in d._frequencies.iteritems():
+                docs[w].append(i)
+                freqs[w].append(f)
+                weight = augmented_tf(f, max_freq)
+                if weight > max_weights[w]:
+                    max_weights[w] = weight
+        return dict((w, Postings.encode(ids, freqs[w], max_weights[w]))
+                    for w, ids in docs.iteritems())
+
+    def add(self, doc):
+        """Adds `doc`, returning its id"""
+        i = len(self._keys)
+        keys = self._keys
+        if not isinstance(keys, list) and \
+                not (isinstance(keys, array) and
+                     isinstance(doc.key, (int, long))):
+            keys = self._keys = key_table(chain(keys, [doc.key]))
+        else:
+            keys.append(doc.key)
+        self._ids.add(doc.key, i)
+        if self._documents is not None:
+            self._documents.append(doc)
+        if not isinstance(self._norms, array):
+            self._norms = array('d', self._norms)
+        max_freq = doc.max_freq
+        self._norms.append(tf_norm(max_freq))
+
+        index = self._inverted_index
+        for w, f in doc._frequencies.iteritems():
+            weight = augmented_tf(f, max_freq)
+            postings = index.get(w)
+            if postings is None:
+                postings = index[w] = Postings()
+            postings.append(i, f)
+            if weight > postings.max_weight:
+                postings.max_weight = weight
+            self._document_frequencies[w] = len(postings)
+
+        self._size += 1
+        self._idf = {}
+        return i
+
+    def remove(self, doc):
+        """Removes the document(s) keyed `doc.key`, returning how many
+        there were.
+
+        Only the postings of the terms in `doc` are looked at, so it
+        should have the same text as when it was added.
+        """
+        ids = tuple(self._ids.get(doc.key))
+        index = self._inverted_index
+        for i in ids:
+            for w in doc._frequencies:
+                postings = index.get(w)
+                # max_weight is left alone, as it's still an upper bound
+                if postings is None or not postings.remove(i):
+                    continue
+                if postings:
+                    self._document_frequencies[w] = len(postings)
+                else:
+                    del index[w]
+                    del self._document_frequencies[w]
+            self._ids.discard(doc.key, i)
+            if self._documents is not None:
+                self._documents[i] = None
+
+        self._size -= len(ids)
+        if ids:
+            self._idf = {}
+        return len(ids)
+
+    def postings_count(self, doc):
+        """How many postings answering `doc` would have to look at"""
+        index = self._inverted_index
+        return sum(len(index[w]) for w in doc._frequencies if w in index)
+
+    def matches(self, doc, key):
+        """Does the document `key` contain any of the words in `doc`?"""
+        ids = self._ids.get(key)
+        if not ids:
+            return False
+        for w in doc._frequencies:
+            postings = self._inverted_index.get(w)
+            if postings is None:
+                continue
+            for i in ids:
+                if postings.find(i) is not None:
+                    return True
+        return False
+
+    def _candidate_ids(self, doc):
+        """The ids of every document containing a word in `doc`"""
+        ids = set()
+        for w in doc._frequencies:
+            postings = self._inverted_index.get(w)
+            if postings is not None:
+                ids.update(postings.docs())
+                count('postings', len(postings))
+        return ids
+
+    def _allowed_ids(self, keys):
+        if keys is None:
+            return None
+        return self._ids.positions(keys)
+
+    def _filtered_ids(self, ids, allowed):
+        """Narrows `ids` (all of them, if None) to those whose keys are
+        in `allowed`"""
+        if allowed is None:
+            return ids
+        keys = self._keys
+        if ids is None:
+            return KeysIn(keys, allowed)
+        return set(i for i in ids if keys[i] in allowed)
+
+    def _top_documents(self, doc, top, allowed=None):
+        """Pushes the TF-IDF dot product of `doc` against every document
+        sharing a term with it into `top`, ranked by negated score.
+
+        Short postings are simply accumulated a term at a time. Once
+        there are more than `MAXSCORE_POSTINGS` of them to get through,
+        they're walked a document at a time, MaxScore style, instead. Each
+        query term's upper bound is its query weight times the largest
+        weight in its postings. Once `top` is full, the terms whose
+        bounds sum to less than its threshold can't lift a document
+        in on their own, so they stop producing candidates and are only
+        probed (by binary search) for documents the other terms found,
+        and only while the document still has a chance.
+        """
+        terms = []
+        max_freq = doc.max_freq
+        for w, f in doc._frequencies.iteritems():
+            postings = self._inverted_index.get(w)
+            if postings is not None:
+                qw = augmented_tf(f, max_freq) * self.idf(w)
+                terms.append((qw * postings.max_weight, qw, postings))
+        if not terms:
+            return top
+
+        norms = self._norms
+        postings = sum(len(t[2]) for t in terms)
+        if postings <= self.MAXSCORE_POSTINGS:
+            scores = {}
+            get = scores.get
+            for _, qw, term in terms:
+                for i, f in term.items():
+                    scores[i] = get(i, 0.0) + qw * (.5 + f * norms[i])
+            count('postings', postings)
+            count('candidates', len(scores))
+            top.extend((-score, i) for i, score in scores.iteritems()
+                       if allowed is None or i in allowed)
+            return top
+
+        terms.sort(key=lambda t: t[0])
+        m = len(terms)
+        bounds = []
+        total = 0.0
+        for t in terms:
+            total += t[0]
+            bounds.append(total)
+        qws = [t[1] for t in terms]
+        postings_of = [t[2] for t in terms]
+        bases_of = [p.bases for p in postings_of]
+        offsets_of = [p.offsets for p in postings_of]
+        freqs_of = [p.freqs for p in postings_of]
+        ends = [len(p) for p in postings_of]
+
+        # the document each term's cursor is on, or past the end of the
+        # ids once its postings run out.
+        exhausted = len(self._keys)
+        positions = [0] * m
+        current = [p.doc(0) for p in postings_of]
+
+        threshold = -top.threshold
+        essential = 0
+        while essential < m and bounds[essential] < threshold:
+            essential += 1
+
+        candidates = 0
+        while essential < m:
+            candidate = min(current[essential:])
+            if candidate == exhausted:
+                break
+            candidates += 1
+            norm = norms[candidate]
+
+            score = 0.0
+            for i in xrange(essential, m):
+                if current[i] == candidate:
+                    p = positions[i]
+                    score += qws[i] * (.5 + freqs_of[i][p] * norm)
+                    p += 1
+                    positions[i] = p
+                    if p < ends[i]:
+                        current[i] = (bases_of[i][p >> POSTINGS_SHIFT] +
+                                      offsets_of[i][p])
+                    else:
+                        current[i] = exhausted
+
+            if allowed is not None and candidate not in allowed:
+                continue
+
+            for i in xrange(essential - 1, -1, -1):
+                if score + bounds[i] < threshold:
+                    break
+                # Postings.seek, inlined
+                p = positions[i]
+                first = p >> POSTINGS_SHIFT
+                bases = bases_of[i]
+                b = bisect_right(bases, candidate, first) - 1
+                if b >= first:
+                    start = b << POSTINGS_SHIFT
+                    p = bisect_left(offsets_of[i], candidate - bases[b],
+                                    p if p > start else start,
+                                    min(ends[i], start + POSTINGS_BLOCK))
+                    positions[i] = p
+                if p < ends[i] and candidate == \
+                        bases[p >> POSTINGS_SHIFT] + offsets_of[i][p]:
+                    score += qws[i] * (.5 + freqs_of[i][p] * norm)
+            else:
+                if top.push(-score, candidate):
+                    threshold = -top.threshold
+                    while essential < m and bounds[essential] < threshold:
+                        essential += 1
+
+        count('candidates', candidates)
+        return top
+
+    def _score_documents(self, doc, ids, top):
+        """Pushes the TF-IDF dot product of `doc` against each of the
+        documents `ids` that share a term with it into `top`, ranked by
+        negated score.
+
+        Rather than walking every posting, each document is looked up in
+        each term's postings with `Postings.seek`, which is cheaper when
+        there are far fewer `ids` than postings.
+        """
+        terms = []
+        max_freq = doc.max_freq
+        for w, f in doc._frequencies.iteritems():
+            postings = self._inverted_index.get(w)
+            if postings is not None:
+                terms.append([augmented_tf(f, max_freq) * self.idf(w),
+                              postings, 0, len(postings)])
+        if not terms:
+            return top
+
+        norms = self._norms
+        ids = sorted(ids)
+        count('candidates', len(ids))
+        # in order, so each term's cursor only ever moves forward
+        for i in ids:
+            score = None
+            for term in terms:
+                qw, postings, lo, hi = term
+                p = postings.seek(i, lo, hi)
+                term[2] = p
+                if p < hi and postings.doc(p) == i:
+                    score = (score or 0.0) + \
+                        qw * (.5 + postings.freqs[p] * norms[i])
+            if score is not None:
+                top.push(-score, i)
+        return top
+
+    def _dump(self):
+        """Flattens the index into (meta, {name: array}) for a snapshot.
+
+        Every term's blocks are concatenated into one array of `bases`,
+        with `starts` saying where each term's postings start. Offsets
+        and frequencies go in one array per width (like 'offsets.B'),
+        with `typecodes` giving the widths of each term's. Term ids only
+        mean something to this process's analyzer, so terms are saved
+        as their stems, as are the keys of the surface forms.
+        """
+        stem_of = self.analyzer.term
+        terms = sorted(self._inverted_index, key=stem_of)
+        starts = array('l', [0])
+        bases = array('l')
+        typecodes = []
+        arrays = {}
+        max_weights = {}
+        for w in terms:
+            postings = self._inverted_index[w]
+            bases.extend(postings.bases)
+            for name in ('offsets', 'freqs'):
+                values = getattr(postings, name)
+                code = _typecode(values)
+                typecodes.append(code)
+                arrays.setdefault('%s.%s' % (name, code),
+                                  array(code)).extend(values)
+            starts.append(starts[-1] + len(postings))
+            max_weights[stem_of(w)] = postings.max_weight
+
+        ids_meta, ids_arrays = self._ids._dump()
+        meta = {'size': self._size, 'terms': map(stem_of, terms),
+                'typecodes': ''.join(typecodes),
+                'idf': dict((stem_of(w), idf)
+                            for w, idf in self._idf.iteritems()),
+                'max_weights': max_weights, 'ids': ids_meta,
+                'forms': None}
+        if self._forms is not None:
+            meta['forms'] = dict((stem_of(t), word)
+                                 for t, word in self._forms.iteritems())
+        arrays.update({'starts': starts, 'bases': bases,
+                       'norms': array('d', self._norms)})
+        arrays.update(_prefixed('ids.', ids_arrays))
+        if isinstance(self._keys, array):
+            arrays['keys'] = self._keys
+        else:
+            meta['keys'] = self._keys
+        return meta, arrays
 
-    def _rollup_frequencies(self, documents):
-        f = defaultdict(lambda: 0)
-        for d in documents:
-            for w in d._frequencies:
-                f[w] += 1
-                self._inverted_index[w].add(d)
-        return f
+    @classmethod
+    def _restore(cls, meta, reader):
+        """The inverse of `_dump`, with arrays coming from `reader`.
 
-    def _candidate_documents(self, doc, keys=None):
-        """Return only the documents from the index which actually
-        contain a word in `doc`
+        The original documents aren't part of a snapshot, so a restored
+        index can only score queries with its own postings. Its terms
+        are interned into the shared analyzer as they're read.
+        """
+        index = cls.__new__(cls)
+        analyzer = index.analyzer = ANALYZER
+        intern = analyzer.intern
+        index._documents = None
+        index._size = meta['size']
+        index._idf = dict((intern(w), idf)
+                          for w, idf in meta['idf'].iteritems())
+        index._keys = meta['keys'] if 'keys' in meta else reader.view('keys')
+        index._ids = KeyMap._restore(meta['ids'], reader.scope('ids.'))
+        index._forms = None
+        if meta['forms'] is not None:
+            index._forms = dict((intern(w), word)
+                                for w, word in meta['forms'].iteritems())
+
+        index._norms = reader.view('norms')
+
+        starts = reader.view('starts')
+        typecodes = meta['typecodes']
+        max_weights = meta['max_weights']
+        index._inverted_index = {}
+        index._document_frequencies = {}
+        # where the next term's bases, offsets and freqs are
+        at = defaultdict(int)
+        for i, w in enumerate(meta['terms']):
+            count = starts[i + 1] - starts[i]
+            blocks = (count + POSTINGS_BLOCK - 1) >> POSTINGS_SHIFT
+            views = []
+            for name, size in (('bases', blocks),
+                               ('offsets.' + typecodes[2 * i], count),
+                               ('freqs.' + typecodes[2 * i + 1], count)):
+                views.append(reader.view(name, at[name], size))
+                at[name] += size
+            t = intern(w)
+            index._inverted_index[t] = Postings(*views,
+                                                max_weight=max_weights[w])
+            index._document_frequencies[t] = count
+        return index
+
+    def query(self, doc, max_results=10, distance=None, keys=None,
+              allowed=None):
+        """Finds the `max_results` documents most relevant to `doc`,
+        optionally limited to those with a key in `keys`, and in
+        `allowed`.
+
+        `keys` gets turned into a set of document ids up front, so it
+        should be small. `allowed` is only ever asked whether it holds a
+        key, so it can be anything supporting `in`, like a `Bitmap`.
+
+        Relevance is the TF-IDF dot product, unless a different
+        `distance` function of two documents is given.
+
+        Returns [(1 / relevance, 'key')], most relevant first.
+        """
+        top = TopK(max_results)
+        if distance is None:
+            keys_of = self._keys
+            self._top_documents(doc, top, self._filtered_ids(
+                self._allowed_ids(keys), allowed))
+            return [(-1 / rank if rank else INFINITY, keys_of[i])
+                    for rank, i in top.results()]
+
+        documents = self._documents
+        if documents is None:
+            raise ValueError("scoring with a distance function needs "
+                             "the documents the index was built from")
+        ids = self._candidate_ids(doc)
+        allowed = self._filtered_ids(self._allowed_ids(keys), allowed)
+        for i in ids:
+            if allowed is not None and i not in allowed:
+                continue
+            dist = distance(doc, documents[i])
+            if dist == 0:
+                dist = INFINITY
+            else:
+                dist = 1.0 / dist
+            top.push(dist, i)
 
-        If keys is specified, only check those specified by `keys`"""
+        return [(dist, self._keys[i]) for dist, i in top.results()]
 
-        docs = set()
-        for w in doc._frequencies:
-            if keys:
-                for d in self._inverted_index[w]:
-                    if d.key in keys:
-                        docs.add(d)
-            else:
-                docs.update(self._inverted_index[w])
 
-        return docs
+def _after(prefix):
+    """The smallest string greater than every string starting with
+    `prefix`"""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
 
-    def query(self, doc, max_results=10, distance=fdot_product, keys=None):
-        results = []
 
-        for d in self._candidate_documents(doc, keys=keys):
-            dist = distance(doc, d)
-            if dist == 0:
-                dist = inf
-            else:
-                dist = 1 / dist
-            
-            heapq.heappush(results, (dist, d.key))
-            results = heapq.nsmallest(max_results, results, key=lambda x: x[0])
+class PrefixIndex(object):
+    """Finds the heaviest strings starting with a given prefix, for
+    type-ahead.
 
-        return results
+    Strings are kept lowercased, in one sorted list, so the strings
+    starting with a prefix are a contiguous run found by binary search,
+    which is then scanned for the heaviest. To keep every lookup cheap,
+    prefixes matching more than `SCAN_LIMIT` strings (the short ones)
+    have their top `MAX_SUGGESTIONS` worked out ahead of time.
+    """
 
+    SCAN_LIMIT = 256
+    MAX_SUGGESTIONS = 20
+
+    def __init__(self, weights):
+        """`weights` maps each string to how strongly it's suggested"""
+        merged = {}
+        for s, weight in weights.iteritems():
+            key = s.lower()
+            if key not in merged or merged[key][0] < weight:
+                merged[key] = (weight, s)
+        self._keys = sorted(merged)
+        self._labels = [merged[k][1] for k in self._keys]
+        self._weights = array('d', (merged[k][0] for k in self._keys))
+        self._precomputed = self._precompute()
 
-# HACK: We're dealing in terms of a single city, which means that
-# accuracy is unlikely to be *too* affected by not using something
-# more geographically sound, like great circle distance.
-def euclidean_distance(p1, p2):
-    """Compute the distance between p1 and p2 on a hyperplane"""
-    return math.sqrt(sum(map(lambda x, y: (x-y)**2, p1, p2)))
+    def __len__(self):
+        return len(self._keys)
+
+    def _scan(self, lo, hi, count):
+        top = TopK(count)
+        weights = self._weights
+        for i in xrange(lo, hi):
+            top.push(-weights[i], i)
+        return [self._labels[i] for _, i in top.results()]
+
+    def _precompute(self):
+        """Works out the suggestions for every prefix matching more
+        than `SCAN_LIMIT` strings"""
+        keys = self._keys
+        precomputed = {}
+        if len(keys) > self.SCAN_LIMIT:
+            precomputed[''] = self._scan(0, len(keys), self.MAX_SUGGESTIONS)
+        runs = [(0, len(keys), 0)]
+        while runs:
+            lo, hi, depth = runs.pop()
+            i = lo
+            while i < hi:
+                if len(keys[i]) <= depth:
+                    i += 1
+                    continue
+                prefix = keys[i][:depth + 1]
+                j = bisect_left(keys, _after(prefix), i, hi)
+                if j - i > self.SCAN_LIMIT:
+                    precomputed[prefix] = self._scan(i, j,
+                                                     self.MAX_SUGGESTIONS)
+                    runs.append((i, j, depth + 1))
+                i = j
+        return precomputed
+
+    def suggest(self, prefix, count=10):
+        """The (up to) `count` heaviest strings starting with `prefix`,
+        heaviest first"""
+        prefix = prefix.lower()
+        if count <= self.MAX_SUGGESTIONS and prefix in self._precomputed:
+            return self._precomputed[prefix][:count]
+        keys = self._keys
+        lo = bisect_left(keys, prefix)
+        hi = bisect_left(keys, _after(prefix), lo) if prefix else len(keys)
+        return self._scan(lo, hi, count)
+
+
+def count_words(words, counts, stop_words=STOP_WORDS):
+    """Counts each of `words` (lowercase) which could be suggested
+    into `counts`, a dict of {word: count}"""
+    for word in words:
+        if word not in stop_words and word.isalpha():
+            counts[word] = counts.get(word, 0) + 1
+
+
+def surface_forms(analyzer, counts):
+    """{term id: word} of the word each term is suggested as: of the
+    words in `counts` (from `count_words`) sharing its stem, whichever
+    shows up the most. Stems without an id are left out."""
+    best = {}
+    for word, count in counts.iteritems():
+        t = analyzer.term_id(analyzer.stem(word))
+        if t is not None and (count, word) > best.get(t, (0, '')):
+            best[t] = (count, word)
+    return dict((t, word) for t, (_, word) in best.iteritems())
+
+
+def term_suggestions(docindex, texts=()):
+    """A `PrefixIndex` of the words `docindex` can find, weighted by
+    how many documents they're in.
+
+    Words sharing a stem are suggested once, as whichever form of it
+    shows up the most. An index built by the loader (or restored from
+    a snapshot of one) already knows them. Otherwise, they're counted
+    from `texts`, which costs stemming every word again.
+    """
+    forms = docindex._forms
+    if forms is None:
+        analyzer = docindex.analyzer
+        counts = {}
+        for text in texts:
+            count_words(word_splitter(text), counts, analyzer.stop_words)
+        forms = surface_forms(analyzer, counts)
+
+    weights = {}
+    for t, word in forms.iteritems():
+        df = docindex._document_frequencies.get(t)
+        if df:
+            weights[word] = df
+    return PrefixIndex(weights)
+
+
+class GeodesicProjection(object):
+    """Projects (lat, lon) in degrees onto earth-centered, earth-fixed
+    (ECEF) coordinates on a sphere of `radius`.
+
+    Searching happens on the chord (the straight line through the
+    earth) between two points, which is monotonic in the great circle
+    distance. Converting the chord back into an arc is the haversine
+    formula, so results come back in great circle miles.
+    """
 
+    dimensions = 3
 
-class SpatialNode(object):
-                  
-    __slots__ = ('pt', 'key', 'left', 'right',)
+    def __init__(self, radius=EARTH_RADIUS_MILES):
+        self.radius = radius
 
-    def __init__(self, pt=None, key=None, left=None, right=None):
-        self.pt = pt
-        self.key = key
-        self.left = left
-        self.right = right
+    def project(self, pt):
+        lat, lon = math.radians(pt[0]), math.radians(pt[1])
+        r = self.radius
+        c = math.cos(lat)
+        return (r * c * math.cos(lon), r * c * math.sin(lon),
+                r * math.sin(lat))
+
+    def bound(self, distance):
+        """The chord length of a great circle arc of `distance`"""
+        theta = min(float(distance) / self.radius, math.pi)
+        return 2 * self.radius * math.sin(theta / 2)
+
+    def distance(self, d2):
+        """The great circle distance for a squared chord length"""
+        r = self.radius
+        return 2 * r * math.asin(min(1.0, math.sqrt(d2) / (2 * r)))
+
+
+class PlanarProjection(object):
+    """Leaves points alone, for data that really is on a hyperplane.
+
+    Distances are scaled by `magnitude`.
+    """
+
+    def __init__(self, magnitude=1):
+        self.magnitude = magnitude
+
+    def project(self, pt):
+        return tuple(pt)
+
+    def bound(self, distance):
+        return float(distance) / self.magnitude
+
+    def distance(self, d2):
+        return math.sqrt(d2) * self.magnitude
+
+
+class KDTree(object):
+    """A KD-Tree flattened into parallel arrays.
+
+    Rather than linking node objects together, the points are laid out
+    in "implicit" tree order: the node covering the slots `[lo, hi)` is
+    stored at `(lo + hi) // 2`, its left subtree covers `[lo, mid)` and
+    its right subtree covers `[mid + 1, hi)`. The splitting axis is the
+    depth modulo the number of dimensions, exactly as in the linked
+    version.
+
+    `coords` is a flat `array('d')` holding `k` coordinates per slot,
+    and `keys` is the parallel table of external keys. `lower` and
+    `upper` are the corners of the box bounding every point.
+    """
+
+    __slots__ = ('k', 'coords', 'keys', 'lower', 'upper',)
+
+    def __init__(self, k, coords, keys, lower=None, upper=None):
+        self.k = k
+        self.coords = coords
+        self.keys = keys
+        if lower is None or upper is None:
+            lower = tuple(min(coords[a::k]) if keys else 0.0
+                          for a in range(k))
+            upper = tuple(max(coords[a::k]) if keys else 0.0
+                          for a in range(k))
+        self.lower = lower
+        self.upper = upper
+
+    def __len__(self):
+        return len(self.keys)
+
+    def distance2(self, slot, pt):
+        """Squared distance from the point in `slot` to `pt`"""
+        k = self.k
+        coords = self.coords
+        base = slot * k
+        d2 = 0.0
+        for a in range(k):
+            diff = coords[base + a] - pt[a]
+            d2 += diff * diff
+        return d2
+
+    def count(self, pt, radius, max_depth=None):
+        """Counts the slots within `radius` of `pt`.
+
+        Bounding boxes are narrowed on the way down, so a subtree that
+        lies entirely inside the ball is counted without visiting it,
+        and one entirely outside is skipped. With `max_depth`, subtrees
+        still straddling the edge of the ball at that depth are
+        guessed to be half in, which makes this a cheap estimate.
+        """
+        n = len(self.keys)
+        if not n:
+            return 0
+
+        k = self.k
+        coords = self.coords
+        r2 = radius * radius
+        axes = range(k)
+        total = 0
+
+        stack = [(0, n, 0, list(self.lower), list(self.upper))]
+        while stack:
+            lo, hi, depth, lower, upper = stack.pop()
+
+            near = far = 0.0
+            for a in axes:
+                p = pt[a]
+                if p < lower[a]:
+                    diff = lower[a] - p
+                    near += diff * diff
+                elif p > upper[a]:
+                    diff = p - upper[a]
+                    near += diff * diff
+                diff = max(p - lower[a], upper[a] - p)
+                far += diff * diff
+            if near > r2:
+                continue
+            if far <= r2:
+                total += hi - lo
+                continue
+            if max_depth is not None and depth >= max_depth:
+                total += (hi - lo) / 2.0
+                continue
+
+            mid = (lo + hi) >> 1
+            if self.distance2(mid, pt) <= r2:
+                total += 1
+
+            axis = depth % k
+            split = coords[mid * k + axis]
+            if lo < mid:
+                left = list(upper)
+                left[axis] = split
+                stack.append((lo, mid, depth + 1, lower, left))
+            if mid + 1 < hi:
+                right = list(lower)
+                right[axis] = split
+                stack.append((mid + 1, hi, depth + 1, right, upper))
+
+        return total
+
+    def cover(self, pt, radius, leaf=0):
+        """Covers the slots within `radius` of `pt` with ranges.
+
+        Like `count`, a subtree entirely inside the ball is taken whole,
+        as its one range of slots, without visiting it. Subtrees
+        straddling the edge of the ball are split until they have no
+        more than `leaf` slots, and then taken whole too, so the ranges
+        can hold slots out of range, unless `leaf` is 0. The bigger
+        `leaf`, the fewer nodes are visited.
+
+        Returns [(lo, hi)], covering the slots `[lo, hi)`.
+        """
+        n = len(self.keys)
+        if not n:
+            return []
+
+        k = self.k
+        coords = self.coords
+        r2 = radius * radius
+        axes = range(k)
+        ranges = []
+
+        stack = [(0, n, 0, list(self.lower), list(self.upper))]
+        while stack:
+            lo, hi, depth, lower, upper = stack.pop()
+
+            near = far = 0.0
+            for a in axes:
+                p = pt[a]
+                if p < lower[a]:
+                    diff = lower[a] - p
+                    near += diff * diff
+                elif p > upper[a]:
+                    diff = p - upper[a]
+                    near += diff * diff
+                diff = max(p - lower[a], upper[a] - p)
+                far += diff * diff
+            if near > r2:
+                continue
+            if far <= r2 or hi - lo <= leaf:
+                ranges.append((lo, hi))
+                continue
+
+            mid = (lo + hi) >> 1
+            if self.distance2(mid, pt) <= r2:
+                ranges.append((mid, mid + 1))
+
+            axis = depth % k
+            split = coords[mid * k + axis]
+            if lo < mid:
+                left = list(upper)
+                left[axis] = split
+                stack.append((lo, mid, depth + 1, lower, left))
+            if mid + 1 < hi:
+                right = list(lower)
+                right[axis] = split
+                stack.append((mid + 1, hi, depth + 1, right, upper))
+
+        return ranges
+
+    def within(self, pt, radius, allowed=None):
+        """Finds all slots within `radius` of `pt`, whose keys are in
+        `allowed`, if given.
+
+        Returns [(squared distance, slot)] in no particular order.
+        """
+        found = []
+        keys = self.keys
+        n = len(keys)
+        if not n:
+            return found
+
+        k = self.k
+        coords = self.coords
+        r2 = radius * radius
+        axes = range(k)
+
+        # a flat stack of lo, hi and depth, three ints per subtree. Each
+        # push still builds a short-lived tuple to extend it with, but
+        # there are no node objects, and nothing outlives the walk.
+        stack = []
+        pop = stack.pop
+        push = counting('nodes', stack.extend)
+        push((0, n, 0))
+        while stack:
+            depth = pop()
+            hi = pop()
+            lo = pop()
+
+            mid = (lo + hi) >> 1
+            base = mid * k
+            d2 = 0.0
+            for a in axes:
+                diff = coords[base + a] - pt[a]
+                d2 += diff * diff
+            if d2 <= r2 and (allowed is None or keys[mid] in allowed):
+                found.append((d2, mid))
+
+            axis = depth % k
+            diff = pt[axis] - coords[base + axis]
+            depth += 1
+            # are we within range at the axis level?
+            if lo < mid and diff <= radius:
+                push((lo, mid, depth))
+            if mid + 1 < hi and -diff <= radius:
+                push((mid + 1, hi, depth))
+
+        return found
+
+    def within_many(self, pts, radii, allowed=None):
+        """Finds all slots within `radii[i]` of `pts[i]`, for every
+        `i`, in a single walk of the tree. If `allowed` is given, only
+        slots whose keys are in it are found.
+
+        Each subtree is visited once, carrying along the searches that
+        still reach into it, so the searches share the walk instead of
+        each making their own.
+
+        Returns a list of [(squared distance, slot)] per point, each in
+        no particular order.
+        """
+        found = [[] for _ in pts]
+        keys = self.keys
+        n = len(keys)
+        if not n or not pts:
+            return found
+
+        k = self.k
+        coords = self.coords
+        r2s = [r * r for r in radii]
+        searches = zip(pts, radii, r2s, found)
+
+        stack = []
+        pop = stack.pop
+        push = counting('nodes', stack.append)
+        push((0, n, 0, searches))
+        while stack:
+            lo, hi, depth, active = pop()
+
+            mid = (lo + hi) >> 1
+            base = mid * k
+            node = coords[base:base + k]
+            axis = depth % k
+            split = node[axis]
+            hit = allowed is None or keys[mid] in allowed
+            left, right = [], []
+            for search in active:
+                pt, radius, r2, hits = search
+                d2 = 0.0
+                for c, p in izip(node, pt):
+                    d2 += (c - p) * (c - p)
+                if hit and d2 <= r2:
+                    hits.append((d2, mid))
+
+                diff = pt[axis] - split
+                if diff <= radius:
+                    left.append(search)
+                if -diff <= radius:
+                    right.append(search)
+
+            depth += 1
+            if lo < mid and left:
+                push((lo, mid, depth, left))
+            if mid + 1 < hi and right:
+                push((mid + 1, hi, depth, right))
+
+        return found
+
+    def nearest(self, pt, count, radius=None, allowed=None):
+        """Finds the `count` slots closest to `pt`, optionally no
+        further than `radius` away, and with keys in `allowed`.
+
+        A `TopK` holds the best candidates seen so far. Once it is
+        full, the worst of them defines the search ball, and any subtree
+        whose splitting plane lies outside of that ball is skipped. The
+        ball only ever shrinks as better candidates come in. Slots which
+        aren't `allowed` never become candidates, so never shrink it.
+
+        Returns [(squared distance, slot)], closest first.
+        """
+        keys = self.keys
+        n = len(keys)
+        if not n or count <= 0:
+            return []
+
+        k = self.k
+        coords = self.coords
+        axes = range(k)
+        bound = INFINITY if radius is None else radius * radius
+        best = TopK(count)
+
+        # entries are (lo, hi, depth, squared distance to the subtree's
+        # splitting plane). The far side is pushed first so the near
+        # side is explored, and the ball tightened, before we decide
+        # whether the far side is worth a look.
+        stack = []
+        pop = stack.pop
+        push = counting('nodes', stack.extend)
+        push((0, n, 0, 0.0))
+        while stack:
+            plane = pop()
+            depth = pop()
+            hi = pop()
+            lo = pop()
+            if plane > bound:
+                continue
+
+            mid = (lo + hi) >> 1
+            base = mid * k
+            d2 = 0.0
+            for a in axes:
+                diff = coords[base + a] - pt[a]
+                d2 += diff * diff
+            if d2 <= bound and (allowed is None or keys[mid] in allowed) \
+                    and best.push(d2, mid) and best.full:
+                bound = best.threshold
+
+            axis = depth % k
+            diff = pt[axis] - coords[base + axis]
+            depth += 1
+            far = diff * diff
+            if diff <= 0:
+                if mid + 1 < hi:
+                    push((mid + 1, hi, depth, far))
+                if lo < mid:
+                    push((lo, mid, depth, 0.0))
+            else:
+                if lo < mid:
+                    push((lo, mid, depth, far))
+                if mid + 1 < hi:
+                    push((mid + 1, hi, depth, 0.0))
 
-    def distance(self, pt, func=euclidean_distance):
-        return func(self.pt, pt)
+        return best.results()
+
+
+# From: http://en.wikipedia.org/wiki/Kd-tree
+def kdtree(pts):
+    """Builds a KDTree out of [('key', (x, y, ...)), ...]
+
+    Instead of sorting at every level, every axis is sorted once up
+    front. Each level then takes the median straight out of the list
+    sorted on its own axis, and stable-partitions the other axes around
+    it, which keeps them sorted for the next level down. The whole
+    build is O(k n log n).
+    """
+    keys = []
+    flat = array('d')
+    for key, pt in pts:
+        keys.append(key)
+        flat.extend(pt)
+
+    n = len(keys)
+    if not n:
+        return KDTree(0, flat, key_table(keys), (), ())
+
+    k = len(flat) // n # assumes all points have the same dimension
+    orders = [sorted(xrange(n), key=lambda i, a=a: flat[i * k + a])
+              for a in range(k)]
+
+    placement = [0] * n
+    side = bytearray(n)
+    stack = [(0, 0, orders)]
+    while stack:
+        lo, depth, orders = stack.pop()
+        axis = depth % k
+        ordered = orders[axis]
+        median = len(ordered) // 2
+        pivot = ordered[median]
+        placement[lo + median] = pivot
+
+        left, right = ordered[:median], ordered[median + 1:]
+        if not left and not right:
+            continue
+
+        for i in left:
+            side[i] = 1
+        lefts, rights = [], []
+        for a, order in enumerate(orders):
+            if a == axis:
+                lefts.append(left)
+                rights.append(right)
+            else:
+                lefts.append([i for i in order if side[i] == 1])
+                rights.append([i for i in order
+                               if side[i] == 0 and i != pivot])
+        for i in left:
+            side[i] = 0
+
+        if left:
+            stack.append((lo, depth + 1, lefts))
+        if right:
+            stack.append((lo + median + 1, depth + 1, rights))
+
+    coords = array('d', [0.0]) * (n * k)
+    for slot, i in enumerate(placement):
+        coords[slot * k:(slot + 1) * k] = flat[i * k:(i + 1) * k]
+
+    return KDTree(k, coords, key_table(keys[i] for i in placement))
 
 
 class SpatialIndex(object):
@@ -272,84 +1739,612 @@ class SpatialIndex(object):
        {'key': (lat, lon), ...}
 
     Where `key` is an external way in which to lookup the real value.
+
+    Points are projected once, up front, with `projection`, which
+    defaults to great circle distance in miles. Passing `magnitude`
+    instead treats the points as planar coordinates scaled by it.
+
+    The tree itself is static, so `insert` and `remove` work around it.
+    Removed points are just marked dead. Inserted points go into a few
+    small trees on the side, log-structured: a new point starts a tree
+    of its own, and whenever the newest tree is at least as big as the
+    one before it, the two are rebuilt into one. Each point is rebuilt
+    O(log n) times, and a search looks at O(log n) trees. Once half of
+    the main tree is dead, or the side trees outgrow it, everything is
+    rebuilt into a new main tree with `compact`.
     """
 
-    def __init__(self, locations, magnitude=ESTIMATE_PER_UNIT_DISTANCE_MILES):
+    def __init__(self, locations, magnitude=None, projection=None):
+        if projection is None:
+            if magnitude is None:
+                projection = GeodesicProjection()
+            else:
+                projection = PlanarProjection(magnitude)
+        self.projection = projection
+
         if isinstance(locations, dict):
-            self._tree = self._make_tree(locations.iteritems())
+            locations = locations.iteritems()
+        project = projection.project
+        self._set_tree(self._make_tree((key, project(pt))
+                                       for key, pt in locations))
+
+    def _set_tree(self, tree, slots=None):
+        self._tree = tree
+        self._slots = KeyMap(tree.keys) if slots is None else slots
+        # slots of the main tree which have been removed
+        self._dead = set()
+        # trees of inserted points, biggest first, keyed on serial numbers
+        self._levels = []
+        # serial number -> key and projected point, for live inserts
+        self._serials = {}
+        self._points = {}
+        # key -> serial numbers of its inserted points
+        self._added = {}
+        self._next_serial = 0
+        # removed serial numbers still sitting in a tree in `_levels`
+        self._stale = 0
+
+    def __len__(self):
+        return len(self._tree) - len(self._dead) + len(self._serials)
+
+    def _dump(self):
+        """Flattens the index into (meta, {name: array}) for a snapshot"""
+        tree, slots = self._tree, self._slots
+        if self._dead or self._serials:
+            tree = self._compacted()
+            slots = KeyMap(tree.keys)
+        slots_meta, slots_arrays = slots._dump()
+        meta = {'projection': self.projection, 'k': tree.k,
+                'lower': tree.lower, 'upper': tree.upper,
+                'slots': slots_meta}
+        arrays = {'coords': tree.coords}
+        arrays.update(_prefixed('slots.', slots_arrays))
+        if isinstance(tree.keys, array):
+            arrays['keys'] = tree.keys
         else:
-            self._tree = self._make_tree(locations)
-        self.magnitude = magnitude
+            meta['keys'] = tree.keys
+        return meta, arrays
+
+    @classmethod
+    def _restore(cls, meta, reader):
+        """The inverse of `_dump`, with arrays coming from `reader`"""
+        index = cls.__new__(cls)
+        index.projection = meta['projection']
+        keys = meta['keys'] if 'keys' in meta else reader.view('keys')
+        index._set_tree(KDTree(meta['k'], reader.view('coords'), keys,
+                               meta['lower'], meta['upper']),
+                        KeyMap._restore(meta['slots'],
+                                        reader.scope('slots.')))
+        return index
 
     def _make_tree(self, locations):
         return kdtree(locations)
 
-    def _search(self, pt, within, node, accum, depth=0, 
-                max_results=None, distance=euclidean_distance):
-        if not node:
-            return
-
-        d = distance(pt, node.pt) * self.magnitude
-        if d <= within:
-            heapq.heappush(accum, (d, node.key,))
-
+    def insert(self, key, pt):
+        """Adds a location `pt` for `key`"""
+        serial = self._next_serial
+        self._next_serial += 1
+        projected = tuple(self.projection.project(pt))
+        self._serials[serial] = key
+        self._points[serial] = projected
+        self._added.setdefault(key, []).append(serial)
+
+        levels = self._levels
+        levels.append(kdtree([(serial, projected)]))
+        while len(levels) > 1 and len(levels[-1]) >= len(levels[-2]):
+            newer, older = levels.pop(), levels.pop()
+            merged = [(s, self._points[s])
+                      for s in chain(older.keys, newer.keys)
+                      if s in self._serials]
+            self._stale -= len(older) + len(newer) - len(merged)
+            if merged:
+                levels.append(kdtree(merged))
+
+        if len(self._serials) > len(self._tree) - len(self._dead):
+            self.compact()
+
+    def remove(self, key):
+        """Removes every location of `key`, returning how many there
+        were"""
+        removed = 0
+        dead = self._dead
+        for slot in self._slots.get(key):
+            if slot not in dead:
+                dead.add(slot)
+                removed += 1
+        for serial in self._added.pop(key, ()):
+            del self._serials[serial]
+            del self._points[serial]
+            self._stale += 1
+            removed += 1
+
+        if len(dead) > len(self._tree) // 2:
+            self.compact()
+        return removed
+
+    def _compacted(self):
+        """A single tree of every live point"""
+        tree = self._tree
+        k, coords, keys, dead = tree.k, tree.coords, tree.keys, self._dead
+        live = [(keys[slot], coords[slot * k:(slot + 1) * k])
+                for slot in xrange(len(tree)) if slot not in dead]
+        live.extend((self._serials[s], self._points[s])
+                    for s in sorted(self._serials))
+        return kdtree(live)
+
+    def compact(self):
+        """Rebuilds the main tree out of every live point, leaving
+        nothing dead or on the side"""
+        self._set_tree(self._compacted())
+
+    def _trees(self):
+        return [self._tree] + self._levels
+
+    def _allowed(self, tree, allowed):
+        """`allowed`, a container of keys, in terms of `tree`'s keys"""
+        if allowed is None or tree is self._tree:
+            return allowed
+        # side trees are keyed on serial numbers, and small
+        return set(s for s, key in self._serials.iteritems()
+                   if key in allowed)
+
+    def _live(self, tree, found):
+        """Drops the removed slots from [(d2, slot)] found in `tree`"""
+        if tree is self._tree:
+            dead = self._dead
+            if not dead:
+                return found
+            return [f for f in found if f[1] not in dead]
+        serials, keys = self._serials, tree.keys
+        return [f for f in found if keys[f[1]] in serials]
+
+    def _keyed(self, tree, found):
+        """Turns [(d2, slot)] found in `tree` into [(d2, 'key')]"""
+        keys = tree.keys
+        if tree is self._tree:
+            return [(d2, keys[slot]) for d2, slot in found]
+        serials = self._serials
+        return [(d2, serials[keys[slot]]) for d2, slot in found]
+
+    def _merged(self, runs, max_results=None):
+        """Merges runs of [(d2, 'key')], each closest first, into
+        [(distance, 'key')]"""
+        found = runs[0] if len(runs) == 1 else list(heapq.merge(*runs))
         if max_results:
-#            import pdb; pdb.set_trace()
-            accum = heapq.nsmallest(max_results, accum, 
-                                    key=lambda x: x[0])
-
-        axis = depth % len(pt)
-
-        for child in ('left', 'right'):
-            child = getattr(node, child)
-            if child:
-                # are we within range at the axis level?
-                there = [0] * len(pt)
-                there[axis] = child.pt[axis]
+            found = found[:max_results]
+        distance = self.projection.distance
+        return [(distance(d2), key) for d2, key in found]
 
-                here = [0] * len(pt)
-                here[axis] = pt[axis]
-
-                if distance(there, here) <= within:
-                    accum = self._search(pt, within, child, accum, depth+1,
-                                         max_results=max_results, 
-                                         distance=distance)
-        return accum
+    def _ordered(self, tree, found, max_results=None):
+        found = self._live(tree, found)
+        if max_results:
+            found = heapq.nsmallest(max_results, found)
+        else:
+            found.sort()
+        return self._keyed(tree, found)
 
-    def search(self, pt, within, max_results=None):
+    def search(self, pt, within, max_results=None, allowed=None):
         """Finds and orders all nodes within `within` distance of
-        `pt`
+        `pt`, limited to those with keys in `allowed`, if given
 
         Returns [(distance, 'key')]
         """
-        return self._search(pt, within, self._tree, [], 
-                            max_results=max_results)
-
-
-
-# From: http://en.wikipedia.org/wiki/Kd-tree
-def kdtree(pts, depth=0):
-    if not pts:
-        return None
+        projection = self.projection
+        here = projection.project(pt)
+        radius = projection.bound(within)
+        runs = []
+        for tree in self._trees():
+            found = tree.within(here, radius, self._allowed(tree, allowed))
+            runs.append(self._ordered(tree, found, max_results))
+        return self._merged(runs, max_results)
+
+    def search_many(self, searches, max_results=None, allowed=None):
+        """Runs `search(pt, within, max_results, allowed)` for every
+        (pt, within) in `searches`, sharing a single walk of each tree.
+
+        Returns a list of [(distance, 'key')], one per search.
+        """
+        projection = self.projection
+        pts = [projection.project(pt) for pt, _ in searches]
+        radii = [projection.bound(within) for _, within in searches]
+
+        runs = [[] for _ in searches]
+        for tree in self._trees():
+            for i, found in enumerate(tree.within_many(
+                    pts, radii, self._allowed(tree, allowed))):
+                runs[i].append(self._ordered(tree, found, max_results))
+        return [self._merged(r, max_results) for r in runs]
+
+    def nearest(self, pt, k, within=None, allowed=None):
+        """Finds the `k` nodes closest to `pt`, optionally limited to
+        those within `within` distance of it, and with keys in
+        `allowed`.
+
+        Unlike `search(pt, within, max_results=k)`, which gathers
+        everything in range and then keeps the best `k`, this prunes
+        the tree with the current k-th best distance as it goes.
+
+        Returns [(distance, 'key')], closest first.
+        """
+        projection = self.projection
+        here = projection.project(pt)
+        radius = None if within is None else projection.bound(within)
+
+        runs = []
+        for tree in self._trees():
+            # enough extra to make up for any removed points found
+            dead = len(self._dead) if tree is self._tree else self._stale
+            found = self._live(tree, tree.nearest(
+                here, k + dead, radius, self._allowed(tree, allowed)))
+            runs.append(self._keyed(tree, found[:k]))
+        return self._merged(runs, k)
+
+    def sample(self, pt, within, count=1, accept=None, rng=random):
+        """Picks up to `count` different keys at random from those
+        within `within` distance of `pt`, every location in range being
+        equally likely. If `accept` is given, only keys it returns true
+        for are picked.
+
+        Each tree loosely covers the ball with ranges of slots (see
+        `KDTree.cover`), and slots are drawn uniformly from those, so
+        nothing in range is gathered up. Slots out of range, removed
+        points, and keys `accept` turns down, are just drawn again. If that keeps
+        happening, everything in range is gone through instead, so
+        rare matches are still found.
+
+        Returns [(distance, 'key')], in the order they were picked.
+        """
+        projection = self.projection
+        here = projection.project(pt)
+        radius = projection.bound(within)
+
+        # each range of slots, and the running total of slots up to
+        # and including it
+        ranges, totals = [], []
+        total = 0
+        for tree in self._trees():
+            for lo, hi in tree.cover(here, radius, SAMPLE_LEAF):
+                total += hi - lo
+                ranges.append((tree, lo))
+                totals.append(total)
+        if not total or count <= 0:
+            return []
+
+        main, dead, serials = self._tree, self._dead, self._serials
+        r2 = radius * radius
+
+        def key_of(tree, slot):
+            """The live key in `slot` of `tree`, or None"""
+            if tree is main:
+                return None if slot in dead else tree.keys[slot]
+            return serials.get(tree.keys[slot])
+
+        picked = {}
+        order = []
+
+        def pick(tree, slot):
+            d2 = tree.distance2(slot, here)
+            if d2 > r2:
+                return
+            key = key_of(tree, slot)
+            if key is None or key in picked:
+                return
+            if accept is not None and not accept(key):
+                return
+            picked[key] = d2
+            order.append(key)
+
+        for _ in xrange(count * SAMPLE_TRIES):
+            if len(order) >= count:
+                break
+            drawn = rng.randrange(total)
+            i = bisect_right(totals, drawn)
+            tree, lo = ranges[i]
+            pick(tree, lo + drawn - (totals[i - 1] if i else 0))
+        else:
+            slots = []
+            start = 0
+            for (tree, lo), end in izip(ranges, totals):
+                slots.extend((tree, s) for s in xrange(lo, lo + end - start))
+                start = end
+            rng.shuffle(slots)
+            for tree, slot in slots:
+                if len(order) >= count:
+                    break
+                pick(tree, slot)
+
+        distance = projection.distance
+        return [(distance(picked[key]), key) for key in order]
+
+    def distances(self, pt, keys, within=None):
+        """Finds the distance from `pt` to each of `keys`, dropping
+        those further than `within` away.
+
+        A key with more than one location gets its closest.
+
+        Returns [(distance, 'key')] in the order of `keys`
+        """
+        tree = self._tree
+        projection = self.projection
+        here = projection.project(pt)
+        bound = INFINITY
+        if within is not None:
+            bound = projection.bound(within) ** 2
+
+        found = []
+        distance = projection.distance
+        slots, dead = self._slots, self._dead
+        added, points = self._added, self._points
+        for key in keys:
+            d2 = INFINITY
+            for slot in slots.get(key):
+                if slot not in dead:
+                    d2 = min(d2, tree.distance2(slot, here))
+            for serial in added.get(key, ()):
+                d2 = min(d2, sum((a - b) * (a - b)
+                                 for a, b in izip(points[serial], here)))
+            if d2 <= bound and d2 < INFINITY:
+                found.append((distance(d2), key))
+        return found
+
+    def estimate(self, pt, within, max_depth=ESTIMATE_DEPTH):
+        """Estimates how many nodes are within `within` distance of
+        `pt`, looking no deeper than `max_depth` into each tree."""
+        projection = self.projection
+        here = projection.project(pt)
+        radius = projection.bound(within)
+        return sum(tree.count(here, radius, max_depth=max_depth)
+                   for tree in self._trees())
+
+
+class Plan(object):
+    """One way of answering a search for `query` (optional) within
+    `within` of `pt`. Run it with `execute`, which returns
+    [(distance, 'key')], best first: closest first without a query, and
+    most relevant first with one.
+
+    `costs` holds whatever the planner estimated along the way, and
+    `explain` describes the whole thing in a line, for logging.
+
+    Plans which start with everything in range (`scans_range`) can be
+    handed that, as `in_range`, rather than searching for it themselves.
+
+    If `allowed` is given, only keys in it are found. It's checked as
+    each index is walked, so what isn't allowed is never ranked, scored
+    or distance checked.
+    """
 
-    # realize any iterator so we can index
-    pts = list(pts)
+    scans_range = False
 
-    # Select axis based on depth so that axis cycles through all valid values
-    k = len(pts[0][1]) # assumes all points have the same dimension
-    axis = depth % k
- 
-    # Sort point list and choose median as pivot element
-    pts.sort(key=lambda loc: loc[1][axis])
-    median = len(pts) // 2 # choose median
+    def __init__(self, spatial, text, pt, within, query=None,
+                 max_results=None, costs=None, allowed=None):
+        self.spatial = spatial
+        self.text = text
+        self.pt = pt
+        self.within = within
+        self.query = query
+        self.max_results = max_results
+        self.costs = costs or {}
+        self.allowed = allowed
 
-    loc = pts[median]
-    # Create node and construct subtrees
-    node = SpatialNode(key=loc[0], pt=loc[1])
-    node.left = kdtree(pts[:median], depth + 1)
-    node.right = kdtree(pts[median + 1:], depth + 1)
+    @property
+    def strategy(self):
+        return self.__class__.__name__
+
+    def execute(self, in_range=None):
+        raise NotImplementedError
+
+    def explain(self):
+        bits = ['%s within %gmi of (%g, %g)' % (self.strategy, self.within,
+                                               self.pt[0], self.pt[1])]
+        if self.query is not None:
+            bits.append('terms=%s' % ','.join(self.query.terms()))
+        if self.max_results:
+            bits.append('max_results=%d' % self.max_results)
+        if self.allowed is not None:
+            bits.append('filtered')
+        bits.extend('%s=%g' % kv for kv in sorted(self.costs.iteritems()))
+        return ' '.join(bits)
+
+    def _ranked(self, top, distances):
+        """Turns document ids in `top` back into [(distance, 'key')]"""
+        keys = self.text._keys
+        return [(distances[keys[i]], keys[i]) for _, i in top.results()]
+
+
+class RangeScan(Plan):
+    """Everything in range (or the `max_results` closest of it),
+    straight out of the spatial index"""
+
+    scans_range = True
+
+    def execute(self, in_range=None):
+        if in_range is None:
+            with stage('spatial'):
+                in_range = self.spatial.search(self.pt, self.within,
+                                               self.max_results, self.allowed)
+        return in_range
+
+
+class NearestScan(Plan):
+    """The `max_results` closest, straight out of the spatial index"""
+
+    def execute(self, in_range=None):
+        with stage('spatial'):
+            return self.spatial.nearest(self.pt, self.max_results,
+                                        within=self.within,
+                                        allowed=self.allowed)
+
+
+class SpatialFirst(Plan):
+    """Finds everything in range, then scores each of those documents
+    against the query. Cheap when the radius is small, no matter how
+    common the terms are."""
+
+    scans_range = True
+
+    def execute(self, in_range=None):
+        if in_range is None:
+            with stage('spatial'):
+                in_range = self.spatial.search(self.pt, self.within,
+                                               allowed=self.allowed)
+        distances = {}
+        for d, key in in_range:
+            distances.setdefault(key, d)
+
+        text = self.text
+        with stage('score'):
+            top = text._score_documents(self.query,
+                                        text._allowed_ids(distances),
+                                        TopK(self.max_results))
+        return self._ranked(top, distances)
+
+
+class TextFirst(Plan):
+    """Gathers every document containing a query term from the
+    postings, then checks how far away each of them is. Cheap when the
+    terms are rare, no matter how big the radius is."""
+
+    def execute(self, in_range=None):
+        text = self.text
+        keys = text._keys
+        with stage('gather'):
+            ids = text._candidate_ids(self.query)
+            if self.allowed is not None:
+                allowed = self.allowed
+                ids = [i for i in ids if keys[i] in allowed]
+        with stage('distances'):
+            found = self.spatial.distances(self.pt,
+                                           set(keys[i] for i in ids),
+                                           within=self.within)
+        distances = dict((key, d) for d, key in found)
+
+        with stage('score'):
+            top = text._score_documents(
+                self.query, [i for i in ids if keys[i] in distances],
+                TopK(self.max_results))
+        return self._ranked(top, distances)
+
+
+class QueryPlanner(object):
+    """Picks how to answer a search over a `SpatialIndex` and a
+    `DocumentIndex` built from the same keys.
+
+    Without a text query, only the spatial index is needed. With one,
+    there are two ways to go: drive from the spatial index and score
+    whatever is in range, or drive from the postings and distance check
+    whatever matches. The planner estimates the work for each, using the
+    query terms' document frequencies and the spatial index's estimate
+    of how many nodes are in range, and takes the cheaper one.
+
+    A search can be limited to the keys in `allowed`, a `Bitmap` say.
+    The fewer keys it has, the fewer of what either side turns up go on
+    to be checked against the other.
+    """
 
-    return node
+    def __init__(self, spatial, text):
+        self.spatial = spatial
+        self.text = text
 
+    def plan(self, pt, within, query=None, max_results=None, allowed=None):
+        """Returns a `Plan` for finding `query` (a `Query`) within
+        `within` of `pt`, among the keys in `allowed`, if given.
 
+        If `max_results` is given, the plan stops at that many: the
+        closest without a query, and the most relevant with one.
+        """
+        spatial, text = self.spatial, self.text
+        if query is None:
+            if max_results:
+                return NearestScan(spatial, text, pt, within,
+                                   max_results=max_results, allowed=allowed)
+            return RangeScan(spatial, text, pt, within, allowed=allowed)
+        if max_results is None:
+            max_results = len(text)
+
+        postings = text.postings_count(query)
+        in_range = spatial.estimate(pt, within)
+        terms = len(query._frequencies)
+        costs = {
+            'postings': postings,
+            'in_range': in_range,
+        }
+        selectivity = 1.0
+        if allowed is not None:
+            selectivity = min(1.0, len(allowed) / float(len(spatial) or 1))
+            costs['selectivity'] = selectivity
+        # walk the postings, then distance check what they turned up
+        costs['text_cost'] = postings * (1 + selectivity)
+        # walk the tree, then look each term up in what it turned up
+        costs['spatial_cost'] = in_range * (1 + terms * selectivity)
+
+        if costs['text_cost'] <= costs['spatial_cost']:
+            strategy = TextFirst
+        else:
+            strategy = SpatialFirst
+        return strategy(spatial, text, pt, within, query=query,
+                        max_results=max_results, costs=costs,
+                        allowed=allowed)
+
+    def sample(self, pt, within, query=None, count=1, allowed=None,
+               rng=random):
+        """Picks up to `count` different keys at random, each equally
+        likely, from those within `within` of `pt` which match `query`
+        (a `Query`), and are in `allowed`, if given.
+
+        Normally, keys are drawn straight from the spatial index, and
+        checked against the query as they are. When the query's terms
+        are rarer than locations in range, most draws would miss, so
+        the documents with them are distance checked instead.
+
+        Returns [(distance, 'key')], in no particular order.
+        """
+        spatial, text = self.spatial, self.text
+        if query is not None and \
+                text.postings_count(query) <= spatial.estimate(pt, within):
+            keys = text._keys
+            candidates = set(keys[i] for i in text._candidate_ids(query))
+            if allowed is not None:
+                candidates = [key for key in candidates if key in allowed]
+            found = spatial.distances(pt, candidates, within=within)
+            return rng.sample(found, min(count, len(found)))
+
+        accept = None
+        if query is not None or allowed is not None:
+            def accept(key):
+                return (allowed is None or key in allowed) and \
+                    (query is None or text.matches(query, key))
+        return spatial.sample(pt, within, count, accept, rng)
+
+    def execute_many(self, searches, max_results=None, allowed=None):
+        """Plans and runs every (pt, within, query) in `searches`,
+        among the keys in `allowed`, if given.
+
+        The plans that start from everything in range share a single
+        walk of the spatial index. For the same reason, searches without
+        a query get everything in range rather than a nearest neighbor
+        search of their own.
+
+        Returns [(plan, results)], one per search.
+        """
+        plans = []
+        for pt, within, query in searches:
+            plan = self.plan(pt, within, query, max_results, allowed)
+            if isinstance(plan, NearestScan):
+                plan = RangeScan(self.spatial, self.text, pt, within,
+                                 max_results=max_results, allowed=allowed)
+            plans.append(plan)
+
+        ranged = [p for p in plans if p.scans_range]
+        found = self.spatial.search_many([(p.pt, p.within) for p in ranged],
+                                         allowed=allowed)
+        in_range = dict(izip(map(id, ranged), found))
 
+        results = []
+        for plan in plans:
+            found = in_range.get(id(plan))
+            if found is not None and isinstance(plan, RangeScan) \
+                    and plan.max_results:
+                found = found[:plan.max_results]
+            results.append((plan, plan.execute(found)))
+        return results
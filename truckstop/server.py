@@ -0,0 +1,120 @@
+"""server.py: Serves a WSGI app from a pool of pre-forked workers.
+
+A single gevent process only ever keeps one core busy. To use more,
+the master process binds the listening socket, and forks `workers`
+children which all accept connections on it, and are replaced if they
+die.
+
+Whatever the master has loaded before forking is shared with the
+workers. For the indexes, that sharing only lasts if they live in a
+mapped snapshot (see `snapshot.py`): pages of ordinary Python objects
+get copied into a worker the first time it touches them, since even
+reading an object updates its reference count. Pages of a mapping
+nothing writes to stay shared, so memory stays flat as workers are
+added.
+"""
+
+import errno
+import os
+import signal
+import socket
+import sys
+
+import gevent
+from gevent.pywsgi import WSGIServer
+
+
+BACKLOG = 1024
+
+
+def listener(host, port, backlog=BACKLOG):
+    """A socket listening on `host`:`port`, for the workers to share"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+
+def work(app, sock):
+    """Serves `app` on `sock` until told to stop"""
+    server = WSGIServer(sock, app)
+    gevent.signal_handler(signal.SIGTERM, server.stop)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    server.serve_forever()
+
+
+class PreforkServer(object):
+    """Forks `workers` processes, each serving `app` on `sock`"""
+
+    def __init__(self, app, sock, workers):
+        self.app = app
+        self.sock = sock
+        self.workers = workers
+        self.children = set()
+        self.stopping = False
+
+    def spawn(self):
+        pid = gevent.fork()
+        if pid == 0:
+            status = 0
+            try:
+                work(self.app, self.sock)
+            except:
+                sys.excepthook(*sys.exc_info())
+                status = 1
+            finally:
+                os._exit(status)
+        self.children.add(pid)
+        return pid
+
+    def replace(self):
+        """Replaces every worker with a fresh fork, say, after the
+        master has loaded new indexes.
+
+        Each worker finishes the requests it has in hand, and is forked
+        again as it exits, from whatever the master has by then. New
+        connections wait in the listening socket's backlog meanwhile.
+        """
+        for pid in self.children:
+            self._terminate(pid)
+
+    def _terminate(self, pid):
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError, e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def stop(self, *args):
+        self.stopping = True
+        for pid in self.children:
+            self._terminate(pid)
+
+    def serve_forever(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        for _ in xrange(self.workers):
+            self.spawn()
+
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, 0)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    break
+                raise
+            if pid not in self.children:
+                continue
+            self.children.discard(pid)
+            if not self.stopping:
+                print "Worker %d exited (%d), replacing it" % (pid, status)
+                self.spawn()
+
+
+def serve(app, host, port, workers):
+    """Serves `app` on `host`:`port` from `workers` forked processes"""
+    PreforkServer(app, listener(host, port), workers).serve_forever()
@@ -0,0 +1,271 @@
+"""snapshot.py: Saves built indexes to a file, and maps them back in.
+
+Parsing the CSV, stemming every document and building both indexes
+happens every time the app starts. A snapshot does that work once,
+offline:
+
+    python -m truckstop.snapshot data.csv data.snapshot
+
+and the app can then be started on `data.snapshot` instead of the CSV.
+
+A snapshot file looks like this:
+
+  - An 8 byte magic number, the format version, a CRC32 of everything
+    after this prefix, and the length of the header.
+  - The header: a pickle of each component's metadata (the small
+    things, like the vocabulary), and a table of where each array lives
+    in the data section.
+  - The data section: the raw contents of every array (coordinates,
+    postings, columns, JSON fragments), each aligned to 8 bytes.
+
+Loading maps the file into memory and hands out ctypes views straight
+into the mapping, so nothing in the data section gets copied or parsed.
+The pages only get read as searches touch them, and processes that map
+the same snapshot share them.
+"""
+
+import ctypes
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import zlib
+import cPickle as pickle
+
+from array import array
+from collections import Counter
+from optparse import OptionParser
+
+from search import SpatialIndex, DocumentIndex
+from store import ObjectStore
+
+
+MAGIC = 'TRKSNAP\x00'
+VERSION = 4
+
+# magic, version, crc32, header length
+PREFIX = struct.Struct('<8sIIQ')
+
+ALIGNMENT = 8
+
+# how much of the file gets checksummed at a time
+CHUNK_SIZE = 1 << 20
+
+# what each array typecode gets viewed as. 'c' is a plain string.
+CTYPES = {
+    'b': ctypes.c_byte,
+    'B': ctypes.c_ubyte,
+    'h': ctypes.c_short,
+    'H': ctypes.c_ushort,
+    'i': ctypes.c_int,
+    'I': ctypes.c_uint,
+    'l': ctypes.c_long,
+    'L': ctypes.c_ulong,
+    'f': ctypes.c_float,
+    'd': ctypes.c_double,
+    'c': ctypes.c_char,
+}
+
+COMPONENTS = (
+    ('spatial', SpatialIndex),
+    ('text', DocumentIndex),
+    ('store', ObjectStore),
+)
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def _aligned(n):
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _platform():
+    """What the raw arrays depend on to be read back correctly"""
+    return {'byteorder': sys.byteorder,
+            'itemsizes': dict((t, ctypes.sizeof(c))
+                              for t, c in CTYPES.iteritems())}
+
+
+def is_snapshot(fname):
+    """Does `fname` look like a snapshot?"""
+    with open(fname, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def save(fname, spatial, text, store):
+    """Writes `spatial`, `text` and `store` to the snapshot `fname`.
+
+    The file is written next to `fname` and renamed into place, so
+    anything mapping the old `fname` is unaffected.
+    """
+    meta, arrays = {}, {}
+    for name, component in zip((n for n, _ in COMPONENTS),
+                               (spatial, text, store)):
+        m, a = component._dump()
+        meta[name] = m
+        for n, v in a.iteritems():
+            arrays['%s.%s' % (name, n)] = v
+
+    layout, blobs, offset = {}, [], 0
+    for name in sorted(arrays):
+        a = arrays[name]
+        if isinstance(a, array):
+            typecode, blob, length = a.typecode, a.tostring(), len(a)
+        else:
+            typecode, blob, length = 'c', str(a), len(a)
+        layout[name] = (typecode, offset, length)
+        blobs.append((offset, blob))
+        offset = _aligned(offset + len(blob))
+
+    header = pickle.dumps({'meta': meta, 'layout': layout,
+                           'platform': _platform()}, 2)
+    start = _aligned(PREFIX.size + len(header))
+
+    directory = os.path.dirname(os.path.abspath(fname))
+    fd, tmpname = tempfile.mkstemp(dir=directory, prefix='.snapshot')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            crc = 0
+            f.write(PREFIX.pack(MAGIC, VERSION, 0, len(header)))
+
+            def write(s):
+                f.write(s)
+                return zlib.crc32(s, crc)
+
+            crc = write(header)
+            crc = write('\0' * (start - PREFIX.size - len(header)))
+            written = 0
+            for at, blob in blobs:
+                crc = write('\0' * (at - written))
+                crc = write(blob)
+                written = at + len(blob)
+
+            f.seek(0)
+            f.write(PREFIX.pack(MAGIC, VERSION, crc & 0xffffffff,
+                                len(header)))
+        # mkstemp only lets us read it
+        os.chmod(tmpname, 0644)
+        os.rename(tmpname, fname)
+    except:
+        os.unlink(tmpname)
+        raise
+
+
+class Reader(object):
+    """Hands out views of the arrays in a mapped snapshot, optionally
+    scoped to the names starting with `prefix`."""
+
+    def __init__(self, mm, start, layout, prefix=''):
+        self.mm = mm
+        self.start = start
+        self.layout = layout
+        self.prefix = prefix
+
+    def scope(self, prefix):
+        return Reader(self.mm, self.start, self.layout, self.prefix + prefix)
+
+    def _find(self, name):
+        try:
+            return self.layout[self.prefix + name]
+        except KeyError:
+            raise SnapshotError("snapshot has no array %r" %
+                                (self.prefix + name))
+
+    def view(self, name, start=0, count=None):
+        """A ctypes array over `count` items of the array `name`,
+        starting at item `start`, without copying anything."""
+        typecode, offset, length = self._find(name)
+        ctype = CTYPES[typecode]
+        if count is None:
+            count = length - start
+        if not count:
+            return (ctype * 0)()
+        at = self.start + offset + start * ctypes.sizeof(ctype)
+        return (ctype * count).from_buffer(self.mm, at)
+
+    def blob(self, name):
+        """The mapping and offset at which the string `name` starts"""
+        typecode, offset, length = self._find(name)
+        return self.mm, self.start + offset
+
+
+def load(fname, verify=True):
+    """Maps the snapshot `fname` back in, returning
+    (spatial index, text index, object store).
+
+    With `verify`, the whole file is checksummed first.
+    """
+    with open(fname, 'rb') as f:
+        # a private mapping, which ctypes can view, but which nothing
+        # ever writes to, so its pages stay shared.
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    if len(mm) < PREFIX.size:
+        raise SnapshotError("%s is too short to be a snapshot" % fname)
+    magic, version, crc, header_length = PREFIX.unpack_from(mm, 0)
+    if magic != MAGIC:
+        raise SnapshotError("%s isn't a snapshot" % fname)
+    if version != VERSION:
+        raise SnapshotError("%s is a version %d snapshot, but we only read "
+                            "version %d" % (fname, version, VERSION))
+
+    if verify:
+        check = 0
+        for at in xrange(PREFIX.size, len(mm), CHUNK_SIZE):
+            check = zlib.crc32(mm[at:at + CHUNK_SIZE], check)
+        if check & 0xffffffff != crc:
+            raise SnapshotError("%s is corrupt" % fname)
+
+    header = pickle.loads(mm[PREFIX.size:PREFIX.size + header_length])
+    if header['platform'] != _platform():
+        raise SnapshotError("%s was written on an incompatible platform"
+                            % fname)
+
+    reader = Reader(mm, _aligned(PREFIX.size + header_length),
+                    header['layout'])
+    return tuple(cls._restore(header['meta'][name],
+                              reader.scope(name + '.'))
+                 for name, cls in COMPONENTS)
+
+
+def shared(spatial, text, store, directory=None):
+    """Moves freshly built indexes into a mapping, returning
+    (spatial index, text index, object store) restored from it.
+
+    Forked processes share the mapped pages for as long as they run,
+    rather than each slowly copying the originals. The file behind the
+    mapping is removed straight away.
+    """
+    fd, fname = tempfile.mkstemp(dir=directory, prefix='.snapshot')
+    os.close(fd)
+    try:
+        save(fname, spatial, text, store)
+        return load(fname, verify=False)
+    finally:
+        os.unlink(fname)
+
+
+parser = OptionParser(usage="%prog [options] datafile snapshotfile")
+
+
+def main(argv=None):
+    from loader import load as load_csv
+
+    (options, args) = parser.parse_args(argv)
+    if len(args) != 2:
+        parser.print_help()
+        raise SystemExit()
+
+    print "Loading data from file...."
+    counters = Counter()
+    spatial, text, store = load_csv(args[0], counters=counters)
+    save(args[1], spatial, text, store)
+    print "%d locations written to %s (%d rows skipped)" % (
+        len(store), args[1], counters['rows'] - counters['indexed'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+"""stats.py: Where the time goes in a request.
+
+Instrumentation is off unless `enable` is called. Once it is, a request
+that calls `begin` gets a `Timing`, which the code it runs adds to as
+it goes:
+
+  - `with stage('score'):` times a stage. Stages can nest, so a stage's
+    time includes any stages inside of it.
+  - `count('candidates', n)` adds to a counter.
+  - `counting('nodes', push)` wraps a function, counting its calls. The
+    index walks wrap the push onto their stacks with it, so nodes are
+    counted without adding anything to their loops while disabled.
+
+`finish` adds the request's `Timing` to the totals kept for the whole
+process, which `summary` reports.
+
+The current `Timing` is kept in a `threading.local`, which gevent's
+monkey patching makes local to each greenlet, so requests served
+concurrently don't mix. While disabled, each of these is a single check
+for None.
+"""
+
+import threading
+import time
+
+from collections import OrderedDict
+
+
+_local = threading.local()
+_enabled = False
+
+
+def enable(on=True):
+    """Turns instrumentation on, or off"""
+    global _enabled
+    _enabled = on
+
+
+def enabled():
+    return _enabled
+
+
+class Timing(object):
+    """The stage timings, in milliseconds, and counters of one request"""
+
+    def __init__(self):
+        self.start = time.time()
+        self.stages = OrderedDict()
+        self.counters = OrderedDict()
+        self.total = None
+
+    def add(self, name, ms):
+        self.stages[name] = self.stages.get(name, 0.0) + ms
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def header(self):
+        """The timing as a one line header value, like
+        'total=2.41 plan=0.05 spatial=1.90 nodes=331 rows=10'"""
+        bits = []
+        if self.total is not None:
+            bits.append('total=%.2f' % self.total)
+        bits.extend('%s=%.2f' % kv for kv in self.stages.iteritems())
+        bits.extend('%s=%d' % kv for kv in self.counters.iteritems())
+        return ' '.join(bits)
+
+
+def current():
+    """The current request's `Timing`, or None"""
+    return getattr(_local, 'timing', None)
+
+
+def begin():
+    """Starts timing the current request, returning its `Timing`, or
+    None if instrumentation is off"""
+    if not _enabled:
+        return None
+    timing = _local.timing = Timing()
+    return timing
+
+
+def finish():
+    """Stops timing the current request, adding it to the totals, and
+    returning its `Timing`"""
+    timing = current()
+    if timing is None:
+        return None
+    _local.timing = None
+    timing.total = (time.time() - timing.start) * 1000
+    TOTALS.add(timing)
+    return timing
+
+
+class stage(object):
+    """Times what's run inside of it as the stage `name`"""
+
+    __slots__ = ('name', 'timing', 'start',)
+
+    def __init__(self, name):
+        self.name = name
+        self.timing = current()
+
+    def __enter__(self):
+        if self.timing is not None:
+            self.start = time.time()
+
+    def __exit__(self, *exc):
+        if self.timing is not None:
+            self.timing.add(self.name, (time.time() - self.start) * 1000)
+
+
+def count(name, n=1):
+    """Adds `n` to the counter `name`"""
+    timing = current()
+    if timing is not None:
+        timing.count(name, n)
+
+
+def counting(name, func):
+    """`func`, counting each call in the counter `name`, or just `func`
+    if nothing is being timed"""
+    timing = current()
+    if timing is None:
+        return func
+    counters = timing.counters
+    counters.setdefault(name, 0)
+
+    def counted(*args):
+        counters[name] += 1
+        return func(*args)
+    return counted
+
+
+class Totals(object):
+    """Timings summed up over every request"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.requests = 0
+        self.total = 0.0
+        self.worst = 0.0
+        # name -> [requests, total ms, worst ms]
+        self.stages = {}
+        self.counters = {}
+
+    def add(self, timing):
+        self.requests += 1
+        self.total += timing.total
+        self.worst = max(self.worst, timing.total)
+        for name, ms in timing.stages.iteritems():
+            s = self.stages.setdefault(name, [0, 0.0, 0.0])
+            s[0] += 1
+            s[1] += ms
+            s[2] = max(s[2], ms)
+        for name, n in timing.counters.iteritems():
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def summary(self):
+        requests = self.requests or 1
+        return {
+            'requests': self.requests,
+            'mean_ms': self.total / requests,
+            'max_ms': self.worst,
+            'stages': dict((name, {'requests': n, 'mean_ms': total / n,
+                                   'max_ms': worst})
+                           for name, (n, total, worst)
+                           in self.stages.iteritems()),
+            'counters': dict((name, {'total': n, 'per_request': float(n) /
+                                     requests})
+                             for name, n in self.counters.iteritems()),
+        }
+
+
+TOTALS = Totals()
@@ -0,0 +1,552 @@
+"""store.py: A compact home for the permit rows behind the indexes.
+
+Keeping every CSV row around as its own dict means paying for a hash
+table, and a fresh copy of every string, per row. Instead, we keep a
+column at a time, and hand out cheap row views on demand.
+
+Each row gets an integer row id, which is just its position in the
+columns. The indexes are keyed on the same row ids, so a search result
+leads straight back to its row.
+
+Columns come in a few flavors:
+
+  - Categorical columns, like `Status`, only have a handful of distinct
+    values. Each row stores a one byte code into a table of them.
+  - Template columns, like `Schedule`, are almost always the same
+    string with another field filled in. Only the rows where that isn't
+    true store anything.
+  - Everything else is a list of strings, interned so that repeated
+    values (addresses, applicants, dates) are only stored once. Stores
+    read back from a snapshot pack each of these into a single buffer
+    instead.
+
+Some columns, like `Location`, which just repeats `Latitude` and
+`Longitude`, aren't kept at all.
+
+Categorical columns can also be filtered on. For each of their values,
+a `Bitmap` holds a bit per row, set when the row has that value, so
+"approved push carts" is an OR and an AND of a few bitmaps, and
+checking whether a row passes is a single bit test.
+
+Finally, each row's fields can be kept already encoded as JSON: a
+fragment like `"Applicant": "Cupkates", "Status": "APPROVED"`, without
+the braces, which responses splice their own fields onto rather than
+encoding the row all over again.
+"""
+
+from array import array
+from binascii import hexlify, unhexlify
+from json.encoder import encode_basestring_ascii
+
+
+# Columns with only a handful of distinct values
+CATEGORICAL_FIELDS = ('FacilityType', 'Status',)
+
+# Columns that are (almost always) other fields filled into a template
+TEMPLATE_FIELDS = {
+    'Schedule': ('http://bsm.sfdpw.org/PermitsTracker/reports/report.aspx'
+                 '?title=schedule&report=rptSchedule'
+                 '&params=permit=%(permit)s&ExportPDF=1'
+                 '&Filename=%(permit)s_schedule.pdf'),
+}
+
+# Columns that aren't worth keeping
+DROPPED_FIELDS = ('Location',)
+
+# How fields are shown, where that isn't just as they're stored
+DISPLAYED_FIELDS = {
+    'Address': lambda value: value.title(),
+}
+
+
+class CategoricalColumn(object):
+    """Stores a small integer code per row, indexing into `values`"""
+
+    __slots__ = ('codes', 'values', '_lookup',)
+
+    def __init__(self):
+        self.codes = array('B')
+        self.values = []
+        self._lookup = {}
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, i):
+        return self.values[self.codes[i]]
+
+    def code(self, value):
+        """The code for `value`, or None if no row has it"""
+        return self._lookup.get(value)
+
+    def append(self, value):
+        code = self._lookup.get(value)
+        if code is None:
+            code = self._lookup[value] = len(self.values)
+            self.values.append(value)
+            if code > 0xff and self.codes.typecode == 'B':
+                self.codes = array('H', self.codes)
+        self.codes.append(code)
+
+
+class TextColumn(object):
+    """Stores a string per row, interned so repeats are shared"""
+
+    __slots__ = ('values',)
+
+    def __init__(self):
+        self.values = []
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, i):
+        return self.values[i]
+
+    def append(self, value):
+        self.values.append(intern(value))
+
+
+class PackedTextColumn(object):
+    """A read-only string per row, sliced out of one big buffer.
+
+    Row `i` is `data[base + bounds[2i]:base + bounds[2i + 1]]`, so rows
+    with the same value can share the same bytes. `data` can be
+    anything that slices into strings, including an mmap.
+    """
+
+    __slots__ = ('data', 'base', 'bounds',)
+
+    def __init__(self, data, base, bounds):
+        self.data = data
+        self.base = base
+        self.bounds = bounds
+
+    def __len__(self):
+        return len(self.bounds) // 2
+
+    def __getitem__(self, i):
+        base = self.base
+        return self.data[base + self.bounds[2 * i]:
+                         base + self.bounds[2 * i + 1]]
+
+    @classmethod
+    def pack(cls, column):
+        """Packs any column of strings, storing each value once"""
+        chunks, bounds, seen = [], array('l'), {}
+        size = 0
+        for i in xrange(len(column)):
+            value = column[i]
+            if value not in seen:
+                seen[value] = size
+                chunks.append(value)
+                size += len(value)
+            bounds.append(seen[value])
+            bounds.append(seen[value] + len(value))
+        return cls(''.join(chunks), 0, bounds)
+
+
+class Bitmap(object):
+    """A set of row ids below `size`, as a bit per row.
+
+    Row `i` is bit `i & 7` of byte `i >> 3`. Combining bitmaps goes
+    through Python's long integers, so it happens a machine word at a
+    time, in C. The long, and the number of rows, are kept once worked
+    out, until the bitmap changes, so the bitmaps the store keeps for
+    its filters only pay for them once.
+    """
+
+    __slots__ = ('bits', 'size', '_value', '_count',)
+
+    def __init__(self, size, bits=None):
+        self.size = size
+        self.bits = bytearray((size + 7) >> 3) if bits is None else bits
+        self._value = None
+        self._count = None
+
+    @classmethod
+    def _from_long(cls, size, value):
+        n = (size + 7) >> 3
+        if not n:
+            return cls(size)
+        bits = bytearray(unhexlify('%0*x' % (2 * n, value)))
+        bits.reverse()
+        bitmap = cls(size, bits)
+        bitmap._value = value
+        return bitmap
+
+    def _long(self):
+        if self._value is None:
+            self._value = int(hexlify(self.bits[::-1]), 16) \
+                if self.bits else 0
+        return self._value
+
+    def __contains__(self, i):
+        # anything but a row id (a string key, None) compares out of
+        # range, or can't be shifted
+        try:
+            return 0 <= i < self.size and \
+                bool(self.bits[i >> 3] & (1 << (i & 7)))
+        except TypeError:
+            return False
+
+    def __len__(self):
+        if self._count is None:
+            self._count = bin(self._long()).count('1')
+        return self._count
+
+    def __iter__(self):
+        bits = self.bits
+        for byte in xrange(len(bits)):
+            b = bits[byte]
+            while b:
+                low = b & -b
+                yield (byte << 3) + low.bit_length() - 1
+                b ^= low
+
+    def __and__(self, other):
+        return Bitmap._from_long(min(self.size, other.size),
+                                 self._long() & other._long())
+
+    def __or__(self, other):
+        size = max(self.size, other.size)
+        return Bitmap._from_long(size, self._long() | other._long())
+
+    def resize(self, size):
+        """Makes room for rows up to `size`"""
+        n = (size + 7) >> 3
+        if n > len(self.bits):
+            self.bits.extend(bytearray(n - len(self.bits)))
+        self.size = max(self.size, size)
+
+    def add(self, i):
+        if i >= self.size:
+            self.resize(i + 1)
+        self.bits[i >> 3] |= 1 << (i & 7)
+        self._value = self._count = None
+
+    def discard(self, i):
+        if 0 <= i < self.size:
+            self.bits[i >> 3] &= ~(1 << (i & 7)) & 0xff
+            self._value = self._count = None
+
+
+class Row(object):
+    """A read-only view of a single row in an `ObjectStore`, which
+    reads like the dict `csv.DictReader` would have given us."""
+
+    __slots__ = ('store', 'id',)
+
+    def __init__(self, store, rowid):
+        self.store = store
+        self.id = rowid
+
+    def __getitem__(self, field):
+        if field not in self.store._fieldset:
+            raise KeyError(field)
+        return self.store.value(self.id, field)
+
+    def __contains__(self, field):
+        return field in self.store._fieldset
+
+    def __iter__(self):
+        return iter(self.store.fields)
+
+    def get(self, field, default=None):
+        if field not in self.store._fieldset:
+            return default
+        return self.store.value(self.id, field)
+
+    def keys(self):
+        return list(self.store.fields)
+
+    def copy(self):
+        return dict((f, self[f]) for f in self.store.fields)
+
+
+class ObjectStore(object):
+    """Rows with the columns `fields`, stored a column at a time.
+
+    `categorical`, `templates` and `dropped` say which of `fields` get
+    stored as codes, filled in from a template, or not at all.
+    `displayed` says how fields are shown in the rows' JSON fragments.
+    """
+
+    def __init__(self, fields, categorical=CATEGORICAL_FIELDS,
+                 templates=TEMPLATE_FIELDS, dropped=DROPPED_FIELDS,
+                 displayed=DISPLAYED_FIELDS):
+        self.fields = tuple(f for f in fields if f not in dropped)
+        self._fieldset = frozenset(self.fields)
+        self._displayed = displayed
+        # each row's JSON fragment, once they've been built
+        self._fragments = None
+        self._templates = dict((f, t) for f, t in templates.iteritems()
+                               if f in self._fieldset)
+        self._exceptions = dict((f, {}) for f in self._templates)
+        self._columns = {}
+        for f in self.fields:
+            if f in self._templates:
+                continue
+            elif f in categorical:
+                self._columns[f] = CategoricalColumn()
+            else:
+                self._columns[f] = TextColumn()
+        self._size = 0
+        self._bitmaps = {}
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        return iter(xrange(self._size))
+
+    def column(self, field):
+        """The column storing `field`, if it's stored as one"""
+        return self._columns.get(field)
+
+    def _writable(self, field):
+        """The column storing `field`, turned back into one which can
+        be changed if it was mapped from a snapshot"""
+        column = self._columns.get(field)
+        if isinstance(column, CategoricalColumn):
+            if not isinstance(column.codes, array):
+                column.codes = array('H' if len(column.values) > 0xff
+                                     else 'B', column.codes)
+        elif isinstance(column, PackedTextColumn):
+            packed = column
+            column = self._columns[field] = TextColumn()
+            for i in xrange(len(packed)):
+                column.append(packed[i])
+        return column
+
+    def append(self, row):
+        """Adds `row`, a dict of field values, returning its row id"""
+        return self.extend([row])
+
+    def extend(self, rows):
+        """Adds each of `rows`, returning the row id of the first. Each
+        column is only looked up once, so this is the quick way to add a
+        lot of rows."""
+        first = self._size
+        for f in self._columns.keys():
+            column = self._writable(f)
+            add = column.append
+            for row in rows:
+                add(row.get(f) or '')
+            bitmaps = self._bitmaps.get(f)
+            if bitmaps is not None:
+                codes = column.codes
+                for rowid in xrange(first, first + len(rows)):
+                    bitmap = bitmaps.get(codes[rowid])
+                    if bitmap is None:
+                        bitmap = bitmaps[codes[rowid]] = Bitmap(rowid)
+                    bitmap.add(rowid)
+        for f, template in self._templates.iteritems():
+            exceptions = self._exceptions[f]
+            for rowid, row in enumerate(rows, first):
+                value = row.get(f) or ''
+                try:
+                    expected = template % row
+                except KeyError:
+                    expected = None
+                if value != expected:
+                    exceptions[rowid] = value
+        self._size += len(rows)
+        if self._fragments is not None:
+            self._writable_fragments().extend(
+                self._encode(rowid) for rowid in xrange(first, self._size))
+        return first
+
+    def set(self, rowid, field, value):
+        """Changes the value of `field` for the row `rowid`"""
+        if field not in self._fieldset:
+            raise KeyError(field)
+        if not 0 <= rowid < self._size:
+            raise KeyError(rowid)
+
+        # values filled in from a template might depend on this one
+        templated = dict((f, self.value(rowid, f)) for f in self._templates
+                         if f != field)
+
+        column = self._writable(field)
+        if column is None:
+            self._set_templated(rowid, field, value)
+        elif isinstance(column, CategoricalColumn):
+            code = column.code(value)
+            if code is None:
+                column.append(value)
+                column.codes.pop()
+                code = column.code(value)
+            bitmaps = self._bitmaps.get(field)
+            if bitmaps is not None:
+                bitmaps[column.codes[rowid]].discard(rowid)
+                if code not in bitmaps:
+                    bitmaps[code] = Bitmap(self._size)
+                bitmaps[code].add(rowid)
+            column.codes[rowid] = code
+        else:
+            column.values[rowid] = intern(value)
+
+        for f, v in templated.iteritems():
+            self._set_templated(rowid, f, v)
+        if self._fragments is not None:
+            self._writable_fragments()[rowid] = self._encode(rowid)
+
+    def _set_templated(self, rowid, field, value):
+        exceptions = self._exceptions[field]
+        exceptions.pop(rowid, None)
+        if self.value(rowid, field) != value:
+            exceptions[rowid] = value
+
+    def value(self, rowid, field):
+        """The value of `field` for the row `rowid`"""
+        column = self._columns.get(field)
+        if column is not None:
+            return column[rowid]
+        exceptions = self._exceptions[field]
+        if rowid in exceptions:
+            return exceptions[rowid]
+        return self._templates[field] % Row(self, rowid)
+
+    def _encode(self, rowid):
+        """The JSON fragment of the row `rowid`"""
+        parts = []
+        displayed = self._displayed
+        for f in self.fields:
+            value = self.value(rowid, f)
+            if f in displayed:
+                value = displayed[f](value)
+            parts.append('%s: %s' % (encode_basestring_ascii(f),
+                                     encode_basestring_ascii(value)))
+        return ', '.join(parts)
+
+    def _writable_fragments(self):
+        if not isinstance(self._fragments, list):
+            packed = self._fragments
+            self._fragments = [packed[i] for i in xrange(len(packed))]
+        return self._fragments
+
+    def build_fragments(self):
+        """Encodes every row's JSON fragment up front, and keeps them up
+        to date from then on"""
+        self._fragments = map(self._encode, xrange(self._size))
+
+    def fragment(self, rowid):
+        """The fields of the row `rowid`, encoded as JSON, without the
+        braces around them"""
+        if self._fragments is None:
+            return self._encode(rowid)
+        return self._fragments[rowid]
+
+    def _dump(self):
+        """Flattens the store into (meta, {name: array}) for a snapshot.
+
+        Text columns are packed into a single string each, so they can
+        be mapped straight back in. So are the rows' JSON fragments,
+        which are built now if they haven't been already.
+        """
+        columns, arrays = {}, {}
+        for f, column in self._columns.iteritems():
+            if isinstance(column, CategoricalColumn):
+                columns[f] = ('categorical', column.values)
+                arrays[f + '.codes'] = column.codes
+            else:
+                packed = PackedTextColumn.pack(column)
+                columns[f] = ('text', None)
+                arrays[f + '.data'] = packed.data
+                arrays[f + '.bounds'] = packed.bounds
+
+        fragments = self._fragments
+        if fragments is None:
+            fragments = map(self._encode, xrange(self._size))
+        packed = PackedTextColumn.pack(fragments)
+        arrays['fragments.data'] = packed.data
+        arrays['fragments.bounds'] = packed.bounds
+
+        meta = {'fields': self.fields, 'templates': self._templates,
+                'exceptions': self._exceptions, 'size': self._size,
+                'columns': columns}
+        return meta, arrays
+
+    @classmethod
+    def _restore(cls, meta, reader):
+        """The inverse of `_dump`, with arrays coming from `reader`"""
+        store = cls.__new__(cls)
+        store.fields = meta['fields']
+        store._fieldset = frozenset(store.fields)
+        store._templates = meta['templates']
+        store._exceptions = meta['exceptions']
+        store._size = meta['size']
+        store._displayed = DISPLAYED_FIELDS
+        store._bitmaps = {}
+        store._columns = {}
+        for f, (kind, values) in meta['columns'].iteritems():
+            if kind == 'categorical':
+                column = CategoricalColumn()
+                column.codes = reader.view(f + '.codes')
+                column.values = values
+                column._lookup = dict((v, i) for i, v in enumerate(values))
+            else:
+                data, base = reader.blob(f + '.data')
+                column = PackedTextColumn(data, base,
+                                          reader.view(f + '.bounds'))
+            store._columns[f] = column
+        data, base = reader.blob('fragments.data')
+        store._fragments = PackedTextColumn(data, base,
+                                            reader.view('fragments.bounds'))
+        return store
+
+    def bitmaps(self, field):
+        """{code: `Bitmap`} of the rows with each value of the
+        categorical column `field`, built the first time it's asked
+        for."""
+        bitmaps = self._bitmaps.get(field)
+        if bitmaps is None:
+            column = self._columns.get(field)
+            if not isinstance(column, CategoricalColumn):
+                raise KeyError("%s isn't categorical" % field)
+            size = self._size
+            bitmaps = dict((code, Bitmap(size))
+                           for code in xrange(len(column.values)))
+            for rowid, code in enumerate(column.codes):
+                bitmaps[code].add(rowid)
+            self._bitmaps[field] = bitmaps
+        return bitmaps
+
+    def bitmap(self, field, value):
+        """A `Bitmap` of the rows whose `field` is `value`"""
+        bitmaps = self.bitmaps(field)
+        code = self._columns[field].code(value)
+        if code is None or code not in bitmaps:
+            return Bitmap(self._size)
+        return bitmaps[code]
+
+    def matching(self, filters):
+        """A `Bitmap` of the rows matching every one of `filters`,
+        {field: [values]}, where a row matches a field if it has any
+        of its values.
+
+        A single value's bitmap is handed back as it is, rather than
+        copied, so it keeps what it knows about itself; it's only to be
+        read."""
+        matched = None
+        for field, values in sorted(filters.iteritems()):
+            either = None
+            for value in values:
+                bitmap = self.bitmap(field, value)
+                either = bitmap if either is None else either | bitmap
+            if either is None:
+                either = Bitmap(self._size)
+            matched = either if matched is None else matched & either
+        return matched
+
+    def get(self, rowid, default=None):
+        """A `Row` view of `rowid`, or `default` if there's no such row"""
+        if 0 <= rowid < self._size:
+            return Row(self, rowid)
+        return default
+
+    def __getitem__(self, rowid):
+        if not 0 <= rowid < self._size:
+            raise KeyError(rowid)
+        return Row(self, rowid)